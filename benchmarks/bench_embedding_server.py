@@ -0,0 +1,96 @@
+"""
+Measures throughput and latency of the embedding server under concurrent load, with and without batching.
+
+Every client thread sends single-text queries over HTTP, like the retrievers do. The unbatched run uses
+``max_batch_size=1``, i.e. one forward pass per request.
+
+Usage::
+
+    python benchmarks/bench_embedding_server.py [--clients 32] [--requests 512] [--workers 2]
+    python benchmarks/bench_embedding_server.py --synthetic   # no model download, simulated forward pass
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_PATH)
+
+from legacy_code_assistant.knowledge_base.embedding_server import EmbeddingClient, EmbeddingServer
+
+
+class SyntheticEncoder:
+    """Simulates a CPU forward pass: a fixed overhead per batch plus a cost per text."""
+
+    def __init__(self, batch_seconds=0.02, text_seconds=0.002, dim=768):
+        self.batch_seconds = batch_seconds
+        self.text_seconds = text_seconds
+        self.dim = dim
+
+    def encode_batch(self, texts):
+        time.sleep(self.batch_seconds + self.text_seconds * len(texts))
+        return np.zeros((len(texts), self.dim), dtype='float32')
+
+
+def load_texts(count):
+    df = pd.read_csv(os.path.join(PROJECT_PATH, 'notebooks', 'knowledge_base.csv'))
+    texts = df['code'].dropna().astype(str).tolist()
+    return [texts[i % len(texts)] for i in range(count)]
+
+
+def run(encoder, texts, clients, workers, max_batch_size, max_wait_ms):
+    with EmbeddingServer(encoder, workers=workers, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                         port=0) as server:
+        client = EmbeddingClient(server.url)
+        client.embed_query(texts[0])
+
+        def timed_query(text):
+            start = time.perf_counter()
+            client.embed_query(text)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            latencies = np.array(list(executor.map(timed_query, texts)))
+        seconds = time.perf_counter() - start
+        batches = server.batches - 1
+
+    return {
+        'texts_per_second': len(texts) / seconds,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'mean_batch_size': len(texts) / max(batches, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--model', default='microsoft/codebert-base')
+    parser.add_argument('--synthetic', action='store_true', help='Use a simulated encoder instead of the model.')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        encoder = SyntheticEncoder()
+    else:
+        from legacy_code_assistant.knowledge_base.embedding_processor import EmbeddingProcessor
+        encoder = EmbeddingProcessor(args.model)
+    texts = load_texts(args.requests)
+
+    for name, max_batch_size in (('unbatched', 1), ('batched', args.max_batch_size)):
+        result = run(encoder, texts, args.clients, args.workers, max_batch_size, args.max_wait_ms)
+        print(f"{name:10s} {result['texts_per_second']:8.1f} texts/s  p50 {result['p50_ms']:8.1f} ms  "
+              f"p99 {result['p99_ms']:8.1f} ms  mean batch {result['mean_batch_size']:5.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Compares the two-pass ``os.walk`` discovery with the single-pass ``scan_repository`` on a large synthetic tree.
+
+Usage::
+
+    python benchmarks/bench_file_discovery.py [--packages 300] [--vendor-packages 3000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from legacy_code_assistant.data_extraction.data_extractor import (extract_code_and_documentation, extract_code_files,
+                                                                  extract_documentation)
+
+
+def build_tree(root, packages, vendor_packages, files_per_package=20):
+    """Create a source tree plus ``node_modules``/``.venv`` directories of the given sizes."""
+    layout = [('src', packages), ('node_modules', vendor_packages), (os.path.join('.venv', 'lib'), vendor_packages)]
+    for top, count in layout:
+        for package in range(count):
+            directory = os.path.join(root, top, f'package_{package}')
+            os.makedirs(directory)
+            for i in range(files_per_package):
+                extension = '.md' if i % 5 == 0 else '.py'
+                with open(os.path.join(directory, f'file_{i}{extension}'), 'w') as f:
+                    f.write('x = 1\n')
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--packages', type=int, default=300)
+    parser.add_argument('--vendor-packages', type=int, default=3000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        build_tree(root, args.packages, args.vendor_packages)
+
+        walk_seconds, (code_files, doc_files) = timed(
+            lambda: (extract_code_files(root), extract_documentation(root, ('.md',))))
+        scan_seconds, (scanned_code, scanned_docs) = timed(
+            lambda: extract_code_and_documentation(root, doc_types=('.md',)))
+
+        print(f'os.walk x2:       {walk_seconds:8.3f}s  {len(code_files)} code, {len(doc_files)} doc files')
+        print(f'scan_repository:  {scan_seconds:8.3f}s  {len(scanned_code)} code, {len(scanned_docs)} doc files')
+        print(f'speed-up:         {walk_seconds / scan_seconds:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
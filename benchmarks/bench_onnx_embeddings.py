@@ -0,0 +1,92 @@
+"""
+Compares the PyTorch and ONNX Runtime (fp32 and int8) CodeBERT backends on the items of ``knowledge_base.csv``.
+
+For every backend the code of all items is embedded and searched with one query per item (its docstring, or its
+name when it has none). Reported are:
+
+* texts/s of embedding the code,
+* the mean cosine similarity of the code vectors to the PyTorch ones,
+* recall@k: the share of the PyTorch top-k results that the backend also returns,
+* hit@k: the share of queries whose own item is in the top-k.
+
+Usage::
+
+    python benchmarks/bench_onnx_embeddings.py [--threads 4] [--batch-size 16] [--k 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_PATH)
+
+from legacy_code_assistant.knowledge_base.embedding_processor import EmbeddingProcessor
+from legacy_code_assistant.knowledge_base.onnx_embedding_processor import OnnxEmbeddingProcessor
+
+
+def load_items():
+    df = pd.read_csv(os.path.join(PROJECT_PATH, 'notebooks', 'knowledge_base.csv'))
+    df = df[df['code'].notna()].reset_index(drop=True)
+    queries = df['docstring'].where(df['docstring'].notna(), df['name']).astype(str).tolist()
+    return df['code'].astype(str).tolist(), queries
+
+
+def embed(processor, texts, batch_size):
+    start = time.perf_counter()
+    vectors = np.concatenate([processor.encode_batch(texts[i:i + batch_size])
+                              for i in range(0, len(texts), batch_size)])
+    return vectors, len(texts) / (time.perf_counter() - start)
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def top_k(code_vectors, query_vectors, k):
+    scores = normalize(query_vectors) @ normalize(code_vectors).T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='microsoft/codebert-base')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    codes, queries = load_items()
+    backends = {
+        'pytorch fp32': EmbeddingProcessor(args.model),
+        'onnx fp32': OnnxEmbeddingProcessor(args.model, num_threads=args.threads),
+        'onnx int8': OnnxEmbeddingProcessor(args.model, quantize=True, num_threads=args.threads),
+    }
+
+    reference = None
+    print(f"{len(codes)} items, k={args.k}")
+    for name, processor in backends.items():
+        embed(processor, codes[:args.batch_size], args.batch_size)  # warm-up
+        code_vectors, texts_per_second = embed(processor, codes, args.batch_size)
+        query_vectors, _ = embed(processor, queries, args.batch_size)
+        neighbours = top_k(code_vectors, query_vectors, args.k)
+        if reference is None:
+            reference = code_vectors, neighbours
+
+        cosine = (normalize(code_vectors) * normalize(reference[0])).sum(axis=1).mean()
+        recall = np.mean([len(set(found) & set(expected)) / args.k
+                          for found, expected in zip(neighbours, reference[1])])
+        hits = np.mean([i in found for i, found in enumerate(neighbours)])
+        print(f"{name:13s} {texts_per_second:8.1f} texts/s  cosine {cosine:.4f}  recall@{args.k} {recall:.3f}  "
+              f"hit@{args.k} {hits:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Measures the quality uplift and the added latency of the cross-encoder re-ranking stage.
+
+The code of the items of ``generated_docstrings.csv`` is indexed and every generated docstring is a query whose only
+relevant result is the code it was generated from. The dense top-k is compared with the top-k of the reranked
+``--fetch-k`` candidates. Reported are MRR, recall@k and the p50/p95 latency per query.
+
+Usage::
+
+    python benchmarks/bench_reranker.py [--reranker cross-encoder/ms-marco-MiniLM-L-6-v2] [--fetch-k 20]
+        [--budget-ms 200] [--threads 4]
+"""
+import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_PATH)
+
+from legacy_code_assistant.knowledge_base.knowledge_builder import KnowledgeBaseBuilder
+from legacy_code_assistant.knowledge_base.reranker import CrossEncoderReranker
+from legacy_code_assistant.knowledge_base.retrieval_evaluation import build_query_set, evaluate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=os.path.join(PROJECT_PATH, 'notebooks', 'generated_docstrings.csv'))
+    parser.add_argument('--model', default='microsoft/codebert-base')
+    parser.add_argument('--reranker', default='cross-encoder/ms-marco-MiniLM-L-6-v2')
+    parser.add_argument('--fetch-k', type=int, default=20)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--budget-ms', type=float, default=None)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', default=None, help='Path of the written JSON report.')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data)
+    queries = build_query_set(df)
+    kbb = KnowledgeBaseBuilder(model_name=args.model, query_cache_size=0)
+    kbb.upload_df_to_faiss(df[df['code'].notna()], 'code')
+    reranker = CrossEncoderReranker(args.reranker, batch_size=args.batch_size, max_candidates=args.fetch_k,
+                                    time_budget_ms=args.budget_ms, num_threads=args.threads)
+
+    ks = tuple(k for k in (1, 3, 5, 10) if k <= args.k)
+    # Queries are embedded once beforehand, so both runs measure search and reranking only.
+    vectors = {labelled_query.query: kbb.processor.embed_query(labelled_query.query) for labelled_query in queries}
+
+    def dense(query):
+        return [doc for doc, _ in kbb.search_by_vector(vectors[query], k=args.k)]
+
+    def reranked(query):
+        candidates = [doc for doc, _ in kbb.search_by_vector(vectors[query], k=args.fetch_k)]
+        return [doc for doc, _ in reranker.rerank(query, candidates, k=args.k)]
+
+    report = {'queries': len(queries), 'items': len(df), 'fetch_k': args.fetch_k,
+              'dense': evaluate(dense, queries, ks=ks), 'reranked': evaluate(reranked, queries, ks=ks)}
+    report['mrr_uplift'] = report['reranked']['mrr'] - report['dense']['mrr']
+    report['added_latency_p50_ms'] = report['reranked']['latency_p50_ms'] - report['dense']['latency_p50_ms']
+
+    for name in ('dense', 'reranked'):
+        result = report[name]
+        recalls = '  '.join(f"recall@{k} {result[f'recall@{k}']:.3f}" for k in ks)
+        print(f"{name:9s} MRR {result['mrr']:.3f}  {recalls}  p50 {result['latency_p50_ms']:.1f} ms  "
+              f"p95 {result['latency_p95_ms']:.1f} ms")
+    print(f"MRR uplift {report['mrr_uplift']:+.3f}, added p50 latency {report['added_latency_p50_ms']:.1f} ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
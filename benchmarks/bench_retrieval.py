@@ -0,0 +1,117 @@
+"""
+Retrieval quality and latency of the index configurations, written as a machine-readable report.
+
+The labelled queries are built from ``generated_docstrings.csv``: every generated docstring is a query whose only
+relevant result is the code it was generated from. Every configuration is measured with the same queries:
+
+* ``code``: the index of the code, as ``code_based_index``,
+* ``docstring``: the index of the generated docstrings, as ``docstring_based_index``,
+* ``hybrid``: both indexes merged by the IndexRouter,
+
+each with a flat, an IVF and an HNSW FAISS index. Reported per configuration are recall@k, MRR, the p50/p95 search
+latency, the serialized index size and the index build time. The embedding time of the items is reported once per
+index. Query embeddings are computed before the runs, so the latencies are those of the search.
+
+With the default queries the docstring index contains the queries themselves, so its quality is an upper bound;
+``--query-column docstring`` uses the docstrings written by the developers instead.
+
+Usage::
+
+    python benchmarks/bench_retrieval.py [--model microsoft/codebert-base] [--output retrieval_report.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_PATH)
+
+from legacy_code_assistant.knowledge_base.knowledge_builder import KnowledgeBaseBuilder
+from legacy_code_assistant.knowledge_base.retrieval_evaluation import build_query_set, evaluate
+from legacy_code_assistant.rag_integration.index_router import IndexRouter
+
+INDEX_COLUMNS = {'code': 'code', 'docstring': 'generated_docstring'}
+
+
+def index_factories(items, nlist=None):
+    nlist = nlist or max(1, int(items ** 0.5))
+    return {'flat': 'Flat', 'ivf': f'IVF{nlist},Flat', 'hnsw': 'HNSW32'}
+
+
+def index_bytes(knowledge_base):
+    import faiss
+    return int(len(faiss.serialize_index(knowledge_base.vectorstore.index)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=os.path.join(PROJECT_PATH, 'notebooks', 'generated_docstrings.csv'))
+    parser.add_argument('--model', default='microsoft/codebert-base')
+    parser.add_argument('--query-column', default='generated_docstring')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None, help='Number of IVF lists; sqrt(items) by default.')
+    parser.add_argument('--nprobe', type=int, default=4)
+    parser.add_argument('--ef-search', type=int, default=64)
+    parser.add_argument('--operation', default=None, help='RagManager operation whose weights the hybrid uses.')
+    parser.add_argument('--output', default='retrieval_report.json')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data)
+    queries = build_query_set(df, query_column=args.query_column)
+    ks = tuple(k for k in (1, 3, 5, 10) if k <= args.k)
+
+    # Both indexes share one model and its query cache, which is filled before the runs.
+    code_knowledge_base = KnowledgeBaseBuilder(model_name=args.model)
+    knowledge_bases = {'code': code_knowledge_base,
+                       'docstring': KnowledgeBaseBuilder(model=code_knowledge_base.processor, model_name=args.model,
+                                                         query_cache_size=0)}
+    embedding_seconds = {}
+    for name, column in INDEX_COLUMNS.items():
+        start = time.perf_counter()
+        knowledge_bases[name].upload_df_to_faiss(df[df[column].notna()], column)
+        embedding_seconds[name] = time.perf_counter() - start
+    vectors = {labelled_query.query: code_knowledge_base.processor.embed_query(labelled_query.query)
+               for labelled_query in queries}
+
+    report = {'data': os.path.abspath(args.data), 'model': args.model, 'queries': len(queries),
+              'query_column': args.query_column, 'k': args.k, 'nprobe': args.nprobe, 'ef_search': args.ef_search,
+              'embedding_seconds': embedding_seconds, 'configurations': []}
+    for index_type, factory in index_factories(len(df), args.nlist).items():
+        build_seconds = {}
+        for name, knowledge_base in knowledge_bases.items():
+            start = time.perf_counter()
+            knowledge_base.reindex(factory, nprobe=args.nprobe if index_type == 'ivf' else None,
+                                   ef_search=args.ef_search if index_type == 'hnsw' else None)
+            build_seconds[name] = time.perf_counter() - start
+
+        searches = {name: (lambda query, knowledge_base=knowledge_base: [
+            doc for doc, _ in knowledge_base.search_by_vector(vectors[query], k=args.k)])
+            for name, knowledge_base in knowledge_bases.items()}
+        router = IndexRouter(knowledge_bases, k=args.k)
+        searches['hybrid'] = lambda query: [doc for doc, _ in router.search(query, operation=args.operation)]
+
+        for name, search in searches.items():
+            used = list(knowledge_bases) if name == 'hybrid' else [name]
+            result = evaluate(search, queries, ks=ks)
+            result.update({
+                'name': f'{name}-{index_type}', 'index': name, 'index_type': index_type, 'index_factory': factory,
+                'index_bytes': sum(index_bytes(knowledge_bases[used_name]) for used_name in used),
+                'build_seconds': sum(build_seconds[used_name] for used_name in used),
+            })
+            report['configurations'].append(result)
+            recalls = '  '.join(f"R@{k} {result[f'recall@{k}']:.3f}" for k in ks)
+            print(f"{result['name']:16s} MRR {result['mrr']:.3f}  {recalls}  p50 {result['latency_p50_ms']:6.2f} ms  "
+                  f"p95 {result['latency_p95_ms']:6.2f} ms  {result['index_bytes'] / 1024:8.1f} KiB  "
+                  f"build {result['build_seconds'] * 1000:7.1f} ms")
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+Builds one shared knowledge base index from many repositories.
+
+The manifest is a YAML file::
+
+    index_name: knowledge_base_index
+    workdir: repos
+    mirror_cache_dir: repos/.mirrors      # optional
+    clone_options: {depth: 1, single_branch: true, sparse_paths: ['*.py']}
+    repos:
+      - name: school
+        url: https://github.com/adigunsherif/Django-School-Management-System.git
+      - name: other
+        url: https://github.com/example/other.git
+        clone_options: {branch: develop}
+
+Repositories are cloned or fetched by a pool of IO threads, their files are parsed by a process pool and the
+extracted items are embedded in batches into a single FAISS index. Every item carries the ``repo`` it came from
+and its file path relative to that repo, which namespaces the shared index. Bounded queues between the stages
+provide backpressure, so a fast stage waits for a slower one instead of buffering whole repositories.
+
+Usage::
+
+    python build_knowledge_base.py manifest.yaml
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import git
+import pandas as pd
+import yaml
+
+from legacy_code_assistant.data_extraction.data_extractor import scan_repository
+from legacy_code_assistant.data_extraction.repository_cloner import clone_repository
+from legacy_code_assistant.knowledge_base.knowledge_builder import CodeAnalyzer, KnowledgeBaseBuilder
+from legacy_code_assistant.utils.instrumentation import instrumentation
+
+DEFAULT_CLONE_OPTIONS = {'depth': 1, 'single_branch': True, 'sparse_paths': ['*.py']}
+_DONE = object()
+
+
+class StageStats:
+    """Thread-safe throughput counters of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, items, seconds, errors=0):
+        with self._lock:
+            if self.started is None:
+                self.started = time.perf_counter() - seconds
+            self.items += items
+            self.errors += errors
+            self.busy_seconds += seconds
+            self.finished = time.perf_counter()
+
+    def to_dict(self):
+        wall_seconds = (self.finished - self.started) if self.started is not None else 0.0
+        return {
+            'items': self.items,
+            'errors': self.errors,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'wall_seconds': round(wall_seconds, 3),
+            'items_per_second': round(self.items / wall_seconds, 2) if wall_seconds else None,
+        }
+
+
+def _analyze_files(repo_name, repo_path, files):
+    """Parse a chunk of files of one repository; runs in a worker process. A failing file is skipped and counted."""
+    start = time.perf_counter()
+    records, errors = [], 0
+    for file in files:
+        try:
+            file_records = CodeAnalyzer([file]).analyze()
+        except Exception as e:
+            print(f"Error occurred while parsing {file}: {e!r}")
+            errors += 1
+            continue
+        for record in file_records:
+            record['repo'] = repo_name
+            record['file'] = os.path.relpath(record['file'], repo_path)
+        records.extend(file_records)
+    return records, len(files), errors, time.perf_counter() - start
+
+
+class IngestionPipeline:
+    """
+    Clones, parses and embeds the repositories of a manifest into one index.
+
+    Attributes
+    ----------
+    manifest : dict
+        the parsed manifest
+    knowledge_base : KnowledgeBaseBuilder
+        the builder holding the shared index
+    stats : dict
+        StageStats of the clone, parse and embed stages
+    """
+
+    def __init__(self, manifest, knowledge_base=None, clone_workers=8, parse_workers=None, files_per_task=64,
+                 embed_batch_size=256, queue_size=4):
+        self.manifest = manifest
+        self.workdir = manifest.get('workdir', 'repos')
+        self.knowledge_base = knowledge_base or KnowledgeBaseBuilder(
+            index_name=manifest.get('index_name', 'knowledge_base_index'))
+        self.clone_workers = clone_workers
+        self.parse_workers = parse_workers or os.cpu_count()
+        self.files_per_task = files_per_task
+        self.embed_batch_size = embed_batch_size
+        self.queue_size = queue_size
+        self.stats = {name: StageStats(name) for name in ('clone', 'parse', 'embed')}
+
+    def run(self):
+        """Run all stages to completion, save the index and return the throughput report."""
+        repos = self.manifest.get('repos') or []
+        repos_queue = queue.Queue()
+        for repo_spec in repos:
+            repos_queue.put(repo_spec)
+        cloned_queue = queue.Queue(maxsize=self.queue_size)
+        records_queue = queue.Queue(maxsize=self.queue_size)
+
+        clone_threads = [threading.Thread(target=self._clone_worker, args=(repos_queue, cloned_queue), daemon=True)
+                         for _ in range(min(self.clone_workers, len(repos)) or 1)]
+        for thread in clone_threads:
+            thread.start()
+        parse_thread = threading.Thread(target=self._parse_dispatcher, args=(cloned_queue, records_queue),
+                                        daemon=True)
+        parse_thread.start()
+
+        def close_clone_stage():
+            for thread in clone_threads:
+                thread.join()
+            cloned_queue.put(_DONE)
+
+        threading.Thread(target=close_clone_stage, daemon=True).start()
+
+        self._embed_consumer(records_queue)
+        parse_thread.join()
+        if self.knowledge_base.vectorstore is None:
+            # An empty manifest, or no repository could be cloned and parsed: there is no index to save.
+            print("Nothing indexed: no code items were extracted from the repositories of the manifest.")
+        else:
+            self.knowledge_base.save_index()
+        return self.report()
+
+    def report(self):
+        return {name: stage.to_dict() for name, stage in self.stats.items()}
+
+    def _clone_worker(self, repos_queue, cloned_queue):
+        while True:
+            try:
+                repo_spec = repos_queue.get_nowait()
+            except queue.Empty:
+                return
+            start = time.perf_counter()
+            repo_path = self._clone_or_fetch(repo_spec)
+            self.stats['clone'].record(int(repo_path is not None), time.perf_counter() - start,
+                                       errors=int(repo_path is None))
+            if repo_path is not None:
+                # Blocks while the parse stage is saturated.
+                cloned_queue.put((repo_spec['name'], repo_path))
+
+    def _clone_or_fetch(self, repo_spec):
+        repo_path = os.path.join(self.workdir, repo_spec['name'])
+        if os.path.isdir(os.path.join(repo_path, '.git')):
+            try:
+                git.Repo(repo_path).remote().pull()
+            except Exception as e:
+                print(f"Error occurred while fetching {repo_spec['name']}: {e}")
+            return repo_path
+
+        clone_options = {**DEFAULT_CLONE_OPTIONS, **self.manifest.get('clone_options', {}),
+                         **repo_spec.get('clone_options', {})}
+        repo = clone_repository(repo_spec['url'], repo_path,
+                                mirror_cache_dir=self.manifest.get('mirror_cache_dir'), **clone_options)
+        return repo_path if repo is not None else None
+
+    def _parse_dispatcher(self, cloned_queue, records_queue):
+        max_in_flight = self.parse_workers * 2
+        try:
+            with ProcessPoolExecutor(max_workers=self.parse_workers) as executor:
+                in_flight = set()
+
+                def drain(return_when):
+                    nonlocal in_flight
+                    done, in_flight = wait(in_flight, return_when=return_when)
+                    for future in done:
+                        try:
+                            records, n_files, errors, seconds = future.result()
+                        except Exception as e:
+                            print(f"Error occurred while parsing files: {e}")
+                            self.stats['parse'].record(0, 0.0, errors=1)
+                            continue
+                        self.stats['parse'].record(n_files, seconds, errors=errors)
+                        if records:
+                            # Blocks while the embed stage is saturated.
+                            records_queue.put(records)
+
+                while (item := cloned_queue.get()) is not _DONE:
+                    repo_name, repo_path = item
+                    files = [path for _, path in scan_repository(repo_path, doc_types=())]
+                    for i in range(0, len(files), self.files_per_task):
+                        if len(in_flight) >= max_in_flight:
+                            drain(FIRST_COMPLETED)
+                        in_flight.add(executor.submit(_analyze_files, repo_name, repo_path,
+                                                      files[i:i + self.files_per_task]))
+                if in_flight:
+                    drain(ALL_COMPLETED)
+        finally:
+            records_queue.put(_DONE)
+
+    def _embed_consumer(self, records_queue):
+        batch = []
+        while (records := records_queue.get()) is not _DONE:
+            batch.extend(records)
+            while len(batch) >= self.embed_batch_size:
+                self._embed(batch[:self.embed_batch_size])
+                batch = batch[self.embed_batch_size:]
+        if batch:
+            self._embed(batch)
+
+    def _embed(self, records):
+        start = time.perf_counter()
+        df = pd.DataFrame(records)
+        df = df[df['code'].fillna('').str.strip() != '']
+        if not df.empty:
+            self.knowledge_base.upload_df_to_faiss(df, 'code')
+        self.stats['embed'].record(len(df), time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build one knowledge base index from a manifest of repositories.')
+    parser.add_argument('manifest', help='YAML manifest listing the repositories to index.')
+    parser.add_argument('--clone-workers', type=int, default=8)
+    parser.add_argument('--parse-workers', type=int, default=None)
+    parser.add_argument('--embed-batch-size', type=int, default=256)
+    parser.add_argument('--report', help='Optional path of a JSON file for the throughput report.')
+    parser.add_argument('--profile-dir', help='Optional directory of cProfile files of the pipeline stages.')
+    args = parser.parse_args()
+    if args.profile_dir:
+        instrumentation.enable_profiling(args.profile_dir)
+
+    with open(args.manifest, 'r') as f:
+        manifest = yaml.load(f, Loader=yaml.FullLoader)
+
+    pipeline = IngestionPipeline(manifest, clone_workers=args.clone_workers, parse_workers=args.parse_workers,
+                                 embed_batch_size=args.embed_batch_size)
+    report = pipeline.run()
+    # Stages run in the parse worker processes are not included.
+    report['instrumentation'] = instrumentation.to_dict()
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,17 +5,25 @@ import sys
 PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(PROJECT_PATH)
 
+import bisect
 import contextlib
-import pathlib
+import hashlib
+import json
+import pickle
+import re
 from collections import defaultdict
 
 import git
 import networkx as nx
 import streamlit as st
 
-from legacy_code_assistant.knowledge_base.knowledge_graph.code_extractor import extract_classes_methods
+from legacy_code_assistant.data_extraction.blob_reader import NULL_SHA, GitBlobReader
+from legacy_code_assistant.knowledge_base.knowledge_graph.parse_cache import ParseCache
 
 REPO_PATH = os.path.join(PROJECT_PATH, 'tests', 'test_repo')
+PARSE_CACHE_DIR = os.path.join(PROJECT_PATH, '.cache', 'parse')
+GRAPH_STATE_PATH = os.path.join(PROJECT_PATH, '.cache', 'commit_graph.pkl')
+GRAPH_STATE_VERSION = 2
 
 print(PROJECT_PATH, REPO_PATH)
 # Constants
@@ -25,32 +33,38 @@ NODE_TYPE_CLASS = "class"
 NODE_TYPE_METHOD = "method"
 EDGE_TYPE_MODIFIED = "modifies"
 EDGE_TYPE_CONTAINS = "contains"
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@')
 
 
 class RepoAnalyzer:
-    def __init__(self, repo_path):
+    def __init__(self, repo_path, parse_cache=None):
         self.repo = git.Repo(repo_path)
         self.graph = nx.DiGraph()
+        self.parse_cache = parse_cache if parse_cache is not None else ParseCache()
+        self.blob_reader = GitBlobReader(repo_path)
 
-    def get_repo_commits(self):
+    def get_repo_commits(self, rev=None):
         return [
             {'commit_id': commit.hexsha, 'author': commit.author.name, 'date': commit.committed_datetime.isoformat(),
              'message': commit.message.strip(), 'files': list(commit.stats.files.keys())} for commit in
-            self.repo.iter_commits()]
+            self.repo.iter_commits(rev)]
 
     def get_repo_files_metadata(self):
         files_metadata = defaultdict(dict)
-        for file in self.repo.tree().traverse():
-            if file.type == 'blob':
-                with contextlib.suppress(Exception):
-                    content = pathlib.Path(file.abspath).read_text()
-                    classes, methods = extract_classes_methods(content)
-                    files_metadata[file.path]['classes'] = list(classes.keys())
-                    files_metadata[file.path]['methods'] = [m[1] if isinstance(m, tuple) else m for m in methods.keys()]
+        blobs = [item for item in self.repo.tree().traverse() if item.type == 'blob' and item.path.endswith('.py')]
+        contents = self.blob_reader.read_many(blob.hexsha for blob in blobs)
+        for file in blobs:
+            with contextlib.suppress(Exception):
+                content = contents[file.hexsha].decode('utf-8')
+                classes, methods = self.parse_cache.extract_classes_methods(content, file_path=file.path,
+                                                                            blob_sha=file.hexsha)
+                files_metadata[file.path]['classes'] = list(classes.keys())
+                files_metadata[file.path]['methods'] = [m[1] if isinstance(m, tuple) else m for m in methods.keys()]
         return files_metadata
 
-    def build_commit_dependency_graph(self, commits_data, files_metadata):
-        class_modification_counts = defaultdict(int)
+    def build_commit_dependency_graph(self, commits_data, files_metadata, class_modification_counts=None):
+        if class_modification_counts is None:
+            class_modification_counts = defaultdict(int)
         for commit in commits_data:
             commit_node = commit['commit_id']
             self.graph.add_node(commit_node, type=NODE_TYPE_COMMIT, author=commit['author'], date=commit['date'],
@@ -72,6 +86,74 @@ class RepoAnalyzer:
                         self.graph.add_edge(class_node, method_node, type=EDGE_TYPE_CONTAINS)
         return self.graph, class_modification_counts
 
+    def update_commit_dependency_graph(self, state_path, files_metadata):
+        """
+        Loads the graph persisted at ``state_path`` and extends it with the commits made since it was saved.
+
+        Only ``last..HEAD`` is processed when the saved commit is still an ancestor of HEAD. After a force-push
+        or rebase, when the classes or methods of a file already in the graph changed, or when there is no usable
+        state, the graph is rebuilt from the full history.
+        """
+        head = self.repo.head.commit.hexsha
+        fingerprints = self._metadata_fingerprints(files_metadata)
+        state = self._load_graph_state(state_path)
+        if state is not None and self._metadata_changed(state, fingerprints):
+            # The nodes of earlier commits were built from the previous classes and methods of these files.
+            state = None
+
+        if state is not None and state['head'] == head:
+            self.graph = state['graph']
+            return self.graph, state['class_modification_counts']
+
+        if state is not None and self._is_ancestor_of_head(state['head']):
+            self.graph = state['graph']
+            class_modification_counts = state['class_modification_counts']
+            commits = self.get_repo_commits(f"{state['head']}..{head}")
+        else:
+            self.graph = nx.DiGraph()
+            class_modification_counts = None
+            commits = self.get_repo_commits()
+
+        graph, class_modification_counts = self.build_commit_dependency_graph(
+            commits, files_metadata, class_modification_counts)
+        self._save_graph_state(state_path, head, class_modification_counts, fingerprints)
+        return graph, class_modification_counts
+
+    @staticmethod
+    def _metadata_fingerprints(files_metadata):
+        return {path: hashlib.sha256(json.dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+                for path, metadata in files_metadata.items()}
+
+    @staticmethod
+    def _metadata_changed(state, fingerprints):
+        saved = state['files_metadata']
+        changed = {path for path in saved.keys() | fingerprints.keys() if saved.get(path) != fingerprints.get(path)}
+        return any(f"file_{path}" in state['graph'] for path in changed)
+
+    def _is_ancestor_of_head(self, commit_sha):
+        try:
+            return self.repo.is_ancestor(commit_sha, self.repo.head.commit)
+        except (git.GitCommandError, ValueError):
+            # The commit no longer exists, e.g. it was garbage collected after a force-push.
+            return False
+
+    def _load_graph_state(self, state_path):
+        with contextlib.suppress(OSError, pickle.UnpicklingError, EOFError):
+            with open(state_path, 'rb') as f:
+                state = pickle.load(f)
+            if state.get('version') == GRAPH_STATE_VERSION and state.get('repo') == self.repo.working_dir:
+                return state
+        return None
+
+    def _save_graph_state(self, state_path, head, class_modification_counts, fingerprints):
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        state = {'version': GRAPH_STATE_VERSION, 'repo': self.repo.working_dir, 'head': head, 'graph': self.graph,
+                 'class_modification_counts': class_modification_counts, 'files_metadata': fingerprints}
+        tmp_path = f'{state_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, state_path)
+
     @staticmethod
     def query_commit_dependency_graph(graph, commit_id):
         return list(nx.descendants(graph, commit_id))
@@ -82,6 +164,8 @@ class RepoAnalyzer:
             # Using the diff to find changes in the commit
             parent = commit.parents[0] if commit.parents else EMPTY_TREE_SHA
             diffs = {diff.a_path: diff for diff in commit.diff(parent)}
+            self.blob_reader.prefetch(blob.hexsha for diff in diffs.values() if diff.a_path.endswith('.py')
+                                      for blob in (diff.a_blob, diff.b_blob) if blob is not None)
 
             for diff in diffs.values():
                 if diff.change_type in ['A', 'M']:
@@ -95,22 +179,68 @@ class RepoAnalyzer:
     def extract_methods_from_diff(self, diff):
         method_changes = defaultdict(str)
         if diff.a_path.endswith(".py"):
-            a_blob = diff.a_blob.data_stream.read().decode('utf-8') if diff.a_blob else ''
-            b_blob = diff.b_blob.data_stream.read().decode('utf-8') if diff.b_blob else ''
+            a_blob = self._read_blob(diff.a_blob)
+            b_blob = self._read_blob(diff.b_blob)
 
-            diff_lines = list(difflib.unified_diff(a_blob.splitlines(), b_blob.splitlines()))
+            a_spans = self._function_spans(a_blob, diff.a_blob.hexsha if diff.a_blob else None)
+            b_spans = self._function_spans(b_blob, diff.b_blob.hexsha if diff.b_blob else None)
+            diff_lines = list(difflib.unified_diff(a_blob.splitlines(), b_blob.splitlines(), lineterm=''))
 
             current_method = None
-            for line in diff_lines:
-                if line.startswith('@@'):
+            a_line = b_line = 0
+            for line in diff_lines[2:]:
+                hunk = HUNK_HEADER.match(line)
+                if hunk:
                     current_method = None
-                elif line.startswith('+') or line.startswith('-'):
-                    if 'def ' in line:
-                        current_method = line.split('def ')[1].split('(')[0].strip()
-                    if current_method:
-                        method_changes[current_method] += line + '\n'
+                    a_line, b_line = int(hunk.group(1)), int(hunk.group(2))
+                    continue
+                if line.startswith('+'):
+                    spans, line_number = b_spans, b_line
+                    b_line += 1
+                elif line.startswith('-'):
+                    spans, line_number = a_spans, a_line
+                    a_line += 1
+                else:
+                    a_line += 1
+                    b_line += 1
+                    continue
+
+                if spans is not None:
+                    current_method = self._enclosing_function(spans, line_number)
+                elif 'def ' in line:
+                    current_method = line.split('def ')[1].split('(')[0].strip()
+                if current_method:
+                    method_changes[current_method] += line + '\n'
         return method_changes
 
+    def _read_blob(self, blob):
+        if blob is None:
+            return ''
+        if blob.hexsha == NULL_SHA:
+            # Working-tree side of a diff, not stored in the object database.
+            return blob.data_stream.read().decode('utf-8')
+        return self.blob_reader.read_text(blob.hexsha)
+
+    def _function_spans(self, content, blob_sha):
+        """Return (start, end, name) line spans of all functions in a blob, or None if it does not parse."""
+        if not content:
+            return []
+        if blob_sha == NULL_SHA:
+            blob_sha = None
+        try:
+            classes, functions = self.parse_cache.extract_classes_methods(content, blob_sha=blob_sha)
+        except (SyntaxError, ValueError):
+            return None
+        items = list(functions.values()) + [f for cls in classes.values() for f in cls.functions.values()]
+        return sorted((f.lineno, f.end_lineno, f.name) for f in items if f.lineno is not None)
+
+    @staticmethod
+    def _enclosing_function(spans, line_number):
+        """Return the innermost function whose span contains the given line."""
+        for start, end, name in reversed(spans[:bisect.bisect_right(spans, (line_number, float('inf'), ''))]):
+            if start <= line_number <= end:
+                return name
+        return None
 
 def visualize_function_evolution(function_modifications):
     st.title("Function Evolution Over Time")
@@ -140,19 +270,24 @@ def visualize_modifications():
     st.code(selected_modification['changes'], language='python')
 
 
+@st.cache_resource
+def get_parse_cache():
+    return ParseCache(PARSE_CACHE_DIR)
+
+
 def main():
     repo_path = REPO_PATH
     print(repo_path)
-    analyzer = RepoAnalyzer(repo_path)
+    analyzer = RepoAnalyzer(repo_path, parse_cache=get_parse_cache())
 
-    if 'commits' not in st.session_state:
-        st.session_state.commits = analyzer.get_repo_commits()
     if 'files_metadata' not in st.session_state:
         st.session_state.files_metadata = analyzer.get_repo_files_metadata()
     if 'function_modifications' not in st.session_state:
         st.session_state.function_modifications = analyzer.get_function_modifications()
 
-    _, _ = analyzer.build_commit_dependency_graph(st.session_state.commits, st.session_state.files_metadata)
+    if 'commit_graph' not in st.session_state:
+        st.session_state.commit_graph, _ = analyzer.update_commit_dependency_graph(
+            GRAPH_STATE_PATH, st.session_state.files_metadata)
 
     visualize_function_evolution(st.session_state.function_modifications)
 
@@ -13,7 +13,9 @@ import streamlit as st
 from streamlit_agraph import agraph, Config, Edge, Node
 
 from legacy_code_assistant.knowledge_base.knowledge_graph.code_graph import CodeUsageGraphBuilder
-from legacy_code_assistant.rag_integration.rag_manager import RagManager
+from legacy_code_assistant.knowledge_base.knowledge_graph.parse_cache import ParseCache
+from legacy_code_assistant.rag_integration import rag_service
+from legacy_code_assistant.rag_integration.prompt_registry import default_registry
 
 if 'AZURE_OPENAI_ENDPOINT' in st.secrets:
     # credentials are given through streamlit.secters
@@ -35,10 +37,11 @@ class CodeGraphAnalyzer:
     SMALL, MEDIUM, LARGE = 2, 10, 15
     SIZE_THRESHOLDS = (100, 200)
 
-    def __init__(self, repo_path):
+    def __init__(self, repo_path, parse_cache=None):
         self.repo_path = repo_path
         self.graph = nx.DiGraph()
         self.module_node_counts = defaultdict(int)
+        self.parse_cache = parse_cache
 
     def analyze_repository(self):
         """Walk through the repository and analyze Python files."""
@@ -50,7 +53,7 @@ class CodeGraphAnalyzer:
     def _analyze_file(self, file_path):
         with open(file_path, 'r') as file:
             content = file.read()
-        graph_builder = CodeUsageGraphBuilder(content, file_path=file_path)
+        graph_builder = CodeUsageGraphBuilder(content, file_path=file_path, parse_cache=self.parse_cache)
         graph_builder.analyze_file()
         self._merge_into_main_graph(graph_builder.graph, self._determine_node_size(len(content)))
         self._update_module_node_count(file_path, len(graph_builder.graph.nodes))
@@ -112,6 +115,30 @@ class CodeGraphAnalyzer:
         return self.graph.nodes(data=True)
 
 
+# Templates offered for a class or function; their titles come from the template registry.
+NODE_TEMPLATES = ('modify', 'test', 'vulnerability', 'analyze', 'refactor')
+
+
+def prompt_options():
+    registry = default_registry()
+    return [registry.get(name).title for name in NODE_TEMPLATES] + ['Find Similar Code']
+
+
+def get_rag_manager():
+    """The RAG service given by RAG_SERVICE_URL, otherwise the RagManager shared by all sessions of the app."""
+    if os.environ.get('RAG_SERVICE_URL'):
+        return rag_service.RagClient(os.environ['RAG_SERVICE_URL'])
+    return rag_service.get_rag_manager('credentials.yaml',
+                                       {'code': 'code_based_index', 'docstring': 'docstring_based_index'},
+                                       'credentials.yaml')
+
+
+@st.cache_resource
+def get_parse_cache():
+    """Parse cache shared by all sessions of the app."""
+    return ParseCache(os.path.join(PROJECT_PATH, '.cache', 'parse'))
+
+
 def get_project_path():
     """Utility function to determine the project path."""
     # return os.path.abspath(osos.path.dirname(__file__))
@@ -124,7 +151,7 @@ def main():
     repo_path = st.sidebar.text_input("Repository Path", os.path.join(project_path, 'tests', 'test_repo', 'Django-School-Management-System-master_unzipped'))
 
     if 'graph_analyzer' not in st.session_state:
-        st.session_state['graph_analyzer'] = CodeGraphAnalyzer(repo_path)
+        st.session_state['graph_analyzer'] = CodeGraphAnalyzer(repo_path, parse_cache=get_parse_cache())
         st.session_state['graph_analyzer'].analyze_repository()
 
     top_modules = st.session_state['graph_analyzer'].get_top_modules(5)
@@ -173,7 +200,8 @@ def display_node_details(graph_analyzer, module_name, top_k=10):
                 file_content = file.read()
 
             if file_content.strip():
-                graph_builder = CodeUsageGraphBuilder(file_content, file_path=node_data['file_path'])
+                graph_builder = CodeUsageGraphBuilder(file_content, file_path=node_data['file_path'],
+                                                      parse_cache=graph_analyzer.parse_cache)
                 graph_builder.analyze_file()
                 display_class_function_details(graph_builder, node_id)
                 st.markdown(f"**File Path**: [`{node_data.get('file_path', '')}`]({node_data.get('file_path', '')})")
@@ -214,9 +242,7 @@ def display_class_function_details(graph_builder, node_id):
                 st.session_state['expanded_classes'][class_name + str(node_id)] = True
 
                 st.markdown(f"#### LLM Prompts")
-                selected_prompt = st.selectbox("Select a prompt template:",
-                                                ["Modify", "Write Tests", "Search for Vulnerabilities",
-                                                 'Explain', 'Refactor'],
+                selected_prompt = st.selectbox("Select a prompt template:", prompt_options(),
                                                 key=f'prompt_select_{node_id}')
                 additional_info = st.text_area("Additional information:", key=f'additional_info_{node_id}')
 
@@ -238,14 +264,12 @@ def display_class_function_details(graph_builder, node_id):
                 st.session_state['expanded_functions'][func_name + str(node_id)] = True
 
                 st.markdown(f"#### LLM Prompts")
-                selected_prompt = st.selectbox("Select a prompt template:",
-                                                ["Modify", "Write Tests", "Search for Vulnerabilities",
-                                                 'Explain', 'Refactor'],
+                selected_prompt = st.selectbox("Select a prompt template:", prompt_options(),
                                                 key=f'prompt_select_{node_id}')
                 additional_info = st.text_area("Additional information:", key=f'additional_info_{node_id}')
 
                 if st.button("Submit to LLM", key=f'submit_llm_{node_id}'):
-                    process_prompt(selected_prompt, additional_info, node_id, class_info.source_code)
+                    process_prompt(selected_prompt, additional_info, node_id, func_info.source_code)
         st.text(f"Docstring: {func_info.docstring}")
         st.markdown("```python\n" + func_info.source_code + "\n```")
 
@@ -257,25 +281,33 @@ def process_prompt(prompt_template, additional_info, node_id, source_code=None):
     st.write(
         f"Processing {prompt_template} with {additional_info} for node {node_id}")  # Here you would integrate your RAG model processing logic
 
-    manager = RagManager('credentials.yaml', 'docstring_based_index', 'credentials.yaml')
-    if prompt_template == 'Modify': # modifyPrompt - context provided
+    manager = get_rag_manager()
+    # Retrieval is scoped to the files of the selected module.
+    selected_module = st.session_state.get('selected_module')
+    filters = {'file_contains': selected_module} if selected_module else None
+    if prompt_template == 'Find Similar Code': # no LLM call - the stored vector of the node is reused
+        for doc, score in manager.find_similar_code(source_code):
+            st.markdown(f"**{doc.metadata.get('name', '')}** (`{doc.metadata.get('file', '')}`), score {score:.3f}")
+            st.markdown("```python\n" + doc.page_content + "\n```")
+        return
+    elif prompt_template == 'Modify': # modifyPrompt - context provided
         print(additional_info)
         print('-'*50)
         print(source_code)
         
         result = manager.modify_code(additional_info, context=source_code)
     elif prompt_template == 'Analyze': # analyzePrompt - retrieve context
-        result = manager.analyze_code(additional_info)
+        result = manager.analyze_code(additional_info, filters=filters)
     elif prompt_template == 'Add Code': # addPrompt - retrieve context
-        result = manager.add_code(additional_info)
+        result = manager.add_code(additional_info, filters=filters)
     elif prompt_template == 'Write Tests': # testPrompt - context provided
         result = manager.write_tests(additional_info, context=source_code)
     elif prompt_template == 'Search for Vulnerabilities': # vulnerabilityPrompt - context provided
         result = manager.search_for_vulnerabilities(additional_info, context=source_code)
     elif prompt_template == 'Ask Question': 
         raise NotImplementedError
-    elif prompt_template == 'Refactor':
-        raise NotImplementedError
+    elif prompt_template == 'Refactor': # refactorPrompt - context provided
+        result = manager.refactor_code(additional_info, context=source_code)
     else:
         raise ValueError(f"Invalid prompt template: {prompt_template}")
 
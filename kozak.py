@@ -1,26 +1,14 @@
 from pathlib import Path
-import yaml
-import os
-import pandas as pd
 import sys
 # from legacy_code_assistant.knowledge_base.description_generator import CodeConditionedGenerator
-from legacy_code_assistant.knowledge_base.knowledge_builder import KnowledgeBaseBuilder
 # from legacy_code_assistant.knowledge_base.knowledge_builder import CodeAnalyzer
-from langchain.embeddings import AzureOpenAIEmbeddings
+from legacy_code_assistant.rag_integration.prompt_registry import default_registry
+from legacy_code_assistant.rag_integration.rag_service import get_rag_manager
 
-from prompts import modifyPrompt, analyzePrompt, addPrompt, testPrompt, vulnerabilityPrompt
-
-from langchain.chat_models import AzureChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.prompts import ChatPromptTemplate
 from langchain.schema.output_parser import StrOutputParser
-from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
-from langchain.vectorstores import FAISS
+from langchain.schema.runnable import RunnablePassthrough
 
-with open('notebooks/credentials.yaml', "r") as f:
-    credentials = yaml.load(f, Loader=yaml.FullLoader)
-os.environ["AZURE_OPENAI_ENDPOINT"] = credentials['AZURE_OPENAI_ENDPOINT']
-os.environ["AZURE_OPENAI_API_KEY"] = credentials['AZURE_OPENAI_API_KEY']
+CREDENTIALS_PATH = 'notebooks/credentials.yaml'
 
 
 #   def getFunctionsDataFrame():
@@ -38,24 +26,16 @@ def format_docs(docs):
 
 class pipeProcess:
     def __init__(self, filepath, index_name):
-        self.model = AzureChatOpenAI(
-            openai_api_version="2023-05-15",
-            azure_deployment=credentials['Deployment_completion'],
-        )
-        self.embeddings = AzureOpenAIEmbeddings(
-            azure_deployment=credentials['Deployment_embeddings'],
-            openai_api_version="2023-05-15",
-        )
-        self.df = pd.read_csv(filepath)
-
-
-        self.kbb_docs = KnowledgeBaseBuilder(index_name=index_name, model=self.embeddings)
-        self.kbb_docs.load_index()
-        self.retriever = self.kbb_docs.get_retriever()
-
+        # The clients and the loaded index are shared with every other user of the same index in this process.
+        self.manager = get_rag_manager(filepath, index_name, CREDENTIALS_PATH)
+        self.model = self.manager.model
+        self.embeddings = self.manager.embeddings
+        self.kbb_docs = self.manager.kbb_docs
+        self.retriever = self.manager.retriever
+        self.prompts = default_registry()
 
     def _build_chain(self, template):
-        prompt = ChatPromptTemplate.from_template(template)
+        prompt = self.prompts.chat_prompt(template)
 
         chain = (
             {"context": self.retriever | format_docs,
@@ -71,7 +51,7 @@ class pipeProcess:
         user_input = input()
 
         # print("znalazlem",self.kbb_docs.search(user_input),)
-        template = analyzePrompt
+        template = 'analyze'
 
         chain = self._build_chain(template)
         result = chain.invoke(user_input)
@@ -83,7 +63,7 @@ class pipeProcess:
         user_input = input()
 
         # print(self.kbb_docs.search(user_input))
-        template = addPrompt
+        template = 'add'
 
         chain = self._build_chain(template)
         result = chain.invoke(user_input)
@@ -94,7 +74,7 @@ class pipeProcess:
         print("Wchodzę w pipe modyfikacji, Wpisz swój prompt do chatu")
         user_input = input()
         # print("retriever",self.retriever,"||",self.kbb_docs.search(user_input))
-        template = modifyPrompt
+        template = 'modify'
         chain = self._build_chain(template)
         result = chain.invoke(user_input)
         print(result)
@@ -103,7 +83,7 @@ class pipeProcess:
     def testPipe(self):
         print("Wchodzę w pipe pisanie testów, Wpisz swój prompt do chatu")
         user_input = input()
-        template = testPrompt
+        template = 'test'
         chain = self._build_chain(template)
         result = chain.invoke(user_input)
         print(result)
@@ -112,7 +92,7 @@ class pipeProcess:
     def vulPipe(self):
         print("Wchodzę w pipe sprawdzanie podatności, Wpisz swój prompt do chatu")
         user_input = input()
-        template = vulnerabilityPrompt
+        template = 'vulnerability'
         chain = self._build_chain(template)
         result = chain.invoke(user_input)
         print(result)
@@ -121,11 +101,7 @@ class pipeProcess:
     def otherPipe(self):
         print("Wchodzę w pipe inne, Wpisz swój prompt do chatu")
         user_input = input()
-        template = """Answer the question based only on the following context:
-        {context}
-
-        Question: {question}
-        """
+        template = 'other'
         chain = self._build_chain(template)
         result = chain.invoke(user_input)
         print(result)
@@ -0,0 +1,150 @@
+import subprocess
+import threading
+from collections import OrderedDict
+
+NULL_SHA = '0' * 40
+
+
+class GitBlobReader:
+    """
+    Reads git objects through a single long-lived ``git cat-file --batch`` process.
+
+    Requests are pipelined, so reading many blobs costs one round trip instead of one process or file open
+    per object. Blobs read ahead of time with ``prefetch`` are kept in a bounded LRU cache.
+
+    Attributes
+    ----------
+    repo_path : str
+        path to the repository (working tree or bare)
+    max_cache_bytes : int
+        upper bound on the total size of cached blob contents
+    """
+
+    def __init__(self, repo_path, max_cache_bytes=256 * 1024 * 1024):
+        self.repo_path = repo_path
+        self.max_cache_bytes = max_cache_bytes
+        self._process = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Terminate the ``cat-file`` process."""
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                self._process.wait()
+                self._process.stdout.close()
+                self._process = None
+
+    def read(self, sha):
+        """
+        Reads a single object.
+
+        :param sha: Hex SHA of the object.
+        :return: Object content as bytes, or None if the object does not exist.
+        """
+        return self.read_many([sha])[sha]
+
+    def read_text(self, sha, encoding='utf-8'):
+        """Reads a blob and decodes it, returning an empty string for missing objects."""
+        data = self.read(sha)
+        return data.decode(encoding) if data is not None else ''
+
+    def read_many(self, shas):
+        """
+        Reads many objects in one pipelined batch.
+
+        :param shas: Iterable of hex SHAs.
+        :return: Dictionary mapping each SHA to its content, or None for missing objects.
+        """
+        results = {}
+        pending = []
+        with self._lock:
+            for sha in dict.fromkeys(shas):
+                if sha in self._cache:
+                    self._cache.move_to_end(sha)
+                    results[sha] = self._cache[sha]
+                else:
+                    pending.append(sha)
+            if pending:
+                results.update(self._fetch(pending))
+        return results
+
+    def prefetch(self, shas):
+        """Reads the given objects ahead of time and keeps them in the cache."""
+        with self._lock:
+            pending = [sha for sha in dict.fromkeys(shas) if sha not in self._cache and sha != NULL_SHA]
+            for sha, data in self._fetch(pending).items():
+                if data is not None:
+                    self._remember(sha, data)
+
+    def commit_range_blobs(self, rev_range='HEAD', paths=None):
+        """
+        Lists the blobs changed by the commits in a range.
+
+        :param rev_range: Revision range understood by ``git log``, e.g. ``'abc123..HEAD'``.
+        :param paths: Optional pathspecs restricting the listed files, e.g. ``['*.py']``.
+        :return: List of blob SHAs on both sides of every change, without duplicates.
+        """
+        command = ['git', 'log', '--raw', '--no-abbrev', '--no-renames', '--format=', rev_range]
+        if paths:
+            command += ['--', *paths]
+        output = subprocess.run(command, cwd=self.repo_path, capture_output=True, text=True, check=True).stdout
+
+        blobs = {}
+        for line in output.splitlines():
+            if not line.startswith(':'):
+                continue
+            _, _, old_sha, new_sha, _ = line[1:].split('\t')[0].split(' ')
+            for sha in (old_sha, new_sha):
+                if sha != NULL_SHA:
+                    blobs[sha] = None
+        return list(blobs)
+
+    def prefetch_commit_range(self, rev_range='HEAD', paths=None):
+        """Prefetches every blob touched by the commits in ``rev_range``."""
+        self.prefetch(self.commit_range_blobs(rev_range, paths))
+
+    def _ensure_process(self):
+        if self._process is None:
+            self._process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.repo_path,
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return self._process
+
+    def _fetch(self, shas):
+        if not shas:
+            return {}
+        process = self._ensure_process()
+
+        # Requests are written from a separate thread so a large batch cannot deadlock on a full stdout pipe.
+        def write_requests():
+            process.stdin.write(b''.join(f'{sha}\n'.encode('ascii') for sha in shas))
+            process.stdin.flush()
+
+        writer = threading.Thread(target=write_requests, daemon=True)
+        writer.start()
+        results = {}
+        for sha in shas:
+            header = process.stdout.readline().split()
+            if len(header) < 3 or header[-1] == b'missing':
+                results[sha] = None
+                continue
+            size = int(header[2])
+            results[sha] = process.stdout.read(size)
+            process.stdout.read(1)
+        writer.join()
+        return results
+
+    def _remember(self, sha, data):
+        self._cache[sha] = data
+        self._cache_bytes += len(data)
+        while self._cache_bytes > self.max_cache_bytes and self._cache:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
@@ -1,7 +1,17 @@
 import os
+import re
+import subprocess
 
 import git
 
+from legacy_code_assistant.utils.instrumentation import instrumentation
+
+DEFAULT_EXCLUDED_DIRS = frozenset({
+    '.git', '.hg', '.svn', 'node_modules', '.venv', 'venv', '__pycache__', '.tox', '.nox', '.mypy_cache',
+    '.pytest_cache', '.ruff_cache', '.eggs', 'build', 'dist', 'site-packages',
+})
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+
 
 def extract_code_files(repo_path, file_types=('.py',)):
     """
@@ -31,6 +41,157 @@ def extract_documentation(repo_path, doc_types=('.md', '.txt')):
     return doc_files
 
 
+def extract_code_and_documentation(repo_path, file_types=('.py',), doc_types=('.md', '.txt'), **scan_options):
+    """
+    Extracts code and documentation files from the repository in a single traversal.
+
+    :param repo_path: Path to the cloned repository.
+    :param file_types: Tuple of file extensions to consider as code files.
+    :param doc_types: Tuple of file extensions to consider as documentation.
+    :param scan_options: Additional keyword arguments of ``scan_repository``.
+    :return: Tuple of (code files, documentation files).
+    """
+    files = {'code': [], 'doc': []}
+    with instrumentation.timed('file_walk'):
+        for kind, path in scan_repository(repo_path, file_types, doc_types, **scan_options):
+            files[kind].append(path)
+    return files['code'], files['doc']
+
+
+def scan_repository(repo_path, file_types=('.py',), doc_types=('.md', '.txt'), max_file_size=DEFAULT_MAX_FILE_SIZE,
+                    excluded_dirs=DEFAULT_EXCLUDED_DIRS, use_gitignore=True):
+    """
+    Lazily yields the code and documentation files of the repository.
+
+    Directories named in ``excluded_dirs`` are pruned without being read. With ``use_gitignore`` the file list
+    comes from ``git ls-files`` when ``repo_path`` is a git repository, otherwise ``.gitignore`` files are
+    honoured while scanning the tree with ``os.scandir``.
+
+    :param repo_path: Path to the cloned repository.
+    :param file_types: Tuple of file extensions to consider as code files.
+    :param doc_types: Tuple of file extensions to consider as documentation.
+    :param max_file_size: Files larger than this many bytes are skipped; None disables the limit.
+    :param excluded_dirs: Names of directories that are never entered.
+    :param use_gitignore: Whether ignored files should be skipped.
+    :return: Generator of (kind, path) tuples, where kind is 'code' or 'doc'.
+    """
+    paths = _git_listed_files(repo_path, excluded_dirs) if use_gitignore else None
+    if paths is None:
+        paths = _scan_tree(repo_path, excluded_dirs, use_gitignore)
+
+    for path, size in paths:
+        if path.endswith(file_types):
+            kind = 'code'
+        elif path.endswith(doc_types):
+            kind = 'doc'
+        else:
+            continue
+        if max_file_size is not None:
+            if size is None:
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    continue
+            if size > max_file_size:
+                continue
+        instrumentation.count('files_found', kind=kind)
+        yield kind, path
+
+
+def _git_listed_files(repo_path, excluded_dirs):
+    try:
+        output = subprocess.run(['git', 'ls-files', '--cached', '--others', '--exclude-standard', '-z'],
+                                cwd=repo_path, capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    def listed_files():
+        for relative_path in output.decode('utf-8', errors='surrogateescape').split('\0'):
+            if relative_path and not excluded_dirs.intersection(relative_path.split('/')[:-1]):
+                yield os.path.join(repo_path, *relative_path.split('/')), None
+
+    return listed_files()
+
+
+def _scan_tree(repo_path, excluded_dirs, use_gitignore):
+    stack = [(repo_path, '', [])]
+    while stack:
+        directory, relative_dir, rules = stack.pop()
+        if use_gitignore:
+            rules = rules + _read_gitignore(os.path.join(directory, '.gitignore'), relative_dir)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            relative_path = f'{relative_dir}{entry.name}'
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_dir:
+                    if entry.name in excluded_dirs or _is_ignored(rules, relative_path, True):
+                        continue
+                    stack.append((entry.path, f'{relative_path}/', rules))
+                elif entry.is_file() and not _is_ignored(rules, relative_path, False):
+                    yield entry.path, entry.stat().st_size
+            except OSError:
+                continue
+
+
+def _read_gitignore(path, relative_dir):
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    rules = []
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        anchored = '/' in line
+        pattern = _gitignore_pattern_to_regex(line.lstrip('/'))
+        prefix = re.escape(relative_dir) if anchored else f'{re.escape(relative_dir)}(?:.*/)?'
+        rules.append((re.compile(f'{prefix}{pattern}$'), negate, dir_only))
+    return rules
+
+
+def _gitignore_pattern_to_regex(pattern):
+    regex, i = '', 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex, i = regex + '(?:.*/)?', i + 3
+        elif pattern.startswith('**', i):
+            regex, i = regex + '.*', i + 2
+        elif pattern[i] == '*':
+            regex, i = regex + '[^/]*', i + 1
+        elif pattern[i] == '?':
+            regex, i = regex + '[^/]', i + 1
+        elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            # Only a leading ``!`` negates the class; elsewhere it is a literal character.
+            members = pattern[i + 1:end]
+            if members.startswith('!'):
+                members = '^' + members[1:]
+            regex, i = regex + '[' + members + ']', end + 1
+        else:
+            regex, i = regex + re.escape(pattern[i]), i + 1
+    return regex
+
+
+def _is_ignored(rules, relative_path, is_dir):
+    ignored = False
+    for regex, negate, dir_only in rules:
+        if (is_dir or not dir_only) and regex.match(relative_path):
+            ignored = not negate
+    return ignored
+
+
 def extract_commit_history(repo_path):
     """
     Extracts the commit history from the repository.
@@ -39,13 +200,114 @@ def extract_commit_history(repo_path):
     :return: List of dictionaries containing commit information.
     """
     try:
-        repo = git.Repo(repo_path)
-        commits = []
-        for commit in repo.iter_commits():
-            commit_data = {'author': commit.author.name, 'email': commit.author.email, 'date': commit.authored_datetime,
-                           'message': commit.message.strip()}
-            commits.append(commit_data)
-        return commits
+        return list(iter_commit_history(repo_path))
     except Exception as e:
         print(f"Error occurred while extracting commit history: {e}")
         return []
+
+
+def iter_commit_history(repo_path, rev=None, since=None, until=None, paths=None, max_count=None, skip=None):
+    """
+    Lazily yields the commit history of the repository, newest first.
+
+    :param repo_path: Path to the cloned repository.
+    :param rev: Revision or range to walk, defaults to HEAD.
+    :param since: Only commits more recent than this date, e.g. '2023-01-01' or '6 months ago'.
+    :param until: Only commits older than this date.
+    :param paths: Path or list of paths; only commits touching them are yielded.
+    :param max_count: Maximum number of commits to yield.
+    :param skip: Number of commits to skip before yielding.
+    :return: Generator of dictionaries containing commit information.
+    """
+    repo = git.Repo(repo_path)
+    options = {key: value for key, value in
+               {'since': since, 'until': until, 'max_count': max_count, 'skip': skip}.items() if value is not None}
+    for commit in repo.iter_commits(rev, paths=paths or '', **options):
+        yield {'author': commit.author.name, 'email': commit.author.email, 'date': commit.authored_datetime,
+               'message': commit.message.strip()}
+
+
+def iter_commit_pages(repo_path, page_size=1000, cursor=None, rev='HEAD', **filters):
+    """
+    Yields the commit history in pages that can be resumed later.
+
+    The cursor pins the revision the walk started from, so pages stay consistent while new commits arrive.
+
+    :param repo_path: Path to the cloned repository.
+    :param page_size: Number of commits per page.
+    :param cursor: Cursor returned with a previous page; the walk continues after that page.
+    :param rev: Revision to walk when no cursor is given.
+    :param filters: ``since``, ``until``, ``paths`` and ``max_count`` as in ``iter_commit_history``.
+    :return: Generator of (commits, next_cursor) tuples; next_cursor is None after the last page.
+    """
+    if cursor is None:
+        head, offset = git.Repo(repo_path).commit(rev).hexsha, 0
+    else:
+        head, offset = cursor.rsplit(':', 1)
+        offset = int(offset)
+
+    remaining = filters.pop('max_count', None)
+    while remaining is None or remaining > 0:
+        count = page_size if remaining is None else min(page_size, remaining)
+        commits = list(iter_commit_history(repo_path, rev=head, max_count=count, skip=offset, **filters))
+        offset += len(commits)
+        if remaining is not None:
+            remaining -= len(commits)
+        done = len(commits) < count or remaining == 0
+        yield commits, None if done else f'{head}:{offset}'
+        if done:
+            return
+
+
+def commit_history_to_columns(commits, output_format='numpy'):
+    """
+    Converts commit dictionaries into a columnar structure for vectorized analysis.
+
+    :param commits: Iterable of dictionaries as yielded by ``iter_commit_history``.
+    :param output_format: 'numpy' for a structured array or 'arrow' for a ``pyarrow.Table``.
+    :return: Structured array with 'author', 'email', 'date' (UTC datetime64[s]) and 'message' fields,
+        or a pyarrow Table with dictionary-encoded author and email columns.
+    """
+    import numpy as np
+
+    columns = {'author': [], 'email': [], 'date': [], 'message': []}
+    for commit in commits:
+        columns['author'].append(commit['author'] or '')
+        columns['email'].append(commit['email'] or '')
+        columns['date'].append(int(commit['date'].timestamp()))
+        columns['message'].append(commit['message'])
+
+    if output_format == 'arrow':
+        import pyarrow as pa
+
+        return pa.table({
+            'author': pa.array(columns['author']).dictionary_encode(),
+            'email': pa.array(columns['email']).dictionary_encode(),
+            'date': pa.array(columns['date'], type=pa.timestamp('s', tz='UTC')),
+            'message': pa.array(columns['message'], type=pa.string()),
+        })
+    if output_format != 'numpy':
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+    author_width = max(map(len, columns['author']), default=1) or 1
+    email_width = max(map(len, columns['email']), default=1) or 1
+    dtype = [('author', f'U{author_width}'), ('email', f'U{email_width}'), ('date', 'datetime64[s]'),
+             ('message', object)]
+    array = np.empty(len(columns['date']), dtype=dtype)
+    for name in ('author', 'email', 'message'):
+        array[name] = columns[name]
+    array['date'] = np.array(columns['date'], dtype='int64').astype('datetime64[s]')
+    return array
+
+
+def write_commit_history_parquet(commits, path):
+    """
+    Writes the commit history to a Parquet file.
+
+    :param commits: Iterable of dictionaries as yielded by ``iter_commit_history``.
+    :param path: Destination path of the Parquet file.
+    :return: None
+    """
+    import pyarrow.parquet as pq
+
+    pq.write_table(commit_history_to_columns(commits, output_format='arrow'), path)
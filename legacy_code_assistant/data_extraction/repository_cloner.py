@@ -1,24 +1,96 @@
+import hashlib
+import os
+import pathlib
+
 import git
 
 
-def clone_repository(repo_url, destination_path):
+def clone_repository(repo_url, destination_path, depth=None, shallow_since=None, partial=False, sparse_paths=None,
+                     single_branch=False, branch=None, mirror_cache_dir=None):
     """
     Clones a GitHub repository to a specified local path.
 
+    Without any options a full clone is made. The options can be combined, e.g. ``depth=1, sparse_paths=['*.py']``
+    checks out only the Python files of the latest commit.
+
     :param repo_url: URL of the GitHub repository to clone.
     :param destination_path: Local path where the repository should be cloned.
-    :return: None
+    :param depth: Truncate the history to the given number of commits.
+    :param shallow_since: Truncate the history to commits newer than the given date, e.g. ``'6 months ago'``.
+    :param partial: Make a partial clone (``--filter=blob:none``); blobs are fetched on demand.
+    :param sparse_paths: Glob patterns of the files to check out, e.g. ``['*.py']``.
+    :param single_branch: Fetch only the history of one branch.
+    :param branch: Branch to check out instead of the remote HEAD.
+    :param mirror_cache_dir: Directory of local mirrors; repeated clones of the same URL fetch into the mirror
+        and clone from it instead of the network.
+    :return: The cloned ``git.Repo``, or None if cloning failed.
     """
+    clone_options = {}
+    if depth is not None:
+        clone_options['depth'] = depth
+    if shallow_since is not None:
+        clone_options['shallow_since'] = shallow_since
+    if partial:
+        clone_options['filter'] = 'blob:none'
+    if single_branch:
+        clone_options['single_branch'] = True
+    if branch is not None:
+        clone_options['branch'] = branch
+    if sparse_paths:
+        clone_options['no_checkout'] = True
+
     try:
-        git.Repo.clone_from(repo_url, destination_path)
+        source_url = repo_url
+        if mirror_cache_dir is not None:
+            # Shallow and filtered clones are only honoured over a transport, so the mirror is addressed by URI.
+            source_url = pathlib.Path(update_mirror(repo_url, mirror_cache_dir)).absolute().as_uri()
+
+        repo = git.Repo.clone_from(source_url, destination_path, **clone_options)
+
+        if mirror_cache_dir is not None:
+            repo.remote().set_url(repo_url)
+        if sparse_paths:
+            repo.git.sparse_checkout('set', '--no-cone', *sparse_paths)
+            repo.git.checkout()
         print(f"Repository cloned successfully to {destination_path}")
+        return repo
     except Exception as e:
         print(f"Error occurred while cloning the repository: {e}")
+        return None
 
 
-if __name__ == '__main__':
-    import os
+def get_mirror_path(repo_url, mirror_cache_dir):
+    """
+    Returns the path of the local mirror used for a repository URL.
+
+    :param repo_url: URL of the repository.
+    :param mirror_cache_dir: Directory containing the mirrors.
+    :return: Path of the bare mirror repository.
+    """
+    name = repo_url.rstrip('/').split('/')[-1].removesuffix('.git')
+    url_hash = hashlib.sha1(repo_url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(mirror_cache_dir, f'{name}-{url_hash}.git')
+
+
+def update_mirror(repo_url, mirror_cache_dir):
+    """
+    Creates or refreshes the local bare mirror of a repository.
 
+    :param repo_url: URL of the repository.
+    :param mirror_cache_dir: Directory containing the mirrors.
+    :return: Path of the up-to-date mirror.
+    """
+    mirror_path = get_mirror_path(repo_url, mirror_cache_dir)
+    if os.path.isdir(mirror_path):
+        git.Repo(mirror_path).git.remote('update', '--prune')
+    else:
+        os.makedirs(mirror_cache_dir, exist_ok=True)
+        mirror = git.Repo.clone_from(repo_url, mirror_path, mirror=True)
+        mirror.git.config('uploadpack.allowFilter', 'true')
+    return mirror_path
+
+
+if __name__ == '__main__':
     project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     clone_repository("https://github.com/adigunsherif/Django-School-Management-System.git",
                      rf"{project_path}\tests\test_repo")
@@ -1,17 +1,36 @@
 import yaml
 import os
-from tqdm import tqdm
 import re
 
-import pandas as pd
+from legacy_code_assistant.utils.instrumentation import instrumentation
+from legacy_code_assistant.utils.prompt_layout import (PrefixCacheTracker, chat_prompt,
+                                                        static_prefix)
+from legacy_code_assistant.utils.token_accounting import TokenAccountant, TokenBudgetExceeded
 
-from langchain.chat_models import AzureChatOpenAI
-from langchain.schema import HumanMessage, AIMessage
-from langchain.prompts import ChatMessagePromptTemplate, ChatPromptTemplate, AIMessagePromptTemplate, HumanMessagePromptTemplate
+# The instructions are the same for every code item and come first, so the provider caches them; the type and the
+# code of the item follow in DOCSTRING_TEMPLATE.
+DOCSTRING_INSTRUCTIONS = '''
+Given the code of a function, method or class below your taks is to generate docString describing functions inside.
+Firstly pay attention to all variables that
+are used in the code. Secondly, analyze what is function doing with those variables.
+Based on this, deduce what steps are being taken in this function and what purpose they serve.
+Having all that informations gathered in your mind,
+write a docstring for the function that will describe step by step what is this function doing,
+what's it's purpose and what variables it is affecting.
+Do not write anything other than the docstring, docstring should be the only output.
+Start your answer with ```python\n"""\n and end it with """\n```
+'''
+
+DOCSTRING_TEMPLATE = '''Code of the {type}:
+
+{code}'''
 
 
 class CodeConditionedGenerator:
-    def __init__(self, credentials_path, data_path):
+    def __init__(self, credentials_path, data_path, token_accountant=None):
+        import pandas as pd
+        from langchain.chat_models import AzureChatOpenAI
+
         with open(credentials_path, "r") as f:
             credentials = yaml.load(f, Loader=yaml.FullLoader)
 
@@ -24,33 +43,43 @@ class CodeConditionedGenerator:
         )
 
         self.df = pd.read_csv(data_path)
+        self.token_accountant = token_accountant or TokenAccountant()
+        self.prefix_tracker = PrefixCacheTracker()
 
-    def generate_docstrings(self):
-        prompt = '''
-Given the code of the {type} below your taks is to generate docString describing functions inside.
-Firstly pay attention to all variables that
-are used in the code. Secondly, analyze what is function doing with those variables.
-Based on this, deduce what steps are being taken in this function and what purpose they serve.
-Having all that informations gathered in your mind, 
-write a docstring for the function that will describe step by step what is this function doing, what's it's purpose and what variables it is affecting.
-Do not write anything other than the docstring, docstring should be the only output.
-Start your answer with ```python\n"""\n and end it with """\n```
-\n\n{code}\n\n
-'''
+    def generate_docstrings(self, max_tokens=None, max_cost=None):
+        """
+        Generate a docstring for every code item that is not a module.
 
-        chat_prompt_template = ChatPromptTemplate.from_template(prompt)
+        :param max_tokens: Token budget of the run; the items left when it is spent get no docstring.
+        :param max_cost: Budget of the run in USD, used the same way.
+        :return: The DataFrame with the ``generated_docstring`` column.
+        """
+        from tqdm import tqdm
+
+        chat_prompt_template = chat_prompt(DOCSTRING_INSTRUCTIONS, variables_template=DOCSTRING_TEMPLATE)
 
         mask_docstringable = self.df['type'] != 'module'
         df_docstringable = self.df.loc[mask_docstringable]
-        prompts = [chat_prompt_template.format_prompt(type=example['type'], code=example['code']) for _, example in df_docstringable.iterrows()]
+        prompts = [chat_prompt_template.format_prompt(type=example['type'], code=example['code'])
+                   for _, example in df_docstringable.iterrows()]
 
         docstrings = []
-
-        for prompt in tqdm(prompts):
-            result = self.model(prompt.to_messages()).content
-            result = re.sub('^\n*```\n*(python)\n*(""")?\n*', '', result)
-            result = re.sub('\n*(""")?\n*```\n*$', '', result)
-            docstrings.append(result)
+        self.token_accountant.register_template('docstringPrompt', static_prefix(DOCSTRING_INSTRUCTIONS))
+        with self.token_accountant.job('docstring_generation', max_tokens=max_tokens, max_cost=max_cost):
+            callbacks = [instrumentation.langchain_callback('docstring_generation'),
+                         self.token_accountant.langchain_callback('docstring_generation', 'docstringPrompt'),
+                         self.prefix_tracker.langchain_callback('docstringPrompt')]
+            for prompt in tqdm(prompts):
+                try:
+                    result = self.model(prompt.to_messages(), callbacks=callbacks).content
+                except TokenBudgetExceeded as e:
+                    print(f"{e}; {len(prompts) - len(docstrings)} items are left without a docstring.")
+                    break
+                result = re.sub('^\n*```\n*(python)\n*(""")?\n*', '', result)
+                result = re.sub('\n*(""")?\n*```\n*$', '', result)
+                docstrings.append(result)
+        docstrings += [None] * (len(prompts) - len(docstrings))
+        print(self.token_accountant.format_report())
 
         self.df.loc[mask_docstringable, 'generated_docstring'] = docstrings
         return self.df
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+from langchain.embeddings.base import Embeddings
+
+from legacy_code_assistant.utils.instrumentation import instrumentation
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with an LRU cache of query embeddings.
+
+    Repeated queries, e.g. the same node selected again in the demo, are answered from memory instead of calling
+    the embedding service. Document embeddings are passed through unchanged, they are computed once when the
+    index is built.
+
+    Attributes
+    ----------
+    embeddings : Embeddings
+        the wrapped embedding model
+    max_entries : int
+        number of query embeddings kept in memory
+    hits : int
+        number of queries answered from the cache
+    misses : int
+        number of queries sent to the wrapped model
+    """
+
+    def __init__(self, embeddings, max_entries=1024):
+        self.embeddings = embeddings
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        instrumentation.count('texts_embedded', len(texts))
+        with instrumentation.timed('embed_documents'):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with self._lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                instrumentation.count('query_cache', result='hit')
+                return self._cache[text]
+        with instrumentation.timed('embed_query'):
+            vector = self.embeddings.embed_query(text)
+        self.put(text, vector)
+        with self._lock:
+            self.misses += 1
+        instrumentation.count('query_cache', result='miss')
+        return vector
+
+    def put(self, text, vector):
+        """Store the embedding of a query, e.g. a vector already kept in an index."""
+        with self._lock:
+            self._cache[text] = list(vector)
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def __contains__(self, text):
+        return text in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
@@ -12,3 +12,11 @@ class EmbeddingProcessor:
         with torch.no_grad():
             outputs = self.model(**inputs)
         return outputs.last_hidden_state.mean(dim=1).numpy()
+
+    def encode_batch(self, texts):
+        """Encode a list of texts in one forward pass, mean-pooling over the non-padding tokens."""
+        inputs = self.tokenizer(list(texts), return_tensors="pt", max_length=512, truncation=True, padding=True)
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+        mask = inputs['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+        return ((outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1)).numpy()
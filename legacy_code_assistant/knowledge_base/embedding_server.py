@@ -0,0 +1,392 @@
+"""
+Local embedding service with dynamic micro-batching.
+
+The model is loaded once and shared by forked worker processes (copy-on-write), so indexing workers and the
+demo apps do not each pay the model load time and memory. Concurrent requests are queued for a few milliseconds
+and encoded together in one forward pass.
+
+Usage::
+
+    python -m legacy_code_assistant.knowledge_base.embedding_server --workers 4 --port 8765
+
+and in the clients::
+
+    KnowledgeBaseBuilder(model=EmbeddingClient('http://127.0.0.1:8765'), model_name='microsoft/codebert-base')
+"""
+import argparse
+import gc
+import itertools
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+_NOTHING = object()
+# How often the collecting thread checks that the workers are alive while no result arrives.
+_HEALTH_CHECK_SECONDS = 0.5
+
+
+def _worker_loop(encoder, tasks, results, threads):
+    if threads:
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+    while (task := tasks.get()) is not None:
+        batch_id, texts = task
+        try:
+            results.put((batch_id, np.asarray(encoder.encode_batch(texts), dtype='float32'), None))
+        except Exception as e:
+            results.put((batch_id, None, repr(e)))
+
+
+class EmbeddingServer:
+    """
+    Serves the embeddings of a local model, batching concurrent requests into one forward pass.
+
+    A batch is sent to a worker as soon as ``max_batch_size`` texts are queued or the oldest queued request has
+    waited ``max_wait_ms``. While all workers are busy, requests keep queueing, so batches grow with the load.
+    When a worker dies, the requests of its batch fail and the remaining workers take the following batches.
+
+    Attributes
+    ----------
+    encoder : object
+        the model; any object with ``encode_batch(texts)`` returning one vector per text, e.g. EmbeddingProcessor
+    workers : int
+        number of worker processes forked from this process
+    max_batch_size : int
+        maximal number of texts encoded in one forward pass
+    max_wait_ms : float
+        how long the first request of a batch waits for more requests
+    timeout : float
+        how long ``embed`` waits for the vectors before raising RuntimeError
+    batches : int
+        number of batches encoded so far
+    texts : int
+        number of texts encoded so far
+    """
+
+    def __init__(self, encoder=None, model_name='microsoft/codebert-base', workers=2, max_batch_size=32,
+                 max_wait_ms=5, threads_per_worker=None, host='127.0.0.1', port=8765, timeout=60):
+        if encoder is None:
+            from legacy_code_assistant.knowledge_base.embedding_processor import EmbeddingProcessor
+            encoder = EmbeddingProcessor(model_name)
+        self.encoder = encoder
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.threads_per_worker = threads_per_worker
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.batches = 0
+        self.texts = 0
+
+        self._requests = queue.Queue()
+        # Batches sent to the workers by id, with the index of their worker; every worker has one batch at most.
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._batch_ids = itertools.count()
+        # Indices of the workers waiting for a batch; None once every worker has died.
+        self._idle = queue.Queue()
+        self._dead = set()
+        self._stopping = False
+        self._processes = []
+        self._threads = []
+        self._httpd = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self, serve_http=True):
+        """Fork the workers and start batching; with ``serve_http`` the HTTP endpoint is started as well."""
+        # Workers are forked before any thread is started. Freezing the heap keeps the garbage collector from
+        # touching, and thereby copying, the pages holding the model.
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods()
+                                              else 'spawn')
+        # Every worker has its own task queue, so the batches of a dead worker are known.
+        self._tasks = [context.Queue() for _ in range(self.workers)]
+        self._results = context.Queue()
+        self._dead, self._stopping = set(), False
+        gc.freeze()
+        for worker in range(self.workers):
+            process = context.Process(target=_worker_loop, daemon=True,
+                                      args=(self.encoder, self._tasks[worker], self._results, self.threads_per_worker))
+            process.start()
+            self._processes.append(process)
+            self._idle.put(worker)
+        gc.unfreeze()
+
+        self._threads = [threading.Thread(target=self._batch_loop, daemon=True),
+                         threading.Thread(target=self._collect_loop, daemon=True)]
+        if serve_http:
+            self._httpd = _EmbeddingHTTPServer((self.host, self.port), _EmbeddingRequestHandler)
+            self._httpd.embedding_server = self
+            self.port = self._httpd.server_address[1]
+            self._threads.append(threading.Thread(target=self._httpd.serve_forever, daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop the HTTP endpoint, the batching threads and the workers."""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        batch_thread, collect_thread = self._threads[:2]
+        self._requests.put(None)
+        batch_thread.join()
+        self._stopping = True
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join()
+        self._results.put(None)
+        collect_thread.join()
+        self._processes, self._threads = [], []
+        self._idle = queue.Queue()
+
+    def embed(self, texts):
+        """Embed texts through the batching queue and return one vector per text."""
+        futures = []
+        for i in range(0, len(texts), self.max_batch_size):
+            future = Future()
+            self._requests.put((list(texts[i:i + self.max_batch_size]), future))
+            futures.append(future)
+        deadline = time.monotonic() + self.timeout
+        try:
+            return [vector for future in futures
+                    for vector in future.result(timeout=max(0.0, deadline - time.monotonic()))]
+        except FutureTimeoutError:
+            raise RuntimeError(f"The texts were not embedded within {self.timeout} seconds.")
+
+    def _batch_loop(self):
+        carry = _NOTHING
+        while True:
+            # A free worker is awaited first, so requests arriving meanwhile join the next batch.
+            worker = self._next_worker()
+            if worker is None:
+                self._fail_requests(carry)
+                return
+            first = self._requests.get() if carry is _NOTHING else carry
+            carry = _NOTHING
+            if first is None:
+                return
+            batch = [first]
+            size = len(first[0])
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while size < self.max_batch_size:
+                try:
+                    request = self._requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None or size + len(request[0]) > self.max_batch_size:
+                    carry = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            while not self._dispatch(batch, worker):
+                # The worker died after it was taken from the idle queue; the batch goes to another one.
+                worker = self._next_worker()
+                if worker is None:
+                    for _, future in batch:
+                        future.set_exception(RuntimeError("All embedding workers have died."))
+                    self._fail_requests(carry)
+                    return
+
+    def _next_worker(self):
+        """Take the next idle worker that is still alive, or None once every worker has died."""
+        while True:
+            worker = self._idle.get()
+            if worker is None or (worker not in self._dead and self._processes[worker].exitcode is None):
+                return worker
+
+    def _fail_requests(self, carry):
+        """Fail the queued and all later requests once every worker has died, until the server is stopped."""
+        request = self._requests.get() if carry is _NOTHING else carry
+        while request is not None:
+            request[1].set_exception(RuntimeError("All embedding workers have died."))
+            request = self._requests.get()
+
+    def _dispatch(self, batch, worker):
+        """Send the batch to the worker; False if the worker has already been reaped."""
+        batch_id = next(self._batch_ids)
+        spans, texts = [], []
+        for request_texts, future in batch:
+            spans.append((future, len(texts), len(texts) + len(request_texts)))
+            texts.extend(request_texts)
+        with self._in_flight_lock:
+            if worker in self._dead:
+                return False
+            self._in_flight[batch_id] = (worker, spans)
+        self._tasks[worker].put((batch_id, texts))
+        return True
+
+    def _reap_dead_workers(self):
+        """Fail the batch of every worker that exited; a dead worker is not given further batches."""
+        if self._stopping:
+            return
+        for worker, process in enumerate(self._processes):
+            if worker in self._dead or process.exitcode is None:
+                continue
+            with self._in_flight_lock:
+                self._dead.add(worker)
+                lost = [batch_id for batch_id, (owner, _) in self._in_flight.items() if owner == worker]
+                lost = [self._in_flight.pop(batch_id)[1] for batch_id in lost]
+            for spans in lost:
+                for future, _, _ in spans:
+                    future.set_exception(RuntimeError(f"Embedding worker {worker} died with exit code "
+                                                      f"{process.exitcode} while encoding the batch."))
+            if len(self._dead) == len(self._processes):
+                self._idle.put(None)
+
+    def _collect_loop(self):
+        while True:
+            self._reap_dead_workers()
+            try:
+                result = self._results.get(timeout=_HEALTH_CHECK_SECONDS)
+            except queue.Empty:
+                continue
+            if result is None:
+                return
+            batch_id, vectors, error = result
+            with self._in_flight_lock:
+                worker, spans = self._in_flight.pop(batch_id, (None, None))
+            if spans is None:
+                # The batch of a worker that died after sending its result; its requests have already failed.
+                continue
+            self._idle.put(worker)
+            self.batches += 1
+            self.texts += spans[-1][2]
+            for future, start, end in spans:
+                if error is not None:
+                    future.set_exception(RuntimeError(f"Error occurred while encoding the batch: {error}"))
+                else:
+                    future.set_result(vectors[start:end].tolist())
+
+
+class _EmbeddingHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections as soon as a few dozen clients connect at once.
+    request_queue_size = 256
+
+
+class _EmbeddingRequestHandler(BaseHTTPRequestHandler):
+    """``POST /embed`` with ``{"texts": [...]}`` returns ``{"embeddings": [[...], ...]}``."""
+
+    def do_POST(self):
+        if self.path != '/embed':
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            embeddings = self.server.embedding_server.embed(body['texts'])
+        except (ValueError, KeyError) as e:
+            self.send_error(400, str(e))
+            return
+        except RuntimeError as e:
+            self.send_error(500, str(e))
+            return
+        self._send_json({'embeddings': embeddings})
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+        server = self.server.embedding_server
+        self._send_json({'status': 'ok', 'batches': server.batches, 'texts': server.texts})
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EmbeddingClient(Embeddings):
+    """
+    LangChain embeddings backed by a running EmbeddingServer.
+
+    Attributes
+    ----------
+    url : str
+        address of the server, e.g. ``http://127.0.0.1:8765``
+    batch_size : int
+        number of documents sent per request
+    timeout : float
+        request timeout in seconds
+    """
+
+    def __init__(self, url='http://127.0.0.1:8765', batch_size=256, timeout=60):
+        self.url = url.rstrip('/')
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+    def embed_documents(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            embeddings.extend(self._post(texts[i:i + self.batch_size]))
+        return embeddings
+
+    def embed_query(self, text):
+        return self._post([text])[0]
+
+    def _post(self, texts):
+        request = urllib.request.Request(f'{self.url}/embed', data=json.dumps({'texts': list(texts)}).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())['embeddings']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve embeddings of a local model with dynamic batching.')
+    parser.add_argument('--model', default='microsoft/codebert-base')
+    parser.add_argument('--backend', choices=('pytorch', 'onnx', 'onnx-int8'), default='pytorch')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads-per-worker', type=int, default=None)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    encoder = None
+    if args.backend != 'pytorch':
+        from legacy_code_assistant.knowledge_base.onnx_embedding_processor import OnnxEmbeddingProcessor
+        encoder = OnnxEmbeddingProcessor(args.model, quantize=args.backend == 'onnx-int8',
+                                         num_threads=args.threads_per_worker)
+    server = EmbeddingServer(encoder, model_name=args.model, workers=args.workers, max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_wait_ms, threads_per_worker=args.threads_per_worker,
+                             host=args.host, port=args.port)
+    server.start()
+    print(f"Serving {args.model} embeddings at {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
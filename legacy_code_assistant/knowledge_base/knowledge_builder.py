@@ -1,16 +1,10 @@
-import ast
-import astor
 from typing import List, Tuple
 from pathlib import Path
 
-from langchain.vectorstores import FAISS
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter # to splits data to chunks
-from langchain.document_loaders import DataFrameLoader
-
-
-
+# langchain, FAISS and the embedding models are imported by the methods that need them, so CodeAnalyzer can be
+# used without loading them.
 from legacy_code_assistant.knowledge_base.knowledge_graph.code_extractor import extract_all
+from legacy_code_assistant.utils.instrumentation import instrumentation
 
 
 class KnowledgeBaseBuilder:
@@ -25,10 +19,18 @@ class KnowledgeBaseBuilder:
         the name of the index used in Faiss
     index : FaissStore
         the FaissStore instance
+    query_cache_size : int
+        number of query embeddings kept in the LRU cache; 0 disables the cache
+    query_cache : CachedEmbeddings or None
+        the LRU cache of query embeddings wrapping the model
     """
 
-    def __init__(self, index_name='code-search', model_name=None, model=None):
+    def __init__(self, index_name='code-search', model_name=None, model=None, query_cache_size=1024):
         """Initialize the Embedding Processor and FaissStore."""
+        from langchain.embeddings import HuggingFaceEmbeddings
+
+        from legacy_code_assistant.knowledge_base.embedding_cache import CachedEmbeddings
+
         self.index_name = index_name
 
         if model is None and model_name is None:
@@ -41,56 +43,92 @@ class KnowledgeBaseBuilder:
             self.model_name = model_name
             self.processor = HuggingFaceEmbeddings(model_name=self.model_name)
 
+        self.query_cache = None
+        if query_cache_size:
+            self.processor = self.query_cache = CachedEmbeddings(self.processor, max_entries=query_cache_size)
+
         self.vectorstore = None
+        self._reset_lookups()
 
     def upload_texts_to_faiss(self, data):
         """Encode the data and upload it to Faiss."""
+        from langchain.vectorstores import FAISS
 
         strings = list(data.values())
-        if self.vectorstore is None:
-            self.vectorstore = FAISS.from_texts(
-                texts=strings, 
-                embedding=self.processor,
-            )
-        else:
-            self.vectorstore.add_texts(
-                texts=strings, 
-                embedding=self.processor,
-            )
+        with instrumentation.timed('index_documents'):
+            if self.vectorstore is None:
+                self.vectorstore = FAISS.from_texts(
+                    texts=strings, 
+                    embedding=self.processor,
+                )
+            else:
+                self.vectorstore.add_texts(
+                    texts=strings, 
+                    embedding=self.processor,
+                )
+        instrumentation.count('documents_indexed', len(strings))
+        self._reset_lookups()
 
     def initialize_faiss_based_on_df(self, df, text_column):
         """Initialize the FaissStore based on a DataFrame."""
+        from langchain.vectorstores import FAISS
 
         assert self.vectorstore is None, 'FaissStore already initialized.'
 
+        texts = self._df_to_documents(df, text_column)
+
+        with instrumentation.timed('index_documents'):
+            self.vectorstore = FAISS.from_documents(
+            texts, self.processor,
+            )
+        instrumentation.count('documents_indexed', len(texts))
+        self._reset_lookups()
+
+    def upload_df_to_faiss(self, df, text_column):
+        """Encode the rows of a DataFrame and add them to Faiss, initializing the FaissStore if needed.
+
+        The remaining columns are kept as document metadata."""
+        from langchain.vectorstores import FAISS
+
+        texts = self._df_to_documents(df, text_column)
+        with instrumentation.timed('index_documents'):
+            if self.vectorstore is None:
+                self.vectorstore = FAISS.from_documents(texts, self.processor)
+            else:
+                self.vectorstore.add_documents(texts)
+        instrumentation.count('documents_indexed', len(texts))
+        self._reset_lookups()
+
+    @staticmethod
+    def _df_to_documents(df, text_column):
+        from langchain.document_loaders import DataFrameLoader
+        from langchain.text_splitter import RecursiveCharacterTextSplitter # to splits data to chunks
+
         df_loader = DataFrameLoader(
             df,
             page_content_column=text_column,
         )
 
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=25000, chunk_overlap=10)
-        texts = text_splitter.split_documents(df_loader.load())
-
-
-        self.vectorstore = FAISS.from_documents(
-        texts, self.processor,
-        )
-        
+        return text_splitter.split_documents(df_loader.load())
 
-    def search(self, query: str, k: int = 3) -> List[Tuple[str, float]]:
+    def search(self, query: str, k: int = 3, filters=None) -> List[Tuple[str, float]]:
         """From a query, find the elements corresponding based on personal information stored in vectordb.
         Euclidian distance is used to find the closest vectors.
 
         Args:
         query (str): Question asked by the user.
-        vectordb_dir (str, optional): Path to the vectordb. Defaults to config.VECTORDB_DIR.
+        k (int, optional): Number of results.
+        filters (dict, optional): Metadata filters, e.g. {'module': 'views', 'type': 'class'}, see MetadataTable.
+            Only the matching vectors are searched.
 
         Returns:
         List[Tuple[Document, float]]: Elements corresponding to the query based on semantic search, associated
         with their respective score.
         """
 
-        results = self.vectorstore.similarity_search_with_score(query=query, k=k)
+        # Embedding the query and searching the vectors are timed as separate stages.
+        results = self.search_by_vector(self.processor.embed_query(query), k=k, filters=filters)
         return results
 
     def save_index(self):
@@ -99,11 +137,171 @@ class KnowledgeBaseBuilder:
 
     def load_index(self):
         """Load the index."""
+        from langchain.vectorstores import FAISS
         self.vectorstore = FAISS.load_local(self.index_name, embeddings =self.processor)
+        self._reset_lookups()
+
+    def get_vector(self, doc_id):
+        """Return the stored vector of a document given its docstore id, or None if it is not in the index."""
+        if self._id_positions is None:
+            # Built once per loaded or updated index instead of scanning all ids on every call.
+            self._id_positions = {stored_id: position
+                                  for position, stored_id in self.vectorstore.index_to_docstore_id.items()}
+        position = self._id_positions.get(doc_id)
+        if position is None:
+            return None
+        return self._reconstruct(position)
+
+    def get_vector_for_text(self, text):
+        """Return the stored vector of the document whose content is exactly ``text``, or None.
+
+        Graph nodes are indexed with their code, so the code of a node finds its vector without an embedding call.
+        The vector also seeds the query cache, so a later search for the same code is not embedded either."""
+        if self._text_positions is None:
+            docstore = self.vectorstore.docstore
+            self._text_positions = {}
+            for position, doc_id in self.vectorstore.index_to_docstore_id.items():
+                document = docstore.search(doc_id)
+                if hasattr(document, 'page_content'):
+                    self._text_positions.setdefault(document.page_content, position)
+        position = self._text_positions.get(text)
+        if position is None:
+            return None
+        vector = self._reconstruct(position)
+        # Normalized stored vectors differ from the embedding of the query.
+        if self.query_cache is not None and not self.vectorstore._normalize_L2:
+            self.query_cache.put(text, vector.tolist())
+        return vector
+
+    def _reconstruct(self, position):
+        index = self.vectorstore.index
+        try:
+            return index.reconstruct(int(position))
+        except RuntimeError:
+            # IVF indexes need a direct map from ids to list entries before vectors can be read back.
+            import faiss
+            faiss.extract_index_ivf(index).make_direct_map()
+            return index.reconstruct(int(position))
+
+    def reindex(self, index_factory='Flat', nprobe=None, ef_search=None):
+        """Rebuild the FAISS index with another structure from the stored vectors, keeping the documents and ids.
+
+        :param index_factory: FAISS index factory string, e.g. ``'Flat'``, ``'IVF64,Flat'`` or ``'HNSW32'``. IVF indexes
+            are trained on the stored vectors.
+        :param nprobe: Number of IVF lists searched per query.
+        :param ef_search: Size of the HNSW candidate list searched per query.
+        """
+        import faiss
+
+        old_index = self.vectorstore.index
+        try:
+            vectors = old_index.reconstruct_n(0, old_index.ntotal)
+        except RuntimeError:
+            faiss.extract_index_ivf(old_index).make_direct_map()
+            vectors = old_index.reconstruct_n(0, old_index.ntotal)
+
+        index = faiss.index_factory(old_index.d, index_factory, old_index.metric_type)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        if nprobe is not None:
+            faiss.extract_index_ivf(index).nprobe = nprobe
+        if ef_search is not None:
+            index.hnsw.efSearch = ef_search
+        self.vectorstore.index = index
+        self._reset_lookups()
+
+    def search_by_vector(self, vector, k: int = 3, filters=None):
+        """Return the documents closest to a vector, together with their scores."""
+        import numpy as np
+
+        with instrumentation.timed('vector_search'):
+            if filters:
+                return self._filtered_search_by_vector(vector, k, filters)
+            vector = np.asarray(vector, dtype='float32').tolist()
+            return self.vectorstore.similarity_search_with_score_by_vector(vector, k=k)
+
+    def find_similar(self, text, k: int = 3, filters=None):
+        """Find the documents most similar to ``text``, e.g. the code of a graph node.
+
+        The stored vector is reused when ``text`` is already indexed, so no embedding call is made; the document
+        itself is left out of the results. Other texts are embedded through the query cache."""
+        vector = self.get_vector_for_text(text)
+        if vector is None:
+            return self.search(text, k=k, filters=filters)
+        results = self.search_by_vector(vector, k=k + 1, filters=filters)
+        return [(doc, score) for doc, score in results if doc.page_content != text][:k]
+
+    def search_and_rerank(self, query, reranker, k=3, fetch_k=None, filters=None):
+        """
+        Over-fetch candidates by vector similarity and reorder them with a reranker, e.g. CrossEncoderReranker.
+
+        :param query: Question asked by the user.
+        :param reranker: Object whose ``rerank(query, documents, k)`` returns ``(document, score)`` pairs.
+        :param k: Number of results.
+        :param fetch_k: Number of candidates fetched; defaults to the ``max_candidates`` of the reranker.
+        :param filters: Metadata filters of the candidates, see ``search``.
+        :return: List of ``(document, score)`` pairs, best first.
+        """
+        fetch_k = fetch_k or getattr(reranker, 'max_candidates', 4 * k)
+        candidates = [doc for doc, _ in self.search(query, k=max(fetch_k, k), filters=filters)]
+        return reranker.rerank(query, candidates, k=k)
+
+    @property
+    def metadata_table(self):
+        """The file, module, parent and type of every vector, built from the docstore on first use."""
+        from legacy_code_assistant.knowledge_base.metadata_table import MetadataTable
+
+        if self._metadata_table is None:
+            self._metadata_table = MetadataTable.from_vectorstore(self.vectorstore)
+        return self._metadata_table
+
+    def _filtered_search_by_vector(self, vector, k, filters):
+        # The filters are turned into an IDSelector, so FAISS only compares the query with the matching vectors
+        # instead of over-fetching and filtering the results.
+        import faiss
+        import numpy as np
+
+        ids = self.metadata_table.select(filters)
+        if len(ids) == 0:
+            return []
+        query = np.ascontiguousarray(np.asarray(vector, dtype='float32').reshape(1, -1))
+        if self.vectorstore._normalize_L2:
+            faiss.normalize_L2(query)
+
+        index = self.vectorstore.index
+        selector = faiss.IDSelectorBatch(ids)
+        if hasattr(index, 'nprobe'):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+        elif hasattr(index, 'hnsw'):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        distances, positions = index.search(query, min(k, len(ids)), params=params)
+
+        results = []
+        for distance, position in zip(distances[0], positions[0]):
+            if position < 0:
+                continue
+            document = self.vectorstore.docstore.search(self.vectorstore.index_to_docstore_id[int(position)])
+            results.append((document, float(distance)))
+        return results
 
-    def get_retriever(self):
-        """Return the retriever."""
-        return self.vectorstore.as_retriever(search_kwargs={'k':3})
+    def _reset_lookups(self):
+        self._id_positions = None
+        self._text_positions = None
+        self._metadata_table = None
+
+    def get_retriever(self, filters=None, k=3, reranker=None):
+        """Return the retriever, optionally restricted to the documents matching ``filters`` and reranked."""
+        if not filters and reranker is None:
+            return self.vectorstore.as_retriever(search_kwargs={'k': k})
+
+        from langchain.schema.runnable import RunnableLambda
+        if reranker is not None:
+            return RunnableLambda(
+                lambda query: [doc for doc, _ in self.search_and_rerank(query, reranker, k=k, filters=filters)])
+        return RunnableLambda(lambda query: [doc for doc, _ in self.search(query, k=k, filters=filters)])
 
 
 class CodeAnalyzer:
@@ -114,10 +312,13 @@ class CodeAnalyzer:
     ----------
     code_files : list
         a list of code files to analyze
+    parse_cache : ParseCache or None
+        optional cache of parsed files shared with the graph and history analysis
     """
 
-    def __init__(self, code_files):
+    def __init__(self, code_files, parse_cache=None):
         self.code_files = code_files
+        self.parse_cache = parse_cache
 
     def analyze(self):
         """
@@ -138,7 +339,13 @@ class CodeAnalyzer:
             with open(file, 'r') as f:
                 content = f.read()
 
-            classes, functions, mod_info = extract_all(content)
+            with instrumentation.timed('code_analysis'):
+                if self.parse_cache is not None:
+                    classes, functions, mod_info = self.parse_cache.extract_all(content, file_path=str(file))
+                else:
+                    classes, functions, mod_info = extract_all(content)
+            instrumentation.count('files_analyzed')
+            instrumentation.count('items_extracted', len(classes) + len(functions) + 1)
 
             for cl, cl_info in classes.items():
                 info_dict = {}
@@ -0,0 +1,132 @@
+import json
+import math
+
+# Weight of every edge type of CodeUsageGraphBuilder: a callee usually explains its caller better than a base class,
+# and a class is the weakest hint about one of its methods.
+DEFAULT_EDGE_WEIGHTS = {'calls': 1.0, 'inherit': 0.8, 'consist': 0.6}
+
+
+class AdjacencyIndex:
+    """
+    Weighted neighbours of every node of a code usage graph, computed once so that expanding retrieval results
+    along the graph is a few dictionary lookups.
+
+    Edges are followed in both directions, ``calls`` edges weigh more the more often the callee is called and the
+    reverse direction (from a callee to its callers, from a base class to its subclasses) is damped by
+    ``reverse_weight``. The neighbours of every node are sorted by weight, best first.
+
+    Attributes
+    ----------
+    neighbours : dict
+        list of ``(neighbour, edge type, weight)`` tuples per node name
+    """
+
+    def __init__(self, neighbours=None):
+        self.neighbours = neighbours or {}
+
+    @classmethod
+    def from_graph(cls, graph, edge_weights=None, reverse_weight=0.5):
+        """
+        Builds the index of a graph of CodeUsageGraphBuilder or CodeGraphAnalyzer.
+
+        :param graph: networkx DiGraph whose edges have a ``type`` and, for ``calls``, a ``weight`` attribute.
+        :param edge_weights: Weight per edge type; edges of other types are ignored.
+        :param reverse_weight: Factor applied to the weight of an edge followed against its direction.
+        :return: The AdjacencyIndex.
+        """
+        edge_weights = edge_weights or DEFAULT_EDGE_WEIGHTS
+        best = {}
+        for source, target, data in graph.edges(data=True):
+            edge_type = data.get('type')
+            if edge_type not in edge_weights:
+                continue
+            weight = edge_weights[edge_type] * math.log2(1 + data.get('weight', 1))
+            for node, neighbour, factor in ((source, target, 1.0), (target, source, reverse_weight)):
+                if node == neighbour or factor <= 0:
+                    continue
+                key = (node, neighbour)
+                if weight * factor > best.get(key, (None, 0.0))[1]:
+                    best[key] = (edge_type, weight * factor)
+
+        neighbours = {}
+        for (node, neighbour), (edge_type, weight) in best.items():
+            neighbours.setdefault(node, []).append((neighbour, edge_type, weight))
+        for node_neighbours in neighbours.values():
+            node_neighbours.sort(key=lambda neighbour: neighbour[2], reverse=True)
+        return cls(neighbours)
+
+    @classmethod
+    def from_files(cls, file_paths, parse_cache=None, **kwargs):
+        """Builds the index of the code usage graph of several Python files."""
+        import networkx as nx
+        from legacy_code_assistant.knowledge_base.knowledge_graph.code_graph import CodeUsageGraphBuilder
+
+        graph = nx.DiGraph()
+        for file_path in file_paths:
+            with open(file_path, 'r') as f:
+                content = f.read()
+            try:
+                graph_builder = CodeUsageGraphBuilder(content, file_path=str(file_path), parse_cache=parse_cache)
+                graph_builder.analyze_file()
+            except SyntaxError as e:
+                print(f"Skipping {file_path}: {e}")
+                continue
+            graph = nx.compose(graph, graph_builder.graph)
+        return cls.from_graph(graph, **kwargs)
+
+    def __len__(self):
+        return len(self.neighbours)
+
+    def __contains__(self, node):
+        return node in self.neighbours
+
+    def expand(self, seeds, max_depth=2, decay=0.5, min_score=0.0):
+        """
+        Scores the nodes reachable from scored seed nodes.
+
+        A node reached over edges of weights ``w1, ..., wd`` from a seed of score ``s`` scores
+        ``s * w1 * ... * wd * decay ** (d - 1)``; the best path counts.
+
+        :param seeds: Dictionary of the seed nodes and their scores.
+        :param max_depth: Maximal number of edges between a seed and a returned node.
+        :param decay: Factor applied for every edge after the first.
+        :param min_score: Nodes scoring less are neither returned nor expanded.
+        :return: Dictionary of the reached nodes, seeds excluded, and their scores.
+        """
+        scores = dict(seeds)
+        frontier = dict(seeds)
+        for depth in range(max_depth):
+            factor = decay if depth else 1.0
+            next_frontier = {}
+            for node, node_score in frontier.items():
+                for neighbour, _, weight in self.neighbours.get(node, ()):
+                    score = node_score * weight * factor
+                    if score > min_score and score > scores.get(neighbour, 0.0):
+                        scores[neighbour] = next_frontier[neighbour] = score
+            frontier = next_frontier
+        return {node: score for node, score in scores.items() if node not in seeds}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.neighbours, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            neighbours = json.load(f)
+        return cls({node: [tuple(neighbour) for neighbour in node_neighbours]
+                    for node, node_neighbours in neighbours.items()})
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(description='Precompute the AdjacencyIndex of the code graph of a repository.')
+    parser.add_argument('repo_path')
+    parser.add_argument('output', help='Path of the written JSON index.')
+    args = parser.parse_args()
+
+    index = AdjacencyIndex.from_files(sorted(Path(args.repo_path).rglob('*.py')))
+    index.save(args.output)
+    print(f"Saved the neighbours of {len(index)} nodes to {args.output}")
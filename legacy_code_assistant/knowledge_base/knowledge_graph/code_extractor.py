@@ -1,9 +1,11 @@
 import ast
 import astor
 
+from legacy_code_assistant.utils.instrumentation import instrumentation
+
 
 class ClassItem:
-    def __init__(self, name, docstring, source_code, base_names, file_path):
+    def __init__(self, name, docstring, source_code, base_names, file_path, lineno=None, end_lineno=None):
         self.name = name
         self.docstring = docstring
         self.source_code = source_code
@@ -11,6 +13,8 @@ class ClassItem:
         self.functions = {}
         self.usage = {}
         self.file_path = file_path
+        self.lineno = lineno
+        self.end_lineno = end_lineno
 
     def __repr__(self):
         return f"ClassItem(name={self.name})"
@@ -20,12 +24,14 @@ class ClassItem:
 
 
 class FunctionItem:
-    def __init__(self, name, docstring, code, file_path):
+    def __init__(self, name, docstring, code, file_path, lineno=None, end_lineno=None):
         self.name = name
         self.docstring = docstring
         self.source_code = code
         self.usage = {}
         self.file_path = file_path
+        self.lineno = lineno
+        self.end_lineno = end_lineno
 
     def __repr__(self):
         return f"FunctionItem(name={self.name})"
@@ -45,13 +51,19 @@ class CodeExtractor(ast.NodeVisitor):
 
     def visit_ClassDef(self, node):
         base_names = [base.id for base in node.bases if isinstance(base, ast.Name)]
+        with instrumentation.timed('astor'):
+            source_code = astor.to_source(node)
         self.current_class = self.classes[node.name] = ClassItem(
-            node.name, ast.get_docstring(node), astor.to_source(node), base_names, self.file_path)
+            node.name, ast.get_docstring(node), source_code, base_names, self.file_path,
+            node.lineno, node.end_lineno)
         self.generic_visit(node)
         self.current_class = None
 
     def visit_FunctionDef(self, node):
-        function_item = FunctionItem(node.name, ast.get_docstring(node), astor.to_source(node), self.file_path)
+        with instrumentation.timed('astor'):
+            source_code = astor.to_source(node)
+        function_item = FunctionItem(node.name, ast.get_docstring(node), source_code, self.file_path,
+                                     node.lineno, node.end_lineno)
         if self.current_class:
             self.current_function = self.current_class.functions[node.name] = function_item
         else:
@@ -92,11 +104,15 @@ def extract_classes_methods(file_content):
 
 
 def extract_all(file_content):
-    tree = ast.parse(file_content)
+    with instrumentation.timed('ast_parse'):
+        tree = ast.parse(file_content)
     extractor = CodeExtractor(file_content)
-    extractor.visit(tree)
+    # The visit includes the astor time of the classes and functions, which is also recorded on its own.
+    with instrumentation.timed('ast_visit'):
+        extractor.visit(tree)
 
-    module_code = astor.to_source(tree)
+    with instrumentation.timed('astor'):
+        module_code = astor.to_source(tree)
     module = {
         'docstring': ast.get_docstring(tree), 'code': module_code,
         'code_start_line': 0, 'code_end_line': None
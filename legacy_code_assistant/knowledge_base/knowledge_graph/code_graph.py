@@ -2,7 +2,6 @@ import ast
 import os
 import sys
 
-import matplotlib.pyplot as plt
 import networkx as nx
 
 project_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -12,15 +11,21 @@ from legacy_code_assistant.knowledge_base.knowledge_graph.code_extractor import
 
 
 class CodeUsageGraphBuilder:
-    def __init__(self, file_content, repo_path=None, file_path=None):
+    def __init__(self, file_content, repo_path=None, file_path=None, parse_cache=None):
         self.file_content = file_content
         self.repo_path = repo_path
         self.graph = nx.DiGraph()
         self.code_extractor = CodeExtractor(self.file_content, file_path)
+        self.parse_cache = parse_cache
 
     def analyze_file(self):
-        tree = ast.parse(self.file_content)
-        self.code_extractor.visit(tree)
+        if self.parse_cache is not None:
+            classes, functions, _ = self.parse_cache.extract_all(self.file_content,
+                                                                 file_path=self.code_extractor.file_path)
+            self.code_extractor.classes, self.code_extractor.functions = classes, functions
+        else:
+            tree = ast.parse(self.file_content)
+            self.code_extractor.visit(tree)
 
         self._add_class_nodes_and_edges()
         self._add_function_nodes_and_edges()
@@ -58,6 +63,8 @@ class CodeUsageGraphBuilder:
         print("Node List: ")
 
     def visualize_graph(self):
+        import matplotlib.pyplot as plt
+
         pos = nx.spring_layout(self.graph)
         nx.draw(self.graph, pos, with_labels=True, node_color='lightblue', edge_color='gray')
         plt.show()
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from legacy_code_assistant.knowledge_base.knowledge_graph.code_extractor import ClassItem, FunctionItem, extract_all
+
+CACHE_FORMAT_VERSION = 1
+
+
+def git_blob_sha(content):
+    """
+    Computes the git blob SHA-1 of the given content.
+
+    Working-tree files hashed this way share cache keys with the blobs stored in git history.
+
+    :param content: File content as str or bytes.
+    :return: Hex digest identical to ``git hash-object``.
+    """
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def _function_to_record(function_item):
+    return [function_item.name, function_item.docstring, function_item.source_code, function_item.usage,
+            function_item.lineno, function_item.end_lineno]
+
+
+def _function_from_record(record, file_path):
+    name, docstring, code, usage, lineno, end_lineno = record
+    function_item = FunctionItem(name, docstring, code, file_path, lineno, end_lineno)
+    function_item.usage = dict(usage)
+    return function_item
+
+
+def _class_to_record(class_item):
+    return [class_item.name, class_item.docstring, class_item.source_code, class_item.bases, class_item.usage,
+            class_item.lineno, class_item.end_lineno,
+            [_function_to_record(function_item) for function_item in class_item.functions.values()]]
+
+
+def _class_from_record(record, file_path):
+    name, docstring, code, bases, usage, lineno, end_lineno, functions = record
+    class_item = ClassItem(name, docstring, code, list(bases), file_path, lineno, end_lineno)
+    class_item.usage = dict(usage)
+    for function_record in functions:
+        function_item = _function_from_record(function_record, file_path)
+        class_item.functions[function_item.name] = function_item
+    return class_item
+
+
+class ParseCache:
+    """
+    Content-addressed cache of ``extract_all`` results.
+
+    Entries are keyed by git blob SHA, so a blob parsed while mining history is reused for the same content
+    in the working tree and vice versa. Recently used entries are kept in memory with LRU eviction; when
+    ``cache_dir`` is given, entries are also persisted there as zlib-compressed JSON records.
+
+    Attributes
+    ----------
+    cache_dir : str or None
+        directory of the on-disk tier, ``None`` keeps the cache in memory only
+    max_entries : int
+        maximum number of parsed blobs held in memory
+    hits : int
+        number of lookups answered from memory or disk
+    misses : int
+        number of lookups that required parsing
+    """
+
+    def __init__(self, cache_dir=None, max_entries=2048):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, blob_sha):
+        return blob_sha in self._entries or (self.cache_dir is not None and os.path.exists(self._path(blob_sha)))
+
+    def extract_all(self, file_content, file_path=None, blob_sha=None):
+        """
+        Cached equivalent of ``code_extractor.extract_all``.
+
+        :param file_content: Source code of the file.
+        :param file_path: Path stamped on the returned items; it is not part of the cache key.
+        :param blob_sha: Git blob SHA of the content, computed from the content when not given.
+        :return: Tuple of (classes, functions, module) with fresh item objects.
+        """
+        payload = self._get_payload(file_content, blob_sha)
+        classes = {record[0]: _class_from_record(record, file_path) for record in payload['classes']}
+        functions = {record[0]: _function_from_record(record, file_path) for record in payload['functions']}
+        return classes, functions, dict(payload['module'])
+
+    def extract_classes_methods(self, file_content, file_path=None, blob_sha=None):
+        """Cached equivalent of ``code_extractor.extract_classes_methods``."""
+        classes, functions, _ = self.extract_all(file_content, file_path=file_path, blob_sha=blob_sha)
+        return classes, functions
+
+    def clear(self):
+        """Drop the in-memory tier; the on-disk tier is left untouched."""
+        with self._lock:
+            self._entries.clear()
+
+    def _get_payload(self, file_content, blob_sha):
+        if blob_sha is None:
+            blob_sha = git_blob_sha(file_content)
+
+        with self._lock:
+            payload = self._entries.get(blob_sha)
+            if payload is not None:
+                self._entries.move_to_end(blob_sha)
+                self.hits += 1
+                return payload
+
+        payload = self._read(blob_sha)
+        if payload is None:
+            if isinstance(file_content, bytes):
+                file_content = file_content.decode('utf-8')
+            classes, functions, module = extract_all(file_content)
+            payload = {
+                'version': CACHE_FORMAT_VERSION,
+                'classes': [_class_to_record(class_item) for class_item in classes.values()],
+                'functions': [_function_to_record(function_item) for function_item in functions.values()],
+                'module': module,
+            }
+            self._write(blob_sha, payload)
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        with self._lock:
+            self._entries[blob_sha] = payload
+            self._entries.move_to_end(blob_sha)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
+
+    def _path(self, blob_sha):
+        return os.path.join(self.cache_dir, blob_sha[:2], f'{blob_sha}.json.z')
+
+    def _read(self, blob_sha):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._path(blob_sha), 'rb') as f:
+                payload = json.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error):
+            return None
+        return payload if payload.get('version') == CACHE_FORMAT_VERSION else None
+
+    def _write(self, blob_sha, payload):
+        if self.cache_dir is None:
+            return
+        path = self._path(blob_sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8')))
+        os.replace(tmp_path, path)
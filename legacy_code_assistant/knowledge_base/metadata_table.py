@@ -0,0 +1,79 @@
+import numpy as np
+
+FIELDS = ('file', 'module', 'parent', 'type')
+
+
+class MetadataTable:
+    """
+    Compact metadata of the vectors of an index, aligned with their FAISS ids.
+
+    Every field is stored as an array of integer codes into a vocabulary of its distinct values, so selecting the
+    ids of e.g. all methods of one module is a vectorized comparison instead of a pass over the docstore.
+
+    Filters map a field to a value or to a list of accepted values, e.g. ``{'module': 'views', 'type': ['class',
+    'method']}``. ``file_contains`` keeps the files whose path contains the given text, which is how
+    ``CodeGraphAnalyzer`` scopes a module.
+
+    Attributes
+    ----------
+    vocabularies : dict
+        distinct values of every field; the codes index into them
+    codes : dict
+        code of the value of every field for every id
+    """
+
+    def __init__(self, metadatas=()):
+        self.vocabularies = {field: [] for field in FIELDS}
+        self._positions = {field: {} for field in FIELDS}
+        self.codes = {field: np.empty(0, dtype='int32') for field in FIELDS}
+        self.append(metadatas)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        """Build the table of a LangChain FAISS vectorstore from the metadata of its documents."""
+        index_to_docstore_id = vectorstore.index_to_docstore_id
+        metadatas = []
+        for position in range(len(index_to_docstore_id)):
+            document = vectorstore.docstore.search(index_to_docstore_id[position])
+            metadatas.append(getattr(document, 'metadata', {}))
+        return cls(metadatas)
+
+    def __len__(self):
+        return len(self.codes[FIELDS[0]])
+
+    def append(self, metadatas):
+        """Add the metadata of the next ids."""
+        metadatas = list(metadatas)
+        for field in FIELDS:
+            new_codes = np.fromiter((self._code(field, metadata.get(field)) for metadata in metadatas),
+                                    dtype='int32', count=len(metadatas))
+            self.codes[field] = np.concatenate([self.codes[field], new_codes])
+
+    def select(self, filters):
+        """
+        Return the ids matching all filters.
+
+        :param filters: Dictionary of field filters, see the class description.
+        :return: Sorted array of matching ids.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for field, value in filters.items():
+            if field == 'file_contains':
+                accepted = [code for code, path in enumerate(self.vocabularies['file'])
+                            if path is not None and value in path]
+                field = 'file'
+            elif field in FIELDS:
+                values = value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+                accepted = [self._positions[field][item] for item in values if item in self._positions[field]]
+            else:
+                raise ValueError(f"Unknown filter: {field}")
+            mask &= np.isin(self.codes[field], accepted)
+        return np.flatnonzero(mask).astype('int64')
+
+    def _code(self, field, value):
+        value = None if value is None else str(value)
+        positions = self._positions[field]
+        if value not in positions:
+            positions[value] = len(self.vocabularies[field])
+            self.vocabularies[field].append(value)
+        return positions[value]
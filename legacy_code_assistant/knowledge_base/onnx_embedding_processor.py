@@ -0,0 +1,136 @@
+import os
+import re
+
+import onnxruntime as ort
+from transformers import AutoTokenizer
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_ONNX_DIR = os.path.join(PROJECT_PATH, '.cache', 'onnx')
+
+
+def export_to_onnx(model_name, onnx_path, opset_version=17):
+    """
+    Exports the encoder of a Hugging Face model to ONNX, with dynamic batch and sequence axes.
+
+    :param model_name: Name or local path of the model.
+    :param onnx_path: Path of the written ``.onnx`` file.
+    :param opset_version: ONNX opset used for the export.
+    :return: Path of the exported model.
+    """
+    import torch
+    from transformers import AutoModel
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = LastHiddenState(AutoModel.from_pretrained(model_name)).eval()
+    sample = tokenizer(['def f(x):\n    return x', 'x = 1'], return_tensors='pt', padding=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    export_options = dict(
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['last_hidden_state'],
+        dynamic_axes={name: {0: 'batch', 1: 'sequence'}
+                      for name in ('input_ids', 'attention_mask', 'last_hidden_state')},
+        opset_version=opset_version,
+    )
+    with torch.no_grad():
+        try:
+            # Newer torch versions default to the dynamo exporter, which needs the extra onnxscript package.
+            torch.onnx.export(model, (sample['input_ids'], sample['attention_mask']), onnx_path, dynamo=False,
+                              **export_options)
+        except TypeError:
+            torch.onnx.export(model, (sample['input_ids'], sample['attention_mask']), onnx_path, **export_options)
+    return onnx_path
+
+
+def quantize_onnx(onnx_path, quantized_path):
+    """
+    Applies dynamic int8 quantization to the weights of an ONNX model.
+
+    :param onnx_path: Path of the fp32 model.
+    :param quantized_path: Path of the written int8 model.
+    :return: Path of the quantized model.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+class OnnxEmbeddingProcessor:
+    """
+    CPU alternative of EmbeddingProcessor running the model with ONNX Runtime.
+
+    The model is exported on first use and the exported files are reused afterwards. Embeddings are mean-pooled
+    over the non-padding tokens like ``EmbeddingProcessor.encode_batch``.
+
+    Attributes
+    ----------
+    model_name : str
+        name or local path of the Hugging Face model
+    quantize : bool
+        whether the dynamically int8 quantized model is used
+    num_threads : int or None
+        number of intra-op threads of ONNX Runtime; None lets it use all cores
+    onnx_path : str
+        path of the ONNX model that is run
+    """
+
+    def __init__(self, model_name='microsoft/codebert-base', quantize=False, num_threads=None, onnx_dir=None,
+                 max_length=512):
+        self.model_name = model_name
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        model_dir = os.path.join(onnx_dir or DEFAULT_ONNX_DIR, re.sub(r'[^\w.-]+', '_', model_name.strip('/\\')))
+        fp32_path = os.path.join(model_dir, 'model.onnx')
+        if not os.path.exists(fp32_path):
+            export_to_onnx(model_name, fp32_path)
+        self.onnx_path = fp32_path
+        if quantize:
+            self.onnx_path = os.path.join(model_dir, 'model.int8.onnx')
+            if not os.path.exists(self.onnx_path):
+                quantize_onnx(fp32_path, self.onnx_path)
+
+        self._session = None
+
+    @property
+    def session(self):
+        # Created on first use: an ONNX Runtime session does not survive a fork, so every worker process of the
+        # EmbeddingServer opens its own.
+        if self._session is None:
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if self.num_threads:
+                options.intra_op_num_threads = self.num_threads
+                options.inter_op_num_threads = 1
+            self._session = ort.InferenceSession(self.onnx_path, options, providers=['CPUExecutionProvider'])
+        return self._session
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_session'] = None
+        return state
+
+    def encode(self, text):
+        return self.encode_batch([text])
+
+    def encode_batch(self, texts):
+        """Encode a list of texts in one run, mean-pooling over the non-padding tokens."""
+        inputs = self.tokenizer(list(texts), return_tensors='np', max_length=self.max_length, truncation=True,
+                                padding=True)
+        hidden = self.session.run(['last_hidden_state'], {
+            'input_ids': inputs['input_ids'].astype('int64'),
+            'attention_mask': inputs['attention_mask'].astype('int64'),
+        })[0]
+        mask = inputs['attention_mask'][..., None].astype(hidden.dtype)
+        return (hidden * mask).sum(axis=1) / mask.sum(axis=1)
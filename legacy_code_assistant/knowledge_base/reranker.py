@@ -0,0 +1,72 @@
+import time
+
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+
+class CrossEncoderReranker:
+    """
+    Re-scores dense retrieval candidates with a cross-encoder that reads the query and the candidate together.
+
+    The candidates are scored on CPU in batches. ``max_candidates`` caps the number of candidates scored per query,
+    and once ``time_budget_ms`` is spent no further batch is started. Candidates left unscored keep their dense order
+    after the scored ones.
+
+    Attributes
+    ----------
+    model_name : str
+        name or local path of a Hugging Face sequence classification model with one relevance logit (or two labels,
+        the second one meaning relevant)
+    batch_size : int
+        number of query-candidate pairs scored in one forward pass
+    max_candidates : int
+        maximal number of candidates scored per query
+    time_budget_ms : float or None
+        time after which no further batch is scored; None scores all ``max_candidates``
+    max_length : int
+        maximal number of tokens of a query-candidate pair; the longer of the two is truncated
+    """
+
+    def __init__(self, model_name='cross-encoder/ms-marco-MiniLM-L-6-v2', batch_size=16, max_candidates=20,
+                 time_budget_ms=None, max_length=256, num_threads=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_candidates = max_candidates
+        self.time_budget_ms = time_budget_ms
+        self.max_length = max_length
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+
+    def score(self, query, texts):
+        """Return the relevance of every text to the query, in one forward pass."""
+        inputs = self.tokenizer([query] * len(texts), list(texts), return_tensors='pt', max_length=self.max_length,
+                                truncation='longest_first', padding=True)
+        with torch.no_grad():
+            logits = self.model(**inputs).logits
+        if logits.shape[-1] == 1:
+            return logits[:, 0].tolist()
+        return (logits[:, -1] - logits[:, 0]).tolist()
+
+    def rerank(self, query, documents, k=None):
+        """
+        Reorder retrieved documents by their cross-encoder relevance.
+
+        :param query: The query the documents were retrieved for.
+        :param documents: Retrieved documents, best first.
+        :param k: Number of documents returned; all candidates when None.
+        :return: List of ``(document, relevance)`` pairs, best first; unscored candidates have a relevance of -inf.
+        """
+        candidates = list(documents)[:self.max_candidates]
+        scores = []
+        start = time.perf_counter()
+        for i in range(0, len(candidates), self.batch_size):
+            if scores and self.time_budget_ms is not None and \
+                    (time.perf_counter() - start) * 1000 >= self.time_budget_ms:
+                break
+            scores.extend(self.score(query, [document.page_content for document in candidates[i:i + self.batch_size]]))
+
+        reranked = sorted(zip(candidates[:len(scores)], scores), key=lambda pair: pair[1], reverse=True)
+        reranked += [(document, float('-inf')) for document in candidates[len(scores):]]
+        return reranked[:k] if k is not None else reranked
@@ -0,0 +1,73 @@
+"""
+Retrieval quality and latency on labelled queries.
+
+The labelled queries are built from ``generated_docstrings.csv``: the docstring generated for a code item is the
+query and the code item is the only relevant result.
+"""
+import time
+from collections import namedtuple
+
+import numpy as np
+
+LabelledQuery = namedtuple('LabelledQuery', ['query', 'relevant'])
+
+
+def build_query_set(df, query_column='generated_docstring', target_column='code', min_query_length=10):
+    """
+    Pair every generated docstring with the code it was generated from.
+
+    :param df: DataFrame of the code items, e.g. read from ``generated_docstrings.csv``.
+    :param query_column: Column of the queries.
+    :param target_column: Column of the relevant texts.
+    :param min_query_length: Shorter queries are skipped.
+    :return: List of LabelledQuery.
+    """
+    rows = df[df[query_column].notna() & df[target_column].notna()]
+    return [LabelledQuery(str(query).strip(), str(target).strip())
+            for query, target in zip(rows[query_column], rows[target_column])
+            if len(str(query).strip()) >= min_query_length]
+
+
+def document_code(document):
+    """Code of a retrieved document; documents of a docstring index keep their code in the metadata."""
+    return str(document.metadata.get('code', document.page_content)).strip()
+
+
+def reciprocal_rank(retrieved, relevant):
+    for rank, item in enumerate(retrieved, start=1):
+        if item == relevant:
+            return 1.0 / rank
+    return 0.0
+
+
+def recall_at_k(retrieved, relevant, k):
+    return float(relevant in retrieved[:k])
+
+
+def evaluate(search, queries, ks=(1, 3, 5, 10), key=document_code):
+    """
+    Run labelled queries and measure the quality and latency of the retrieval.
+
+    :param search: Function returning the documents retrieved for a query, best first, at least ``max(ks)`` of them.
+    :param queries: List of LabelledQuery.
+    :param ks: Cut-offs of the reported recall.
+    :param key: Function comparing a retrieved document with the relevant text of a query.
+    :return: Dictionary with ``recall@k`` per cut-off, ``mrr`` and the latency percentiles in milliseconds.
+    """
+    reciprocal_ranks, recalls, latencies = [], {k: [] for k in ks}, []
+    for labelled_query in queries:
+        start = time.perf_counter()
+        documents = search(labelled_query.query)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        retrieved = [key(document) for document in documents]
+        reciprocal_ranks.append(reciprocal_rank(retrieved, labelled_query.relevant))
+        for k in ks:
+            recalls[k].append(recall_at_k(retrieved, labelled_query.relevant, k))
+
+    report = {'queries': len(queries), 'mrr': float(np.mean(reciprocal_ranks)) if queries else 0.0}
+    for k in ks:
+        report[f'recall@{k}'] = float(np.mean(recalls[k])) if queries else 0.0
+    report['latency_p50_ms'] = float(np.percentile(latencies, 50)) if queries else 0.0
+    report['latency_p95_ms'] = float(np.percentile(latencies, 95)) if queries else 0.0
+    return report
@@ -0,0 +1,174 @@
+import bisect
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from legacy_code_assistant.utils.common_utils import count_tokens
+
+
+class StackOverflowRetriever:
+    """
+    Retrieves StackOverflow questions from the local index built by ``stackoverflow_embeddings``.
+
+    No network access is needed: vectors are searched in the FAISS index and the matching questions are read
+    from the JSONL metadata written next to the vector shards.
+
+    Attributes
+    ----------
+    index : faiss.Index
+        the index over all shard vectors, ids being positions in the shards
+    embed_fn : callable
+        maps a list of texts to an array of vectors; it must be the model used to build the index
+    k : int
+        number of questions returned per query
+    """
+
+    def __init__(self, index_path, vecs_path, embed_fn, k=3, nprobe=16):
+        import faiss
+
+        from legacy_code_assistant.utils.stackoverflow_embeddings import SHARDS_MANIFEST
+
+        self.index = faiss.read_index(index_path)
+        if hasattr(self.index, 'nprobe'):
+            self.index.nprobe = nprobe
+        self.embed_fn = embed_fn
+        self.k = k
+
+        with open(os.path.join(vecs_path, SHARDS_MANIFEST), 'r') as f_obj:
+            manifest = json.load(f_obj)
+        self._metadata_paths = [os.path.join(vecs_path, shard['metadata']) for shard in manifest['shards']]
+        self._shard_starts = list(itertools.accumulate([0] + [shard['count'] for shard in manifest['shards']]))
+        self._line_offsets = {}
+
+    def invoke(self, query):
+        return self.get_relevant_documents(query)
+
+    def get_relevant_documents(self, query):
+        """Return the questions most similar to the query as Documents."""
+        import numpy as np
+        from langchain.schema import Document
+
+        vector = np.ascontiguousarray(np.asarray(self.embed_fn([query]), dtype='float32').reshape(1, -1))
+        distances, ids = self.index.search(vector, self.k)
+        documents = []
+        for distance, vector_id in zip(distances[0], ids[0]):
+            if vector_id < 0:
+                continue
+            question = self._read_metadata(int(vector_id))
+            documents.append(Document(
+                page_content=f"StackOverflow question: {question['title']} (tags: {', '.join(question['tags'])})",
+                metadata={'source': 'stackoverflow', 'id': question['id'], 'score': float(distance),
+                          'url': f"https://stackoverflow.com/q/{question['id']}"},
+            ))
+        return documents
+
+    def _read_metadata(self, vector_id):
+        shard = bisect.bisect_right(self._shard_starts, vector_id) - 1
+        offsets = self._line_offsets.get(shard)
+        if offsets is None:
+            offsets = self._line_offsets[shard] = self._index_lines(self._metadata_paths[shard])
+        with open(self._metadata_paths[shard], 'rb') as f_obj:
+            f_obj.seek(offsets[vector_id - self._shard_starts[shard]])
+            return json.loads(f_obj.readline())
+
+    @staticmethod
+    def _index_lines(path):
+        import numpy as np
+
+        offsets, position = [], 0
+        with open(path, 'rb') as f_obj:
+            for line in f_obj:
+                offsets.append(position)
+                position += len(line)
+        return np.asarray(offsets, dtype='int64')
+
+
+class ContextFetcher:
+    """
+    Gathers the context of a question from the code index and external sources in parallel.
+
+    Code documents always come first. External sources only contribute what they return within
+    ``timeout`` seconds of the request, so a slow source never delays the answer. A source whose previous
+    call is still running is skipped, so a hanging source holds at most one worker of the pool. Documents are
+    added in order of priority until ``token_budget`` is spent.
+
+    Attributes
+    ----------
+    code_retriever : retriever
+        the retriever over the code knowledge base
+    external_retrievers : list
+        retrievers of external knowledge, e.g. StackOverflowRetriever
+    token_budget : int
+        maximal number of context tokens
+    timeout : float
+        latency objective of the external sources in seconds
+    timeouts : int
+        number of external calls that missed the latency objective
+    skipped : int
+        number of external calls not made because the previous call of the source was still running
+    """
+
+    def __init__(self, code_retriever, external_retrievers=(), token_budget=3000, timeout=0.5, max_workers=8):
+        self.code_retriever = code_retriever
+        self.external_retrievers = list(external_retrievers)
+        self.token_budget = token_budget
+        self.timeout = timeout
+        self.timeouts = 0
+        self.skipped = 0
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='context-fetcher')
+
+    def __call__(self, query):
+        return self.fetch(query)
+
+    def fetch(self, query, code_retriever=None):
+        """Return the page contents of the selected documents, code first, within the token budget.
+
+        ``code_retriever`` replaces the code retriever for this query, e.g. with the retriever of an operation."""
+        if isinstance(query, dict):
+            query = query['question']
+        deadline = time.monotonic() + self.timeout
+        external_futures = self._submit_external(query)
+        code_documents = (code_retriever or self.code_retriever).invoke(query)
+
+        external_documents = []
+        for future in external_futures:
+            try:
+                external_documents.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+            except TimeoutError:
+                # A call that has not started yet is dropped; a running one is left to finish in the background.
+                future.cancel()
+                self.timeouts += 1
+            except Exception as e:
+                print(f"Error occurred while fetching external context: {e}")
+        return self._merge(code_documents, external_documents)
+
+    def _submit_external(self, query):
+        futures = []
+        with self._running_lock:
+            for position, retriever in enumerate(self.external_retrievers):
+                running = self._running.get(position)
+                if running is not None and not running.done():
+                    self.skipped += 1
+                    continue
+                future = self._running[position] = self._executor.submit(retriever.invoke, query)
+                futures.append(future)
+        return futures
+
+    def _merge(self, code_documents, external_documents):
+        # Round-robin over the external sources so a single source cannot crowd out the others.
+        longest = max(map(len, external_documents), default=0)
+        interleaved = [docs[i] for i in range(longest) for docs in external_documents if i < len(docs)]
+
+        selected, used_tokens = [], 0
+        for doc in list(code_documents) + interleaved:
+            tokens = count_tokens(doc.page_content)
+            if used_tokens + tokens > self.token_budget:
+                continue
+            selected.append(doc.page_content)
+            used_tokens += tokens
+        return selected
@@ -0,0 +1,120 @@
+from legacy_code_assistant.rag_integration.index_router import item_key
+
+
+def document_node(metadata):
+    """Name of the code graph node of a document, e.g. ``StudentView.get`` for a method."""
+    name = metadata.get('name')
+    if metadata.get('type') == 'method' and metadata.get('parent'):
+        return f"{metadata['parent']}.{name}"
+    return name
+
+
+class GraphExpander:
+    """
+    Adds the code items connected to retrieved documents in the code graph, e.g. the functions they call and the
+    classes they inherit from, which vector similarity alone often misses.
+
+    The retrieved documents are seeds scored by their rank, the AdjacencyIndex scores the nodes around them by edge
+    weight and distance and the best nodes that have a document in the knowledge base are appended to the results.
+    Nodes without a document of their own, e.g. methods of an index of classes, resolve to their class.
+
+    Attributes
+    ----------
+    adjacency : AdjacencyIndex
+        precomputed neighbours of the code graph nodes
+    knowledge_base : KnowledgeBaseBuilder
+        knowledge base with a loaded index holding the documents of the nodes
+    max_expansions : int
+        maximal number of documents added to the retrieved ones
+    max_depth : int
+        maximal number of edges between a retrieved document and an added one
+    decay : float
+        factor applied to the score for every edge after the first
+    min_score : float
+        nodes scoring less are not added
+    """
+
+    def __init__(self, adjacency, knowledge_base, max_expansions=3, max_depth=2, decay=0.5, min_score=0.05):
+        self.adjacency = adjacency
+        self.knowledge_base = knowledge_base
+        self.max_expansions = max_expansions
+        self.max_depth = max_depth
+        self.decay = decay
+        self.min_score = min_score
+        self._node_positions = self._index_nodes()
+
+    def _index_nodes(self):
+        vectorstore = self.knowledge_base.vectorstore
+        node_positions = {}
+        for position, docstore_id in vectorstore.index_to_docstore_id.items():
+            document = vectorstore.docstore.search(docstore_id)
+            node = document_node(getattr(document, 'metadata', {}))
+            if node is not None:
+                node_positions.setdefault(node, []).append(position)
+        return node_positions
+
+    def expand(self, documents, filters=None):
+        """
+        Return the documents connected to ``documents`` in the code graph with their scores, best first.
+
+        :param documents: Retrieved documents, best first.
+        :param filters: Optional metadata filters of the search, see MetadataTable; other documents are not added.
+        :return: List of at most ``max_expansions`` ``(document, score)`` pairs, without the given documents.
+        """
+        seeds = {}
+        for rank, document in enumerate(documents):
+            node = document_node(document.metadata)
+            if node is not None:
+                seeds[node] = max(seeds.get(node, 0.0), 1.0 / (rank + 1))
+        if not seeds:
+            return []
+
+        allowed = set(self.knowledge_base.metadata_table.select(filters).tolist()) if filters else None
+        files = {document.metadata.get('file') for document in documents}
+        seen = {item_key(document) for document in documents}
+        expanded = []
+        candidates = self.adjacency.expand(seeds, max_depth=self.max_depth, decay=self.decay,
+                                           min_score=self.min_score)
+        for node, score in sorted(candidates.items(), key=lambda candidate: candidate[1], reverse=True):
+            document = self._document(node, files, allowed)
+            if document is None or item_key(document) in seen:
+                continue
+            seen.add(item_key(document))
+            expanded.append((document, score))
+            if len(expanded) == self.max_expansions:
+                break
+        return expanded
+
+    def _document(self, node, files, allowed=None):
+        positions = self._node_positions.get(node)
+        if positions is None and '.' in node:
+            positions = self._node_positions.get(node.split('.', 1)[0])
+        if positions is not None and allowed is not None:
+            positions = [position for position in positions if position in allowed]
+        if not positions:
+            return None
+        # Node names are not unique across files; the documents of the files already retrieved are preferred.
+        vectorstore = self.knowledge_base.vectorstore
+        documents = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[position])
+                     for position in positions]
+        return next((document for document in documents if document.metadata.get('file') in files), documents[0])
+
+    def as_retriever(self, retriever, filters=None):
+        """Wrap a retriever so that its documents are followed by their neighbours matching ``filters``."""
+        return GraphExpansionRetriever(self, retriever, filters=filters)
+
+
+class GraphExpansionRetriever:
+    """Retriever appending the graph neighbours of the documents of another retriever."""
+
+    def __init__(self, expander, retriever, filters=None):
+        self.expander = expander
+        self.retriever = retriever
+        self.filters = filters
+
+    def invoke(self, query):
+        documents = self.retriever.invoke(query)
+        return documents + [document for document, _ in self.expander.expand(documents, filters=self.filters)]
+
+    def get_relevant_documents(self, query):
+        return self.invoke(query)
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+
+# Weights of the indexes per RagManager operation; docstrings describe intent, code shows the implementation.
+DEFAULT_OPERATION_WEIGHTS = {
+    'analyze': {'docstring': 0.6, 'code': 0.4},
+    'add': {'docstring': 0.5, 'code': 0.5},
+    'modify': {'docstring': 0.3, 'code': 0.7},
+    'test': {'docstring': 0.3, 'code': 0.7},
+    'vulnerability': {'docstring': 0.2, 'code': 0.8},
+}
+
+
+def item_key(document):
+    """Identify the code item of a document by its file and qualified name, e.g. ``views.py::StudentView.get``."""
+    metadata = document.metadata
+    if 'file' not in metadata or 'name' not in metadata:
+        return document.page_content
+    parent = metadata.get('parent')
+    qualified_name = f"{parent}.{metadata['name']}" if parent and parent != metadata['name'] else metadata['name']
+    return f"{metadata['file']}::{qualified_name}"
+
+
+class IndexRouter:
+    """
+    Queries several knowledge base indexes at once and merges their results.
+
+    FAISS returns distances on a scale specific to each index, so the distances of every index are min-max
+    normalized to a relevance in [0, 1] before they are weighted. Results describing the same code item, e.g. its
+    code and its docstring, are merged into one whose score is the sum of the weighted relevances.
+
+    Attributes
+    ----------
+    indexes : dict
+        KnowledgeBaseBuilder with a loaded index per name, e.g. ``{'code': ..., 'docstring': ...}``
+    operation_weights : dict
+        weight of every index per operation; indexes missing from the weights of an operation are not queried
+    k : int
+        number of merged results returned
+    fetch_k : int
+        number of results fetched from every index before merging
+    shared_embeddings : bool
+        whether all indexes were built with the same embedding model; the query is then embedded only once
+    reranker : object or None
+        optional reranker, e.g. CrossEncoderReranker, reordering the merged candidates of all indexes
+    """
+
+    def __init__(self, indexes, operation_weights=None, k=3, fetch_k=None, shared_embeddings=True, reranker=None):
+        self.indexes = dict(indexes)
+        self.operation_weights = operation_weights or DEFAULT_OPERATION_WEIGHTS
+        self.k = k
+        self.fetch_k = fetch_k or 2 * k
+        self.shared_embeddings = shared_embeddings
+        self.reranker = reranker
+        self._executor = ThreadPoolExecutor(max_workers=len(self.indexes), thread_name_prefix='index-router')
+
+    def weights(self, operation=None):
+        """Weights of the indexes used for an operation; all indexes weigh the same for unknown operations."""
+        weights = {name: weight for name, weight in self.operation_weights.get(operation, {}).items()
+                   if name in self.indexes and weight > 0}
+        return weights or {name: 1.0 for name in self.indexes}
+
+    def search(self, query, operation=None, k=None, filters=None):
+        """
+        Search the indexes weighted for ``operation`` and return the merged ``(document, score)`` pairs, best first.
+        ``filters`` restrict every index to the matching documents, see ``KnowledgeBaseBuilder.search``. With a
+        reranker, the merged candidates are over-fetched and reordered by it, as in ``search_and_rerank``.
+        """
+        k = k or self.k
+        weights = self.weights(operation)
+        fetch_k = self.fetch_k
+        if self.reranker is not None:
+            candidates_k = max(getattr(self.reranker, 'max_candidates', 4 * k), k)
+            fetch_k = max(fetch_k, candidates_k)
+        vector = None
+        if self.shared_embeddings:
+            vector = self.indexes[next(iter(weights))].processor.embed_query(query)
+
+        def search(name):
+            if vector is not None:
+                return self.indexes[name].search_by_vector(vector, k=fetch_k, filters=filters)
+            return self.indexes[name].search(query, k=fetch_k, filters=filters)
+
+        results = dict(zip(weights, self._executor.map(search, weights)))
+
+        merged = {}
+        for name, weight in weights.items():
+            for document, relevance in self._normalize(results[name]):
+                key = item_key(document)
+                score = weight * relevance
+                if key not in merged:
+                    merged[key] = [document, 0.0, 0.0]
+                entry = merged[key]
+                # The text of the index contributing most is kept, the evidence of all indexes is summed.
+                if score > entry[2]:
+                    entry[0], entry[2] = document, score
+                entry[1] += score
+
+        ranked = sorted(merged.values(), key=lambda entry: entry[1], reverse=True)
+        if self.reranker is not None:
+            return self.reranker.rerank(query, [document for document, _, _ in ranked[:candidates_k]], k=k)
+        return [(document, score) for document, score, _ in ranked[:k]]
+
+    def as_retriever(self, operation=None, k=None, filters=None):
+        """Return a retriever over the merged results of an operation."""
+        return RouterRetriever(self, operation, k, filters)
+
+    @staticmethod
+    def _normalize(results):
+        if not results:
+            return []
+        distances = [float(distance) for _, distance in results]
+        low, high = min(distances), max(distances)
+        if high == low:
+            return [(document, 1.0) for document, _ in results]
+        return [(document, (high - distance) / (high - low)) for (document, _), distance in zip(results, distances)]
+
+
+class RouterRetriever:
+    """Retriever of one operation of an IndexRouter, with the ``invoke`` interface of the LangChain retrievers."""
+
+    def __init__(self, router, operation=None, k=None, filters=None):
+        self.router = router
+        self.operation = operation
+        self.k = k
+        self.filters = filters
+
+    def invoke(self, query):
+        return [document for document, _ in self.router.search(query, operation=self.operation, k=self.k,
+                                                                filters=self.filters)]
+
+    def get_relevant_documents(self, query):
+        return self.invoke(query)
@@ -0,0 +1,146 @@
+"""
+Registry of the compiled prompt templates.
+
+The templates of ``rag_prompts`` are validated and compiled into LangChain chat prompts once, when the registry is
+created, together with the token counts of their static prefixes. RagManager, ``kozak.py`` and the demo take their
+templates from ``default_registry()``::
+
+    registry = default_registry()
+    prompt = registry.chat_prompt('analyze')                 # few-shot variant
+    prompt = registry.chat_prompt('analyze', few_shot=False)  # compact variant
+"""
+import hashlib
+import re
+from functools import lru_cache
+
+from legacy_code_assistant.rag_integration.rag_prompts import QUESTION_TEMPLATE, TEMPLATES
+from legacy_code_assistant.utils.common_utils import count_tokens
+from legacy_code_assistant.utils.prompt_layout import chat_prompt, static_prefix
+
+_PLACEHOLDER = re.compile(r'(?<!{){(\w+)}(?!})')
+
+
+class CompiledTemplate:
+    """
+    A validated prompt template with its compiled few-shot and compact chat prompts.
+
+    Attributes
+    ----------
+    name : str
+        name of the template, e.g. ``analyze``
+    title : str
+        name of the template shown to users, e.g. ``Analyze``
+    version : int
+        version of the template, increased whenever its text changes
+    digest : str
+        hash of the text of the template, telling apart edits made without a new version
+    instructions : str
+        static instructions
+    examples : str
+        static few-shot examples; empty for templates without examples
+    variables_template : str
+        template of the last message, the only part with variables
+    variables : list
+        names of the variables of the template
+    """
+
+    def __init__(self, name, instructions, examples='', variables_template=QUESTION_TEMPLATE, title=None, version=1):
+        self.name = name
+        self.title = title or name
+        self.version = version
+        self.instructions = instructions
+        self.examples = examples
+        self.variables_template = variables_template
+        self.variables = sorted(set(_PLACEHOLDER.findall(variables_template)))
+        self._validate()
+
+        self.digest = hashlib.sha256('\0'.join((static_prefix(instructions, examples), variables_template))
+                                     .encode('utf-8')).hexdigest()[:12]
+        self._prefixes = {few_shot: static_prefix(instructions, examples, few_shot=few_shot)
+                          for few_shot in (True, False)}
+        self._prompts = {few_shot: chat_prompt(instructions, examples, variables_template, few_shot=few_shot)
+                         for few_shot in (True, False)}
+        self._prefix_tokens = {few_shot: count_tokens(prefix) for few_shot, prefix in self._prefixes.items()}
+
+    def _validate(self):
+        if not self.instructions.strip():
+            raise ValueError(f"Template '{self.name}' has no instructions.")
+        if not self.variables:
+            raise ValueError(f"Template '{self.name}' has no variables.")
+        for part in (self.instructions, self.examples):
+            leftover = [variable for variable in _PLACEHOLDER.findall(part) if variable in self.variables]
+            if leftover:
+                # A variable in the static part would be sent verbatim and change the cached prefix.
+                raise ValueError(f"Static part of template '{self.name}' contains the variables {leftover}.")
+
+    def label(self, few_shot=True):
+        """Name of a variant of the template in the token and prefix reports, e.g. ``analyze@v1:compact``."""
+        return f'{self.name}@v{self.version}' + ('' if few_shot else ':compact')
+
+    def chat_prompt(self, few_shot=True):
+        return self._prompts[bool(few_shot)]
+
+    def prefix(self, few_shot=True):
+        return self._prefixes[bool(few_shot)]
+
+    def prefix_tokens(self, few_shot=True):
+        return self._prefix_tokens[bool(few_shot)]
+
+    def text(self, few_shot=True):
+        """The whole template as one string, for callers formatting the prompt themselves."""
+        return '\n\n'.join((self.prefix(few_shot), self.variables_template))
+
+
+class TemplateRegistry:
+    """
+    Compiled prompt templates by name.
+
+    Attributes
+    ----------
+    templates : dict
+        CompiledTemplate by name
+    """
+
+    def __init__(self, templates=None):
+        self.templates = {}
+        for name, template in (TEMPLATES if templates is None else templates).items():
+            self.register(name, **template)
+
+    def register(self, name, instructions, examples='', variables_template=QUESTION_TEMPLATE, title=None,
+                 version=1):
+        """Validate and compile a template; raises ValueError for an invalid template or a duplicated name."""
+        if name in self.templates:
+            raise ValueError(f"Template '{name}' is already registered.")
+        self.templates[name] = CompiledTemplate(name, instructions, examples, variables_template, title=title,
+                                                version=version)
+        return self.templates[name]
+
+    def get(self, name):
+        if name not in self.templates:
+            raise ValueError(f"Unknown template '{name}'. Available templates: {', '.join(self.templates)}")
+        return self.templates[name]
+
+    def by_title(self, title):
+        for template in self.templates.values():
+            if template.title == title:
+                return template
+        raise ValueError(f"Unknown template title '{title}'.")
+
+    def chat_prompt(self, name, few_shot=True):
+        return self.get(name).chat_prompt(few_shot)
+
+    def titles(self):
+        return [template.title for template in self.templates.values()]
+
+    def describe(self):
+        """Return the name, title, version, digest and prefix token counts of every template."""
+        return [{'name': template.name, 'title': template.title, 'version': template.version,
+                 'digest': template.digest, 'prefix_tokens': template.prefix_tokens(True),
+                 'compact_prefix_tokens': template.prefix_tokens(False)}
+                for template in self.templates.values()]
+
+
+@lru_cache(maxsize=None)
+def default_registry():
+    """The registry of the templates of ``rag_prompts``, compiled on the first call and shared by the process."""
+    return TemplateRegistry()
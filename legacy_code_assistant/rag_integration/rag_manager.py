@@ -1,22 +1,21 @@
+from operator import itemgetter
 from pathlib import Path
 import yaml
 import os
-import pandas as pd
 import sys
 # from legacy_code_assistant.knowledge_base.description_generator import CodeConditionedGenerator
 from legacy_code_assistant.knowledge_base.knowledge_builder import KnowledgeBaseBuilder
 # from legacy_code_assistant.knowledge_base.knowledge_builder import CodeAnalyzer
-from langchain.embeddings import AzureOpenAIEmbeddings
 
-from legacy_code_assistant.rag_integration.rag_prompts import (
-    modifyPrompt, analyzePrompt, addPrompt, testPrompt, vulnerabilityPrompt)
+from legacy_code_assistant.rag_integration.external_data_fetcher import ContextFetcher
+from legacy_code_assistant.rag_integration.graph_expansion import GraphExpander
+from legacy_code_assistant.rag_integration.index_router import IndexRouter
+from legacy_code_assistant.rag_integration.prompt_registry import default_registry
+from legacy_code_assistant.utils.instrumentation import instrumentation
+from legacy_code_assistant.utils.prompt_layout import PrefixCacheTracker
+from legacy_code_assistant.utils.token_accounting import TokenAccountant
 
-from langchain.chat_models import AzureChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema.output_parser import StrOutputParser
-from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
-from langchain.vectorstores import FAISS
+# langchain and the Azure clients are imported when a RagManager is created, not when this module is imported.
 
 
 #   def getFunctionsDataFrame():
@@ -33,7 +32,13 @@ def format_docs(docs):
 
 
 class RagManager:
-    def __init__(self, filepath, index_name, credentials_filepath):
+    def __init__(self, filepath, index_name, credentials_filepath, external_retrievers=None,
+                 context_token_budget=3000, external_timeout=0.5, operation_weights=None, code_graph=None,
+                 graph_expansions=3, reranker=None, token_accountant=None, max_request_tokens=None,
+                 max_request_cost=None, few_shot=True, prompt_registry=None):
+        from langchain.chat_models import AzureChatOpenAI
+        from langchain.embeddings import AzureOpenAIEmbeddings
+
         with open(credentials_filepath, "r") as f:
             credentials = yaml.load(f, Loader=yaml.FullLoader)
         os.environ["AZURE_OPENAI_ENDPOINT"] = credentials['AZURE_OPENAI_ENDPOINT']
@@ -48,58 +53,149 @@ class RagManager:
             azure_deployment=credentials['Deployment_embeddings'],
             openai_api_version="2023-05-15",
         )
-        self.df = pd.read_csv(filepath)
-
-
-        self.kbb_docs = KnowledgeBaseBuilder(index_name=index_name, model=self.embeddings)
-        self.kbb_docs.load_index()
-        self.retriever = self.kbb_docs.get_retriever()
-
-
-    def _build_chain(self, template, question=None, context=None):
-        prompt = ChatPromptTemplate.from_template(template)
+        self.filepath = filepath
+        self._df = None
+        self._chains = {}
+
+        # Several indexes, e.g. {'code': 'code_based_index', 'docstring': 'docstring_based_index'}, are queried
+        # together by an IndexRouter, weighted per operation.
+        index_names = index_name if isinstance(index_name, dict) else {'default': index_name}
+        self.knowledge_bases = {}
+        for name, path in index_names.items():
+            self.knowledge_bases[name] = KnowledgeBaseBuilder(index_name=path, model=self.embeddings)
+            self.knowledge_bases[name].load_index()
+        self.kbb_docs = next(iter(self.knowledge_bases.values()))
+        # An optional CrossEncoderReranker reorders the over-fetched candidates of the code index, or the merged
+        # candidates of all indexes when there are several.
+        self.reranker = reranker
+        self.retriever = self.kbb_docs.get_retriever(reranker=reranker)
+        self.router = None
+        if len(self.knowledge_bases) > 1:
+            self.router = IndexRouter(self.knowledge_bases, operation_weights=operation_weights, reranker=reranker)
+
+        # The retrieved code items are followed by their callees, base classes and classes from the code graph,
+        # given as an AdjacencyIndex, a graph of CodeUsageGraphBuilder or the path of a saved AdjacencyIndex.
+        self.graph_expander = None
+        if code_graph is not None:
+            from legacy_code_assistant.knowledge_base.knowledge_graph.adjacency_index import AdjacencyIndex
+            if isinstance(code_graph, str):
+                code_graph = AdjacencyIndex.load(code_graph)
+            elif not isinstance(code_graph, AdjacencyIndex):
+                code_graph = AdjacencyIndex.from_graph(code_graph)
+            self.graph_expander = GraphExpander(code_graph, self.kbb_docs, max_expansions=graph_expansions)
+
+        # External sources (e.g. the local StackOverflow index) are queried next to the code index.
+        self.context_fetcher = None
+        if external_retrievers:
+            self.context_fetcher = ContextFetcher(self.retriever, external_retrievers,
+                                                  token_budget=context_token_budget, timeout=external_timeout)
+
+        # Every request is a job of the token accountant; a request whose prompt does not fit in the per-request
+        # budget raises TokenBudgetExceeded before the model is called.
+        self.token_accountant = token_accountant or TokenAccountant()
+        self.max_request_tokens = max_request_tokens
+        self.max_request_cost = max_request_cost
+
+        # The instructions and few-shot examples form a static prefix reused by the provider's prompt cache;
+        # operations called with few_shot=False send the compact prompt without the examples.
+        self.few_shot = few_shot
+        self.prefix_tracker = PrefixCacheTracker()
+        # The templates are validated and compiled when the registry is created, i.e. at startup.
+        self.prompts = prompt_registry or default_registry()
+
+    @property
+    def df(self):
+        """The code items of the index, read on first use."""
+        if self._df is None:
+            import pandas as pd
+            self._df = pd.read_csv(self.filepath)
+        return self._df
+
+    def _build_chain(self, prompt, question=None, context=None, operation=None):
+        from langchain.schema.output_parser import StrOutputParser
+        from langchain.schema.runnable import RunnableLambda
 
         if context is None:
+            retrieve_context = RunnableLambda(
+                lambda inputs: self._retrieve(inputs['question'], operation, inputs.get('filters')))
             chain = (
-                {"context": self.retriever | format_docs,
-                 "question": RunnablePassthrough()}
+                {"context": retrieve_context,
+                 "question": itemgetter('question')}
                 | prompt
                 | self.model
                 | StrOutputParser()
             )
         else:
             chain = (
-                {'context': RunnablePassthrough(), 
-                 "question": RunnablePassthrough()}
+                {'context': itemgetter('context'),
+                 "question": itemgetter('question')}
                 | prompt
                 | self.model
                 | StrOutputParser()
             )
         return chain
-    
-    def _run_chain(self, prompt_template, user_input, context=None):
-        chain = self._build_chain(prompt_template, context=context)
-        input_dict = {'question': user_input}
+
+    def _retrieve(self, question, operation=None, filters=None):
+        """Retrieve the context of a question, restricted to the code items matching ``filters`` if given."""
+        if self.router is not None:
+            retriever = self.router.as_retriever(operation, filters=filters)
+        elif filters:
+            retriever = self.kbb_docs.get_retriever(filters=filters, reranker=self.reranker)
+        else:
+            retriever = self.retriever
+        if self.graph_expander is not None:
+            retriever = self.graph_expander.as_retriever(retriever, filters=filters)
+        with instrumentation.timed('retrieval', operation=operation or ''):
+            if self.context_fetcher is not None:
+                return self.context_fetcher.fetch(question, code_retriever=retriever)
+            return format_docs(retriever.invoke(question))
+
+    def _run_chain(self, operation, user_input, context=None, filters=None, few_shot=None):
+        few_shot = self.few_shot if few_shot is None else few_shot
+        template = self.prompts.get(operation)
+        template_name = template.label(few_shot)
+        # Chains are built once per template; a long-lived manager then only pays for the model call.
+        key = (template_name, context is None)
+        chain = self._chains.get(key)
+        if chain is None:
+            self.token_accountant.register_template(template_name, static_tokens=template.prefix_tokens(few_shot))
+            chain = self._chains[key] = self._build_chain(template.chat_prompt(few_shot), context=context,
+                                                          operation=operation)
+        input_dict = {'question': user_input, 'filters': filters}
         if context is not None:
             input_dict['context'] = context
-        result = chain.invoke(input_dict)
+        # The callbacks time the model calls, count their tokens, enforce the budget of the request and track the
+        # reuse of the prompt prefix.
+        with instrumentation.timed(f'rag.{operation}'), \
+                self.token_accountant.job(operation, max_tokens=self.max_request_tokens,
+                                          max_cost=self.max_request_cost):
+            callbacks = [instrumentation.langchain_callback('llm'),
+                         self.token_accountant.langchain_callback(operation, template_name),
+                         self.prefix_tracker.langchain_callback(template_name)]
+            result = chain.invoke(input_dict, config={'callbacks': callbacks})
         return result
 
-    def analyze_code(self, user_input, context=None):
-        return self._run_chain(analyzePrompt, user_input, context=context)
+    def analyze_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._run_chain('analyze', user_input, context=context, filters=filters, few_shot=few_shot)
 
-    def add_code(self, user_input, context=None):
-        return self._run_chain(addPrompt, user_input, context=context)
+    def add_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._run_chain('add', user_input, context=context, filters=filters, few_shot=few_shot)
 
-    def modify_code(self, user_input, context=None):
-        return self._run_chain(modifyPrompt, user_input, context=context)
+    def modify_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._run_chain('modify', user_input, context=context, filters=filters, few_shot=few_shot)
 
-    def write_tests(self, user_input, context=None):
-        return self._run_chain(testPrompt, user_input, context=context)
+    def write_tests(self, user_input, context=None, filters=None, few_shot=None):
+        return self._run_chain('test', user_input, context=context, filters=filters, few_shot=few_shot)
 
-    def search_for_vulnerabilities(self, user_input, context=None):
-        return self._run_chain(vulnerabilityPrompt, user_input, context=context)
+    def search_for_vulnerabilities(self, user_input, context=None, filters=None, few_shot=None):
+        return self._run_chain('vulnerability', user_input, context=context, filters=filters, few_shot=few_shot)
     
-    def refactor_code(self, user_input):
-        raise NotImplementedError
+    def find_similar_code(self, source_code, k=5, filters=None):
+        """Return the indexed documents most similar to a piece of code, with their scores.
+
+        Code that is already in the index is looked up by its stored vector, without an embedding call."""
+        return self.kbb_docs.find_similar(source_code, k=k, filters=filters)
+
+    def refactor_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._run_chain('refactor', user_input, context=context, filters=filters, few_shot=few_shot)
     
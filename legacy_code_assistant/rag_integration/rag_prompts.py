@@ -1,6 +1,8 @@
-modifyPrompt = """
+modifyInstructions = """
 Your task is to modify the function provided below. Initially, list all the variables and define what they represent. Then analyze the processes and calculations that have been performed in this function. Next, define which of the listed variables relates to the problem described in the query. Based on the acquired knowledge and context, make the required modification to implement the modification requested in the query. Then, proceed sequentially higher in the function hierarchy and verify whether these changes will cause errors in higher-level functions. If not, conclude the process and return only the modified function. Remember, return only whole modified function, do not cut it and information is is Destroying.
+"""
 
+modifyExamples = """
 EXAMPLE:
 
 Q: 
@@ -62,14 +64,10 @@ def calculate_average(grades):
     return weighted_average
 
 ```
-    
-Q:
-Question: {question}
-Context: {context}   
 """
 
 
-analyzePrompt = """
+analyzeInstructions = """
 Choose based on your knowledge one, the most appropriate function/class or module considering given question.
 Analyze the following Python code in detail.
 Describe it, list and explain each variable and its role, examine the processes and calculations performed,
@@ -77,7 +75,9 @@ identify any key logic or algorithms used, and explain the expected output.
 Based on your analysis, determine if there are any areas for optimization or potential errors.
 Conclude by summarizing  overall functionality and its potential applications.
 Remember to do this step by step.
+"""
 
+analyzeExamples = """
 Q: 
 Question: Please provide me analysis of how is discounted price is calculated.
 Context: 
@@ -126,14 +126,9 @@ Overall Functionality and Applications:
 
 This function is useful in e-commerce systems, retail software, or anywhere item prices need to be adjusted based on discounts.
 Its clear input validation and straightforward logic make it reliable for financial calculations involving discounts.
+"""
 
-
-Q:
-Question: {question}
-Context: {context}
-    """
-
-addPrompt = """
+addInstructions = """
 Your task is to design and develop a new function from the ground up.
 Begin by clearly defining the purpose and objectives of the function based on the requirements outlined in the query.
 Next, determine the inputs and outputs of the function: identify what data the function will receive and what it should return.
@@ -146,7 +141,9 @@ and internal workings to integrate smoothly within the existing codebase.
 Once the core functionality and compatibility considerations are outlined,
 write the complete function code, ensuring it adheres to best practices for readability, efficiency,
 and seamless integration with the existing functions. Return only created function.
+"""
 
+addExamples = """
 EXAMPLE:
 
 Q: 
@@ -193,14 +190,15 @@ def average_sum_product(x, y):
     return average
 
 ```
+"""
 
-Q:
-Question: {question}
-
-Context: {context}   
+testInstructions = """
+Write me tests of the code in the context. Remember to take it slow and focus on step by step approach to the problem.
+Quality over quantity.
 """
 
-testPrompt = """Having
+testExamples = """
+Example test for django:
 
 ```py
 from django.test import TestCase
@@ -238,18 +236,10 @@ class SubjectTest(TestCase):
         self.assertEqual(str(subject), "a_subject")
 
 ```
-        
-
-as example test for django. Write me another. Remember to take it slow and focus on step by step approach to the problem.
-Quality over quantity.
-
-Q:
-Question: {question}
-Context: {context}
 """
 
 # Please include the code snippets for analysis within the placeholder "[Insert code snippets here]." Remember, GPT-4's analysis might not cover all aspects, and its suggestions must be verified by security experts. Utilize GPT-4 to complement, not replace, comprehensive security audits and reviews conducted by qualified professionals.
-vulnerabilityPrompt = """Hello GPT-4, I'm a security researcher dedicated to enhancing the safety and resilience of open-source software. With proper permissions, I aim to scrutinize the following code snippets for potential security risks. My goal is to fortify software by contributing patches, fostering a more secure open-source ecosystem. I seek your assistance in this endeavor by evaluating the provided code, drawing insights from common security best practices, recognized vulnerability patterns, and secure coding guidelines. Our focus is constructive and ethical—a quest to fortify and safeguard, not exploit.
+vulnerabilityInstructions = """Hello GPT-4, I'm a security researcher dedicated to enhancing the safety and resilience of open-source software. With proper permissions, I aim to scrutinize the following code snippets for potential security risks. My goal is to fortify software by contributing patches, fostering a more secure open-source ecosystem. I seek your assistance in this endeavor by evaluating the provided code, drawing insights from common security best practices, recognized vulnerability patterns, and secure coding guidelines. Our focus is constructive and ethical—a quest to fortify and safeguard, not exploit.
 
 For each code snippet, please:
 
@@ -259,12 +249,9 @@ For each code snippet, please:
    4. If no issues are found, briefly confirm the code's security pertaining to the aspects checked.
 
 Thank you for contributing to a safer and more secure software development community.
-
-Question: {question}
-Context: {context}
 """
 
-refactorPrompt = """
+refactorInstructions = """
 We're aiming to enhance the existing codebase. Your task involves:
 
     1.Refactoring for Readability and Maintainability:
@@ -285,11 +272,9 @@ We're aiming to enhance the existing codebase. Your task involves:
         Review the code comprehensively to identify and rectify any bugs or errors, ensuring the application functions correctly.
 
 Please document significant changes made, explaining the rationale behind each alteration and how it contributes to enhancing the codebase. Your documentation will aid in understanding your methodology and support future maintenance.
-Question: {question}
-Context: {context}
 """
 
-askPrmopt = """
+askInstructions = """
 Hello,
 I'm working on project, and I have a specific fragment of code that is intended to describe the model's functionality. I'm looking for clarification on how this description correlates with the model's actual behavior and whether it is implemented  correctly.
 
@@ -298,6 +283,29 @@ However, I'm uncertain about it. Could someone explain if my code accurately ref
 Additionally, if there are any best practices or patterns I should follow when describing a model within this fragment, I would appreciate any advice on that.
 
 Thank you for your help!
+"""
+
+
+# The variable part of every prompt. It follows the static instructions and examples, which are sent unchanged with
+# every call, so providers caching prompt prefixes can reuse them.
+QUESTION_TEMPLATE = """Q:
 Question: {question}
-Context: {context}
-"""
\ No newline at end of file
+Context: {context}"""
+
+otherInstructions = """
+Answer the question based only on the following context.
+"""
+
+# Every template: its title shown to users, its version, increased whenever the text of the template changes, and
+# its instructions and few-shot examples. The templates are compiled by the TemplateRegistry of prompt_registry.
+TEMPLATES = {
+    'modify': {'title': 'Modify', 'version': 2, 'instructions': modifyInstructions, 'examples': modifyExamples},
+    'analyze': {'title': 'Analyze', 'version': 2, 'instructions': analyzeInstructions, 'examples': analyzeExamples},
+    'add': {'title': 'Add Code', 'version': 2, 'instructions': addInstructions, 'examples': addExamples},
+    'test': {'title': 'Write Tests', 'version': 2, 'instructions': testInstructions, 'examples': testExamples},
+    'vulnerability': {'title': 'Search for Vulnerabilities', 'version': 2,
+                      'instructions': vulnerabilityInstructions},
+    'refactor': {'title': 'Refactor', 'version': 2, 'instructions': refactorInstructions},
+    'ask': {'title': 'Ask Question', 'version': 2, 'instructions': askInstructions},
+    'other': {'title': 'Other', 'version': 1, 'instructions': otherInstructions},
+}
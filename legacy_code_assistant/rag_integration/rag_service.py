@@ -0,0 +1,378 @@
+"""
+Long-lived RAG service.
+
+One process holds the loaded index, the embedding and chat clients (whose HTTP connections are pooled and reused)
+and the built chains, and answers requests of all callers. Callers either share a RagManager in-process through
+``get_rag_manager`` or talk to a running service through ``RagClient``.
+
+Usage::
+
+    python -m legacy_code_assistant.rag_integration.rag_service --data notebooks/generated_docstrings.csv \\
+        --index code=notebooks/code_based_index --index docstring=notebooks/docstring_based_index \\
+        --credentials credentials.yaml --port 8766
+    python -m legacy_code_assistant.rag_integration.rag_service ... --unix-socket /tmp/rag.sock
+
+and in the callers::
+
+    manager = RagClient('http://127.0.0.1:8766')      # or RagClient('unix:///tmp/rag.sock')
+    manager.analyze_code('What does the attendance view do?')
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import select
+import socket
+import threading
+import urllib.parse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from legacy_code_assistant.rag_integration.rag_manager import RagManager
+from legacy_code_assistant.utils.instrumentation import instrumentation
+from legacy_code_assistant.utils.token_accounting import TokenBudgetExceeded
+
+# Operations of RagManager exposed by the service.
+OPERATIONS = ('analyze_code', 'add_code', 'modify_code', 'write_tests', 'search_for_vulnerabilities',
+              'refactor_code', 'find_similar_code')
+RetrievedDocument = namedtuple('RetrievedDocument', ['page_content', 'metadata'])
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_rag_manager(filepath, index_name, credentials_filepath, **kwargs):
+    """
+    Returns the RagManager of an index shared by the whole process, creating it on the first call.
+
+    :param filepath: Path of the CSV with the code items of the index.
+    :param index_name: Path of the FAISS index, or a dictionary of named index paths queried together.
+    :param credentials_filepath: Path of the YAML file with the Azure credentials.
+    :param kwargs: Further arguments of RagManager, used when the manager is created.
+    :return: The shared RagManager.
+    """
+    index_names = index_name if isinstance(index_name, dict) else {'default': index_name}
+    key = (os.path.abspath(filepath), tuple((name, os.path.abspath(path)) for name, path in index_names.items()),
+           os.path.abspath(credentials_filepath))
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = RagManager(filepath, index_name, credentials_filepath, **kwargs)
+        return _managers[key]
+
+
+class RagService:
+    """
+    Serves a RagManager over HTTP/1.1 on a TCP port or a Unix socket.
+
+    ``POST /<operation>`` with ``{"question": ..., "context": ..., "filters": ..., "few_shot": ...}``
+    (``{"source_code": ..., "k": ..., "filters": ...}`` for ``find_similar_code``) returns ``{"result": ...}``.
+    Connections are kept alive. Requests are accepted by an asyncio loop and the blocking model calls run in a thread
+    pool, so many requests are answered concurrently. ``GET /metrics`` returns the stage timings and counters in the
+    Prometheus text format, ``GET /tokens`` the token and cost report of the manager, ``GET /prefixes`` the reuse of
+    the prompt prefixes and ``GET /prompts`` the versions of the prompt templates. A request over its token budget is
+    answered with 429.
+
+    Attributes
+    ----------
+    manager : RagManager
+        the manager answering the requests
+    unix_socket : str or None
+        path of the Unix socket; when None the service listens on ``host:port``
+    max_workers : int
+        maximal number of requests processed at the same time
+    requests : int
+        number of requests answered so far
+    """
+
+    def __init__(self, manager, host='127.0.0.1', port=8766, unix_socket=None, max_workers=16):
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.max_workers = max_workers
+        self.requests = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rag-service')
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._writers = set()
+
+    @property
+    def url(self):
+        if self.unix_socket is not None:
+            return f'unix://{self.unix_socket}'
+        return f'http://{self.host}:{self.port}'
+
+    def run(self):
+        """Serve until interrupted."""
+        asyncio.run(self._serve_forever())
+
+    def start(self):
+        """Serve from a background thread; returns once the service accepts connections."""
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start_server())
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._close_server())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        """Stop a service started with ``start``."""
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    async def _serve_forever(self):
+        await self._start_server()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self._close_server()
+
+    async def _start_server(self):
+        if self.unix_socket is not None:
+            if os.path.exists(self.unix_socket):
+                os.remove(self.unix_socket)
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=self.unix_socket)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _close_server(self):
+        self._server.close()
+        # Idle kept-alive connections would otherwise keep wait_closed waiting.
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while request_line := await reader.readline():
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self._dispatch(method, path, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if isinstance(payload, str):
+                    data, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    data, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+                writer.write((f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+                              f'Content-Type: {content_type}\r\n'
+                              f'Content-Length: {len(data)}\r\n'
+                              f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode('latin-1')
+                             + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, method, path, body):
+        operation = path.strip('/')
+        if method == 'GET' and operation == 'health':
+            return 200, {'status': 'ok', 'requests': self.requests}
+        if method == 'GET' and operation == 'metrics':
+            return 200, instrumentation.to_prometheus()
+        if method == 'GET' and operation == 'tokens' and getattr(self.manager, 'token_accountant', None):
+            return 200, self.manager.token_accountant.report()
+        if method == 'GET' and operation == 'prefixes' and getattr(self.manager, 'prefix_tracker', None):
+            return 200, self.manager.prefix_tracker.report()
+        if method == 'GET' and operation == 'prompts' and getattr(self.manager, 'prompts', None):
+            return 200, self.manager.prompts.describe()
+        if method != 'POST' or operation not in OPERATIONS:
+            return 404, {'error': f'Unknown operation: {method} {path}'}
+        try:
+            arguments = json.loads(body or b'{}')
+        except ValueError as e:
+            return 400, {'error': f'Invalid JSON: {e}'}
+        required = 'source_code' if operation == 'find_similar_code' else 'question'
+        if not isinstance(arguments, dict) or required not in arguments:
+            return 400, {'error': f'Missing argument: {required}'}
+
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._executor, self._call, operation, arguments)
+        except TokenBudgetExceeded as e:
+            return 429, {'error': str(e)}
+        except Exception as e:
+            print(f"Error occurred while processing {operation}: {e}")
+            return 500, {'error': repr(e)}
+        self.requests += 1
+        return 200, {'result': result}
+
+    def _call(self, operation, arguments):
+        if operation == 'find_similar_code':
+            return [{'page_content': doc.page_content, 'metadata': doc.metadata, 'score': float(score)}
+                    for doc, score in self.manager.find_similar_code(arguments['source_code'],
+                                                                     k=arguments.get('k', 5),
+                                                                     filters=arguments.get('filters'))]
+        return getattr(self.manager, operation)(arguments['question'], context=arguments.get('context'),
+                                                filters=arguments.get('filters'), few_shot=arguments.get('few_shot'))
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class RagClient:
+    """
+    Thin client of a RagService with the interface of RagManager.
+
+    Each thread keeps one connection open to the service and reuses it for its requests.
+
+    Attributes
+    ----------
+    url : str
+        ``http://host:port`` or ``unix:///path/to/socket``
+    timeout : float
+        request timeout in seconds
+    """
+
+    def __init__(self, url='http://127.0.0.1:8766', timeout=300):
+        self.url = url
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def analyze_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._post('analyze_code', {'question': user_input, 'context': context, 'filters': filters,
+                                           'few_shot': few_shot})
+
+    def add_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._post('add_code', {'question': user_input, 'context': context, 'filters': filters,
+                                       'few_shot': few_shot})
+
+    def modify_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._post('modify_code', {'question': user_input, 'context': context, 'filters': filters,
+                                          'few_shot': few_shot})
+
+    def write_tests(self, user_input, context=None, filters=None, few_shot=None):
+        return self._post('write_tests', {'question': user_input, 'context': context, 'filters': filters,
+                                          'few_shot': few_shot})
+
+    def search_for_vulnerabilities(self, user_input, context=None, filters=None, few_shot=None):
+        return self._post('search_for_vulnerabilities',
+                          {'question': user_input, 'context': context, 'filters': filters, 'few_shot': few_shot})
+
+    def refactor_code(self, user_input, context=None, filters=None, few_shot=None):
+        return self._post('refactor_code', {'question': user_input, 'context': context, 'filters': filters,
+                                            'few_shot': few_shot})
+
+    def find_similar_code(self, source_code, k=5, filters=None):
+        return [(RetrievedDocument(item['page_content'], item['metadata']), item['score'])
+                for item in self._post('find_similar_code', {'source_code': source_code, 'k': k, 'filters': filters})]
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and connection.sock is not None and \
+                select.select([connection.sock], [], [], 0)[0]:
+            # An idle kept-alive connection is only readable once the service closed it, e.g. after a restart.
+            self._close_connection()
+            connection = None
+        if connection is None:
+            if self.url.startswith('unix://'):
+                connection = _UnixHTTPConnection(self.url[len('unix://'):], self.timeout)
+            else:
+                parts = urllib.parse.urlsplit(self.url)
+                connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _close_connection(self):
+        self._local.connection.close()
+        self._local.connection = None
+
+    def _post(self, operation, payload):
+        body = json.dumps(payload).encode('utf-8')
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                break
+            except ConnectionError:
+                # Nothing was sent yet, so connecting once more cannot run the operation twice.
+                self._close_connection()
+                if attempt:
+                    raise
+        try:
+            connection.request('POST', f'/{operation}', body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = json.loads(response.read())
+        except (OSError, http.client.HTTPException):
+            # The request may have reached the service; operations are not idempotent, so it is not repeated.
+            self._close_connection()
+            raise
+        if response.status != 200:
+            raise RuntimeError(f"RAG service error {response.status}: {data.get('error')}")
+        return data['result']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a RagManager to many callers.')
+    parser.add_argument('--data', required=True, help='CSV with the code items of the index.')
+    parser.add_argument('--index', required=True, action='append',
+                        help='Path of the FAISS index; repeat as name=path to query several indexes together.')
+    parser.add_argument('--credentials', default='credentials.yaml')
+    parser.add_argument('--code-graph', default=None,
+                        help='Saved AdjacencyIndex of the code graph used to expand the retrieved code items.')
+    parser.add_argument('--max-request-tokens', type=int, default=None,
+                        help='Token budget of a request; requests over it are answered with 429.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--max-workers', type=int, default=16)
+    args = parser.parse_args()
+
+    index_name = args.index[0]
+    if len(args.index) > 1 or '=' in index_name:
+        index_name = dict(index.split('=', 1) for index in args.index)
+    manager = get_rag_manager(args.data, index_name, args.credentials, code_graph=args.code_graph,
+                              max_request_tokens=args.max_request_tokens)
+    service = RagService(manager, host=args.host, port=args.port, unix_socket=args.unix_socket,
+                         max_workers=args.max_workers)
+    print(f"Serving the RAG manager at {service.url}")
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import time
+
+DEFAULT_ENCODING = 'cl100k_base'
+# How long an encoding that could not be loaded is estimated before loading it is tried again.
+ENCODING_RETRY_SECONDS = 60
+
+_encodings = {}
+_failed_encodings = {}
+
+
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    """Return the tiktoken encoding, or None when tiktoken or its BPE file is not available.
+
+    Only a loaded encoding is kept; after a failure loading is tried again once ``ENCODING_RETRY_SECONDS`` passed."""
+    encoding = _encodings.get(encoding_name)
+    if encoding is not None:
+        return encoding
+    failed_at = _failed_encodings.get(encoding_name)
+    if failed_at is not None and time.monotonic() - failed_at < ENCODING_RETRY_SECONDS:
+        return None
+    try:
+        import tiktoken
+        encoding = _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+    except Exception:
+        # tiktoken downloads the encoding on first use, which fails on offline machines.
+        _failed_encodings[encoding_name] = time.monotonic()
+        return None
+    _failed_encodings.pop(encoding_name, None)
+    return encoding
+
+
+def count_tokens(text, encoding_name=DEFAULT_ENCODING):
+    """
+    Counts the tokens of a text as seen by the OpenAI models.
+
+    Falls back to an estimate of four characters per token when tiktoken cannot be used.
+
+    :param text: Text to measure.
+    :param encoding_name: Name of the tiktoken encoding.
+    :return: Number of tokens.
+    """
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
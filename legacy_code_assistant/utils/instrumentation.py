@@ -0,0 +1,243 @@
+"""
+Lightweight per-stage instrumentation of the extraction, indexing and RAG pipelines.
+
+Stages are timed with ``timed``, events and token usage are counted with ``count`` and ``record_tokens``, and the
+collected metrics are exported with ``to_json`` or ``to_prometheus``::
+
+    from legacy_code_assistant.utils.instrumentation import instrumentation
+
+    with instrumentation.timed('embed_documents'):
+        ...
+    print(instrumentation.to_prometheus())
+
+Optionally every timed stage is also an OpenTelemetry span (``enable_opentelemetry``) or is profiled with cProfile
+(``enable_profiling``, or the ``LCA_PROFILE_DIR`` environment variable), one ``.prof`` file per stage run. Timing
+installs no tracing hooks, so sampling profilers such as py-spy see the unmodified call stacks::
+
+    py-spy record -o profile.svg -- python build_knowledge_base.py manifest.yaml
+"""
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_DIR_VARIABLE = 'LCA_PROFILE_DIR'
+
+
+class Instrumentation:
+    """
+    Thread-safe registry of stage timings and counters.
+
+    Attributes
+    ----------
+    tracer : opentelemetry.trace.Tracer or None
+        tracer opening a span per timed stage; None when OpenTelemetry is not enabled
+    profile_dir : str or None
+        directory of the cProfile files of the profiled stages; None disables profiling
+    profile_stages : set or None
+        stages that are profiled; None profiles all stages
+    """
+
+    def __init__(self, profile_dir=None):
+        self.tracer = None
+        self.profile_dir = None
+        self.profile_stages = None
+        self._timings = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profile_runs = 0
+        self._callbacks = {}
+        if profile_dir:
+            self.enable_profiling(profile_dir)
+
+    @contextmanager
+    def timed(self, stage, **attributes):
+        """Time a block of code as one run of ``stage``; the attributes are set on the OpenTelemetry span."""
+        span = self.tracer.start_as_current_span(stage, attributes=attributes) if self.tracer else None
+        profiler = self._start_profiler(stage)
+        if span is not None:
+            span.__enter__()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(stage, time.perf_counter() - start)
+            if span is not None:
+                span.__exit__(None, None, None)
+            if profiler is not None:
+                self._stop_profiler(stage, profiler)
+
+    def record_time(self, stage, seconds):
+        """Record one run of ``stage`` that took ``seconds``."""
+        with self._lock:
+            timing = self._timings.get(stage)
+            if timing is None:
+                self._timings[stage] = [1, seconds, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = min(timing[2], seconds)
+                timing[3] = max(timing[3], seconds)
+
+    def count(self, name, value=1, **labels):
+        """Add ``value`` to the counter ``name`` with the given labels."""
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def record_tokens(self, stage, prompt_tokens=0, completion_tokens=0):
+        """Count the tokens sent to and received from a language model in ``stage``."""
+        if prompt_tokens:
+            self.count('llm_tokens', prompt_tokens, stage=stage, kind='prompt')
+        if completion_tokens:
+            self.count('llm_tokens', completion_tokens, stage=stage, kind='completion')
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+
+    def to_dict(self):
+        """Return the timings in seconds per stage and the counters."""
+        with self._lock:
+            timings = {stage: {'count': count, 'total_seconds': total, 'mean_seconds': total / count,
+                               'min_seconds': minimum, 'max_seconds': maximum}
+                       for stage, (count, total, minimum, maximum) in self._timings.items()}
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in self._counters.items()]
+        return {'timings': timings, 'counters': counters}
+
+    def to_json(self, path=None):
+        """Return the metrics as JSON, and write them to ``path`` if given."""
+        data = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(data)
+        return data
+
+    def to_prometheus(self, prefix='lca'):
+        """Return the metrics in the Prometheus text exposition format."""
+        metrics = self.to_dict()
+        lines = [f'# TYPE {prefix}_stage_seconds summary']
+        for stage, timing in sorted(metrics['timings'].items()):
+            labels = _prometheus_labels({'stage': stage})
+            lines.append(f"{prefix}_stage_seconds_count{labels} {timing['count']}")
+            lines.append(f"{prefix}_stage_seconds_sum{labels} {timing['total_seconds']:.9f}")
+        lines.append(f'# TYPE {prefix}_stage_seconds_max gauge')
+        for stage, timing in sorted(metrics['timings'].items()):
+            lines.append(f"{prefix}_stage_seconds_max{_prometheus_labels({'stage': stage})} "
+                         f"{timing['max_seconds']:.9f}")
+
+        names = sorted({counter['name'] for counter in metrics['counters']})
+        for name in names:
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines.append(f'# TYPE {metric} counter')
+            for counter in metrics['counters']:
+                if counter['name'] == name:
+                    lines.append(f"{metric}{_prometheus_labels(counter['labels'])} {counter['value']}")
+        return '\n'.join(lines) + '\n'
+
+    def enable_opentelemetry(self, tracer=None):
+        """
+        Open an OpenTelemetry span for every timed stage.
+
+        :param tracer: Tracer of the spans; by default the tracer of the globally configured provider.
+        :return: Whether OpenTelemetry could be enabled.
+        """
+        if tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError:
+                print("opentelemetry-api is not installed, spans are not recorded.")
+                return False
+            tracer = trace.get_tracer('legacy_code_assistant')
+        self.tracer = tracer
+        return True
+
+    def enable_profiling(self, directory, stages=None):
+        """Profile the runs of ``stages`` (all stages when None) with cProfile, writing one file per run."""
+        os.makedirs(directory, exist_ok=True)
+        self.profile_dir = directory
+        self.profile_stages = set(stages) if stages is not None else None
+
+    def disable_profiling(self):
+        self.profile_dir = None
+        self.profile_stages = None
+
+    def _start_profiler(self, stage):
+        # cProfile profilers cannot be nested, so only the outermost profiled stage of a thread is profiled.
+        if self.profile_dir is None or getattr(self._local, 'profiling', False):
+            return None
+        if self.profile_stages is not None and stage not in self.profile_stages:
+            return None
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler, e.g. of a debugger, is already active.
+            return None
+        self._local.profiling = True
+        return profiler
+
+    def _stop_profiler(self, stage, profiler):
+        profiler.disable()
+        self._local.profiling = False
+        with self._lock:
+            self._profile_runs += 1
+            run = self._profile_runs
+        stage_name = re.sub(r'[^\w.-]+', '_', stage)
+        profiler.dump_stats(os.path.join(self.profile_dir, f'{stage_name}-{os.getpid()}-{run}.prof'))
+
+    def langchain_callback(self, stage='llm'):
+        """Return a LangChain callback handler timing the model calls of ``stage`` and counting their tokens."""
+        with self._lock:
+            if stage not in self._callbacks:
+                self._callbacks[stage] = _make_callback_handler(self, stage)
+            return self._callbacks[stage]
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{label}="{value}"' for label, value in zip(labels, escaped)) + '}'
+
+
+def _make_callback_handler(instrumentation, stage):
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class InstrumentationCallbackHandler(BaseCallbackHandler):
+
+        def __init__(self):
+            self._starts = {}
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+            self._starts[run_id] = time.perf_counter()
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self._starts[run_id] = time.perf_counter()
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            start = self._starts.pop(run_id, None)
+            if start is not None:
+                instrumentation.record_time(stage, time.perf_counter() - start)
+            token_usage = (response.llm_output or {}).get('token_usage') or {}
+            instrumentation.record_tokens(stage, token_usage.get('prompt_tokens', 0),
+                                          token_usage.get('completion_tokens', 0))
+            instrumentation.count('llm_calls', stage=stage)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._starts.pop(run_id, None)
+            instrumentation.count('llm_errors', stage=stage)
+
+    return InstrumentationCallbackHandler()
+
+
+# Instrumentation shared by the whole process.
+instrumentation = Instrumentation(profile_dir=os.environ.get(PROFILE_DIR_VARIABLE))
@@ -0,0 +1,156 @@
+"""
+Prompt layout for provider-side prompt caching.
+
+Providers such as Azure OpenAI reuse the computation of a prompt prefix they have seen recently, provided it is
+byte-identical and at least ``MIN_CACHEABLE_PREFIX_TOKENS`` long. ``chat_prompt`` therefore sends the static
+instructions and few-shot examples as a system message that is the same for every call, and the variables only in
+the following human message. The compact variant leaves the examples out for latency-sensitive callers.
+
+``PrefixCacheTracker`` hashes the static messages of the prompts actually sent, so a template whose prefix changes
+between calls shows up as a low reuse rate.
+"""
+import hashlib
+import threading
+from functools import lru_cache
+
+from legacy_code_assistant.utils.common_utils import count_tokens
+from legacy_code_assistant.utils.instrumentation import instrumentation
+
+# Shortest prefix cached by the OpenAI models.
+MIN_CACHEABLE_PREFIX_TOKENS = 1024
+
+
+def static_prefix(instructions, examples='', few_shot=True):
+    """
+    Join the instructions and the few-shot examples of a prompt into its static prefix.
+
+    Surrounding blank lines and trailing whitespace of the lines are removed, so the prefix does not depend on how
+    the parts are written in the source.
+
+    :param instructions: Instructions of the prompt.
+    :param examples: Few-shot examples of the prompt.
+    :param few_shot: Whether the examples are included.
+    :return: The prefix.
+    """
+    parts = [instructions, examples] if few_shot and examples else [instructions]
+    return '\n\n'.join('\n'.join(line.rstrip() for line in part.strip().splitlines()) for part in parts)
+
+
+def chat_prompt(instructions, examples='', variables_template='{question}', few_shot=True):
+    """
+    Build a chat prompt whose static prefix is a system message and whose variables are in the last message.
+
+    :param variables_template: Template of the human message, the only part with variables.
+    :return: ChatPromptTemplate.
+    """
+    from langchain.prompts import ChatPromptTemplate
+
+    prefix = static_prefix(instructions, examples, few_shot=few_shot)
+    # The prefix is sent verbatim; braces of code examples must not be read as variables.
+    return ChatPromptTemplate.from_messages([('system', prefix.replace('{', '{{').replace('}', '}}')),
+                                             ('human', variables_template)])
+
+
+def prefix_hash(messages):
+    """Hash of the messages preceding the last one, i.e. of the static prefix of a chat prompt."""
+    digest = hashlib.sha256()
+    for message in messages[:-1]:
+        digest.update(message.type.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(str(message.content).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:16]
+
+
+class PrefixCacheTracker:
+    """
+    Counts how often the static prefix of the prompts of every template is sent again unchanged.
+
+    Attributes
+    ----------
+    encoding_name : str
+        tiktoken encoding used to measure the prefixes
+    """
+
+    def __init__(self, encoding_name='cl100k_base'):
+        self.encoding_name = encoding_name
+        self._prefixes = {}
+        self._cached_tokens = {}
+        self._lock = threading.Lock()
+
+    def record(self, template, messages):
+        """
+        Record the prefix of a prompt sent with ``template``.
+
+        :return: Whether the same prefix was sent before with this template.
+        """
+        key = prefix_hash(messages)
+        with self._lock:
+            prefixes = self._prefixes.setdefault(template, {})
+            reused = key in prefixes
+            if reused:
+                prefixes[key][0] += 1
+            else:
+                prefixes[key] = [1, None]
+        if not reused:
+            tokens = sum(count_tokens(str(message.content), self.encoding_name) for message in messages[:-1])
+            with self._lock:
+                prefixes[key][1] = tokens
+        instrumentation.count('prompt_prefix', template=template, result='reused' if reused else 'new')
+        return reused
+
+    def record_cached_tokens(self, template, tokens):
+        """Record the prompt tokens the provider reports as served from its cache."""
+        with self._lock:
+            self._cached_tokens[template] = self._cached_tokens.get(template, 0) + tokens
+        instrumentation.count('cached_prompt_tokens', tokens, template=template)
+
+    def reset(self):
+        with self._lock:
+            self._prefixes.clear()
+            self._cached_tokens.clear()
+
+    def report(self):
+        """
+        Return per template the calls, the distinct prefixes, the reuse rate and the prefix size in tokens.
+
+        ``cacheable`` tells whether the longest prefix is long enough to be cached by the provider.
+        """
+        with self._lock:
+            report = {}
+            for template, prefixes in self._prefixes.items():
+                calls = sum(count for count, _ in prefixes.values())
+                prefix_tokens = max((tokens or 0) for _, tokens in prefixes.values())
+                report[template] = {'calls': calls, 'prefixes': len(prefixes),
+                                    'reuse_rate': (calls - len(prefixes)) / calls,
+                                    'prefix_tokens': prefix_tokens,
+                                    'cacheable': prefix_tokens >= MIN_CACHEABLE_PREFIX_TOKENS,
+                                    'cached_tokens': self._cached_tokens.get(template, 0)}
+        return report
+
+    def langchain_callback(self, template):
+        """Return a LangChain callback handler recording the prompt prefixes of the model calls of ``template``."""
+        return _callback_handler_class()(self, template)
+
+
+@lru_cache(maxsize=None)
+def _callback_handler_class():
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class PrefixCacheCallbackHandler(BaseCallbackHandler):
+
+        def __init__(self, tracker, template):
+            self.tracker = tracker
+            self.template = template
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            for prompt in messages:
+                self.tracker.record(self.template, prompt)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            token_usage = (response.llm_output or {}).get('token_usage') or {}
+            cached_tokens = (token_usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+            if cached_tokens:
+                self.tracker.record_cached_tokens(self.template, cached_tokens)
+
+    return PrefixCacheCallbackHandler
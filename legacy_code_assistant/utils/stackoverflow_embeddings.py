@@ -1,53 +1,503 @@
 import json
 import lzma
-import xml.etree.ElementTree as ET
+import multiprocessing
+import os
+import queue
 from collections import namedtuple
-from typing import Mapping
+import faiss
 import numpy as np
+from lxml import etree
 from tqdm import tqdm
 
 ParamsTuple = namedtuple('ParamsTuple', ['stack_posts_path', 'stack_meta_path', 'vecs_path',
-                                         'min_techs_in_question'])
-
-
-def questions_iter(file):
-    context = ET.iterparse(file, events=("start", "end"))
-    context = iter(context)
-    event, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag == 'row' and elem.attrib['PostTypeId'] == '1':
-            tags = elem.attrib['Tags'][1:].replace('>', '').split('<')
-            yield elem.attrib['CreationDate'], tags
-            root.clear()
-
-
-def create_question_vecs(params):
-    with open(params.stack_meta_path, 'r') as f_obj:
-        metadata = json.load(f_obj)
-    questions_list = []
-    with tqdm(total=metadata['questions_count']) as pbar:
-        with lzma.open(params.stack_posts_path) as fin:
-            for question_ttl, question_tgs in questions_iter(fin):
-                questions_list.append(question_ttl)
+                                         'min_techs_in_question', 'techs', 'batch_size', 'shard_size'],
+                         defaults=(None, 64, 100_000))
+
+Question = namedtuple('Question', ['id', 'title', 'tags', 'creation_date'])
+
+SHARDS_MANIFEST = 'manifest.json'
+
+
+def parse_tags(tags):
+    """Split the Tags attribute, which is either '<python><django>' or '|python|django|'."""
+    if tags.startswith('|'):
+        return [tag for tag in tags.split('|') if tag]
+    return tags[1:].replace('>', '').split('<') if tags else []
+
+
+def _techs_filter(techs, min_techs_in_question):
+    if not techs and min_techs_in_question > 1:
+        raise ValueError(f"min_techs_in_question={min_techs_in_question} requires techs to count the tags against.")
+    return set(techs) if techs else None
+
+
+def _filter_question(attrib, techs, min_techs_in_question):
+    if attrib.get('PostTypeId') != '1':
+        return None
+    tags = parse_tags(attrib.get('Tags', ''))
+    if techs is not None and len(techs.intersection(tags)) < min_techs_in_question:
+        return None
+    return Question(attrib.get('Id'), attrib.get('Title', ''), tags, attrib.get('CreationDate'))
+
+
+def questions_iter(file, techs=None, min_techs_in_question=1):
+    """
+    Lazily yields the questions of a Posts.xml dump with bounded memory.
+
+    :param file: Path or binary file object of Posts.xml.
+    :param techs: Optional collection of tags; questions are kept only if they have enough of them.
+    :param min_techs_in_question: Minimal number of tags from ``techs`` a question needs; values above 1 raise
+        ValueError when ``techs`` is not given.
+    :return: Generator of Question tuples.
+    """
+    techs = _techs_filter(techs, min_techs_in_question)
+    for _, elem in etree.iterparse(file, events=('end',), tag='row'):
+        question = _filter_question(elem.attrib, techs, min_techs_in_question)
+        if question is not None:
+            yield question
+        # Free the element and the already processed siblings kept alive by the root.
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class VectorShardWriter:
+    """
+    Append-only writer of embedding vectors split into fixed-size ``.npy`` shards.
+
+    Every shard ``shard_00000.npy`` has a sidecar ``shard_00000.jsonl`` with one metadata line per vector.
+    ``manifest.json`` lists the completed shards with their row counts and is rewritten whenever a shard is
+    closed, so an interrupted run leaves a consistent prefix behind.
+    """
+
+    def __init__(self, directory, dim, shard_size=100_000, dtype='float32'):
+        self.directory = directory
+        self.dim = dim
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.shards = []
+        self._vectors = None
+        self._metadata = None
+        self._count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, vectors, metadata):
+        """Append a batch of vectors with one metadata dictionary per vector."""
+        vectors = np.asarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+        start = 0
+        while start < len(vectors):
+            if self._vectors is None:
+                self._open_shard()
+            stop = start + min(len(vectors) - start, self.shard_size - self._count)
+            self._vectors[self._count:self._count + stop - start] = vectors[start:stop]
+            for item in metadata[start:stop]:
+                self._metadata.write(json.dumps(item) + '\n')
+            self._count += stop - start
+            start = stop
+            if self._count == self.shard_size:
+                self._close_shard()
+
+    def close(self):
+        if self._vectors is not None:
+            self._close_shard()
+        self._write_manifest()
+
+    def _open_shard(self):
+        name = f'shard_{len(self.shards):05d}'
+        self._vectors = np.lib.format.open_memmap(os.path.join(self.directory, f'{name}.npy'), mode='w+',
+                                                  dtype=self.dtype, shape=(self.shard_size, self.dim))
+        self._metadata = open(os.path.join(self.directory, f'{name}.jsonl'), 'w')
+        self._count = 0
+
+    def _close_shard(self):
+        self._vectors.flush()
+        self._metadata.close()
+        name = f'shard_{len(self.shards):05d}'
+        self.shards.append({'vectors': f'{name}.npy', 'metadata': f'{name}.jsonl', 'count': self._count})
+        self._vectors, self._metadata = None, None
+        self._write_manifest()
+
+    def _write_manifest(self):
+        manifest = {'dim': self.dim, 'dtype': self.dtype, 'shards': self.shards}
+        tmp_path = os.path.join(self.directory, f'{SHARDS_MANIFEST}.tmp')
+        with open(tmp_path, 'w') as f_obj:
+            json.dump(manifest, f_obj)
+        os.replace(tmp_path, os.path.join(self.directory, SHARDS_MANIFEST))
+
+
+def questions_from_lines(lines, techs=None, min_techs_in_question=1):
+    """
+    Yields the questions of dump lines, each holding a single ``<row .../>`` element.
+
+    The dump stores one row per line, which lets independent workers parse arbitrary line ranges. ``techs`` and
+    ``min_techs_in_question`` filter the questions as in ``questions_iter``.
+    """
+    techs = _techs_filter(techs, min_techs_in_question)
+    for line in lines:
+        line = line.strip()
+        if line.startswith(b'<row'):
+            question = _filter_question(etree.fromstring(line).attrib, techs, min_techs_in_question)
+            if question is not None:
+                yield question
+
+
+def iter_vector_shards(directory):
+    """
+    Yields the shards written by ``VectorShardWriter`` without loading them into memory.
+
+    :param directory: Directory of the shards.
+    :return: Generator of (read-only memmap of vectors, path of the metadata file) tuples.
+    """
+    with open(os.path.join(directory, SHARDS_MANIFEST), 'r') as f_obj:
+        manifest = json.load(f_obj)
+    for shard in manifest['shards']:
+        vectors = np.load(os.path.join(directory, shard['vectors']), mmap_mode='r')[:shard['count']]
+        yield vectors, os.path.join(directory, shard['metadata'])
+
+
+def open_posts(path):
+    return lzma.open(path) if path.endswith('.xz') else open(path, 'rb')
+
+
+def create_question_vecs(params, embed_fn=None):
+    """
+    Streams the questions of the dump through the embedding model into vector shards.
+
+    :param params: ParamsTuple describing the input dump and output directory.
+    :param embed_fn: Callable mapping a list of titles to an array of vectors; CodeBERT by default.
+    """
+    if embed_fn is None:
+        from legacy_code_assistant.knowledge_base.embedding_processor import EmbeddingProcessor
+        embed_fn = EmbeddingProcessor().encode_batch
+
+    total = None
+    if params.stack_meta_path is not None:
+        with open(params.stack_meta_path, 'r') as f_obj:
+            total = json.load(f_obj).get('questions_count')
+
+    writer = None
+    batch = []
+
+    def flush():
+        nonlocal writer
+        vectors = np.asarray(embed_fn([question.title for question in batch]), dtype='float32')
+        if writer is None:
+            writer = VectorShardWriter(params.vecs_path, vectors.shape[1], params.shard_size)
+        writer.append(vectors, [question._asdict() for question in batch])
+        batch.clear()
+
+    with tqdm(total=total) as pbar:
+        with open_posts(params.stack_posts_path) as fin:
+            for question in questions_iter(fin, params.techs, params.min_techs_in_question):
+                batch.append(question)
+                if len(batch) == params.batch_size:
+                    flush()
                 pbar.update(1)
-    with open(params.vecs_path, 'w') as f_obj:
-        json.dump({'data': questions_list}, f_obj)
+        if batch:
+            flush()
+    if writer is None:
+        # No question matched; an empty manifest still marks the run as complete.
+        writer = VectorShardWriter(params.vecs_path, None, params.shard_size)
+    writer.close()
+
+
+def split_byte_ranges(path, parts):
+    """Split an uncompressed dump into byte ranges; workers align them to line boundaries."""
+    size = os.path.getsize(path)
+    bounds = [size * i // parts for i in range(parts + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
 
 
-def get_vecs_from_file(path: str) -> Mapping:
-    with open(path, 'r') as file_obj:
-        vecs = json.load(file_obj)
-    return vecs
+def _read_byte_range(path, start, end):
+    """Yield the lines starting inside [start, end) of a file."""
+    with open(path, 'rb') as fin:
+        if start > 0:
+            fin.seek(start - 1)
+            fin.readline()
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            yield line
+
+
+def _iter_task_lines(task):
+    kind = task[0]
+    if kind == 'chunk':
+        return task[1].splitlines()
+    if kind == 'range':
+        return _read_byte_range(*task[1:])
+    return open_posts(task[1])
+
+
+def _default_embed_factory():
+    from legacy_code_assistant.knowledge_base.embedding_processor import EmbeddingProcessor
+    return EmbeddingProcessor().encode_batch
+
+
+def _question_vecs_worker(tasks, shard_dir, params, embed_factory):
+    embed_fn = embed_factory()
+    writer = None
+    batch = []
+
+    def flush():
+        nonlocal writer
+        vectors = np.asarray(embed_fn([question.title for question in batch]), dtype='float32')
+        if writer is None:
+            writer = VectorShardWriter(shard_dir, vectors.shape[1], params.shard_size)
+        writer.append(vectors, [question._asdict() for question in batch])
+        batch.clear()
+
+    for task in iter(tasks.get, None):
+        lines = _iter_task_lines(task)
+        try:
+            for question in questions_from_lines(lines, params.techs, params.min_techs_in_question):
+                batch.append(question)
+                if len(batch) == params.batch_size:
+                    flush()
+        finally:
+            if hasattr(lines, 'close'):
+                lines.close()
+    if batch:
+        flush()
+    if writer is not None:
+        writer.close()
+
+
+def _put_task(tasks, task, processes, timeout=1.0):
+    """Puts a task on the bounded queue, raising RuntimeError instead of blocking forever once a worker failed."""
+    while True:
+        failed = [process.exitcode for process in processes if process.exitcode not in (None, 0)]
+        if failed:
+            for process in processes:
+                process.terminate()
+            # Do not wait for the queued tasks to be flushed to the workers that are gone.
+            tasks.cancel_join_thread()
+            raise RuntimeError(f"{len(failed)} worker(s) failed while processing the dump "
+                               f"(exit codes {failed}).")
+        try:
+            tasks.put(task, timeout=timeout)
+            return
+        except queue.Full:
+            continue
+
+
+def create_question_vecs_parallel(params, workers=None, input_shards=None, embed_factory=_default_embed_factory,
+                                  chunk_bytes=16 * 1024 * 1024, index_path=None):
+    """
+    Parses, filters and embeds the dump with several worker processes.
+
+    Work is split in one of three ways: ``input_shards`` (pre-split dump files, plain or ``.xz``) are processed
+    one file per task; an uncompressed dump is partitioned into byte ranges aligned to ``<row`` lines; an ``.xz``
+    dump is decompressed by this process and its lines are handed out in chunks of ``chunk_bytes``. Every
+    worker writes its own shard directory under ``params.vecs_path`` and ``merge_vector_shards`` joins them.
+    RuntimeError is raised as soon as a worker exits abnormally; the remaining workers are terminated.
+
+    :param params: ParamsTuple describing the input dump and output directory.
+    :param workers: Number of worker processes, all CPUs by default.
+    :param input_shards: Optional list of pre-split dump files.
+    :param embed_factory: Picklable callable run once per worker that returns the embedding function.
+    :param chunk_bytes: Size of the decompressed chunks handed to workers for ``.xz`` input.
+    :param index_path: If given, a FAISS index of all merged vectors is written there.
+    """
+    workers = workers or os.cpu_count()
+    tasks = multiprocessing.Queue(maxsize=workers * 2)
+    processes = [
+        multiprocessing.Process(target=_question_vecs_worker,
+                                args=(tasks, os.path.join(params.vecs_path, f'part_{i:05d}'), params, embed_factory))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    if input_shards:
+        for shard_path in input_shards:
+            _put_task(tasks, ('file', shard_path), processes)
+    elif not params.stack_posts_path.endswith('.xz'):
+        for start, end in split_byte_ranges(params.stack_posts_path, workers * 4):
+            _put_task(tasks, ('range', params.stack_posts_path, start, end), processes)
+    else:
+        with open_posts(params.stack_posts_path) as fin, tqdm(unit='B', unit_scale=True) as pbar:
+            remainder = b''
+            while block := fin.read(chunk_bytes):
+                block = remainder + block
+                cut = block.rfind(b'\n') + 1
+                remainder = block[cut:]
+                # Waits while all workers are busy, bounding the decompressed data held in memory.
+                _put_task(tasks, ('chunk', block[:cut]), processes)
+                pbar.update(len(block) - len(remainder))
+            if remainder:
+                _put_task(tasks, ('chunk', remainder), processes)
+
+    for _ in processes:
+        _put_task(tasks, None, processes)
+    for process in processes:
+        process.join()
+    failed = [process.exitcode for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"{len(failed)} worker(s) failed while processing the dump.")
+    merge_vector_shards(params.vecs_path, index_path)
+
+
+def merge_vector_shards(vecs_path, index_path=None):
+    """
+    Joins the shard directories of parallel workers into a single manifest in ``vecs_path``.
+
+    :param vecs_path: Directory containing the ``part_*`` shard directories.
+    :param index_path: If given, a FAISS index of all merged vectors is written there.
+    """
+    manifest = {'dim': None, 'dtype': None, 'shards': []}
+    # Workers that got no matching question write no shard directory, possibly leaving vecs_path uncreated.
+    os.makedirs(vecs_path, exist_ok=True)
+    for part in sorted(os.listdir(vecs_path)):
+        part_manifest_path = os.path.join(vecs_path, part, SHARDS_MANIFEST)
+        if not os.path.isfile(part_manifest_path):
+            continue
+        with open(part_manifest_path, 'r') as f_obj:
+            part_manifest = json.load(f_obj)
+        manifest['dim'], manifest['dtype'] = part_manifest['dim'], part_manifest['dtype']
+        for shard in part_manifest['shards']:
+            manifest['shards'].append({'vectors': f"{part}/{shard['vectors']}",
+                                       'metadata': f"{part}/{shard['metadata']}", 'count': shard['count']})
+    with open(os.path.join(vecs_path, SHARDS_MANIFEST), 'w') as f_obj:
+        json.dump(manifest, f_obj)
+
+    if index_path is not None and manifest['shards']:
+        derive_topics_from_vecs(vecs_path, index_path, manifest['dim'])
+
+
+def get_vecs_from_file(path: str) -> np.ndarray:
+    shards = [vectors for vectors, _ in iter_vector_shards(path)]
+    if not shards:
+        with open(os.path.join(path, SHARDS_MANIFEST), 'r') as f_obj:
+            manifest = json.load(f_obj)
+        return np.empty((0, manifest['dim'] or 0), dtype=manifest['dtype'] or 'float32')
+    return np.concatenate(shards)
+
+
+def iter_vector_batches(path_vecs, batch_size=65_536):
+    """Yields contiguous float32 batches of all shard vectors without materializing the whole set."""
+    for vectors, _ in iter_vector_shards(path_vecs):
+        for start in range(0, len(vectors), batch_size):
+            yield np.ascontiguousarray(vectors[start:start + batch_size], dtype='float32')
+
+
+def sample_vectors(path_vecs, sample_size, seed=0):
+    """Draws a uniform random sample of the shard vectors, reading only the sampled rows."""
+    shards = [vectors for vectors, _ in iter_vector_shards(path_vecs)]
+    total = sum(len(vectors) for vectors in shards)
+    if total == 0:
+        raise ValueError(f"There are no vectors in {path_vecs} to sample from.")
+    rng = np.random.default_rng(seed)
+    positions = np.sort(rng.choice(total, size=min(sample_size, total), replace=False))
+    sample, offset = [], 0
+    for vectors in shards:
+        in_shard = positions[(positions >= offset) & (positions < offset + len(vectors))] - offset
+        sample.append(np.asarray(vectors[in_shard], dtype='float32'))
+        offset += len(vectors)
+    return np.ascontiguousarray(np.concatenate(sample))
 
 
 def store_embeddings_to_file(index_faiss, path: str):
     faiss.write_index(index_faiss, path)
 
 
-def derive_topics_from_vecs(path_vecs: str, path_embeddings: str, dimensions: int) -> None:
-    vecs = get_vecs_from_file(path_vecs)
-    vecs_data = [vec for tech_ids in vecs['data'] for vec in tech_ids]
-    index = faiss.IndexFlatL2(len(vecs_data[0]))
-    vecs_data_faiss = np.asarray(vecs_data).astype('float32')
-    index.add(vecs_data_faiss)
+def derive_topics_from_vecs(path_vecs: str, path_embeddings: str, dimensions: int = None,
+                            batch_size: int = 65_536) -> None:
+    """
+    Builds a flat FAISS index of all shard vectors, adding them in batches.
+
+    :param path_vecs: Directory of the vector shards.
+    :param path_embeddings: Path the index is written to.
+    :param dimensions: Dimension of the vectors, needed to write an empty index; read from the vectors when None.
+    :param batch_size: Number of vectors added at once.
+    """
+    index = faiss.IndexFlatL2(dimensions) if dimensions else None
+    for batch in iter_vector_batches(path_vecs, batch_size):
+        if index is None:
+            index = faiss.IndexFlatL2(batch.shape[1])
+        index.add(batch)
+    if index is None:
+        raise ValueError(f"There are no vectors in {path_vecs}; pass their dimensions to write an empty index.")
     store_embeddings_to_file(index, path_embeddings)
+
+
+def build_ivf_index_from_shards(path_vecs, path_index, nlist=None, sample_size=None, batch_size=65_536,
+                                ivfdata_path=None):
+    """
+    Builds an IVF index over the vector shards without holding all vectors in memory.
+
+    The coarse quantizer is trained on a random sample; vectors are then added shard by shard in fixed-size
+    batches, keeping their position in the shards as id so search results map back to the shard metadata.
+    With ``ivfdata_path`` every shard is indexed into its own block file and the blocks are merged into
+    ``OnDiskInvertedLists``, so the inverted lists never have to fit in memory.
+
+    :param path_vecs: Directory of the vector shards.
+    :param path_index: Destination of the index.
+    :param nlist: Number of inverted lists, by default about 4 * sqrt(number of vectors).
+    :param sample_size: Number of training vectors, by default 64 per list.
+    :param batch_size: Number of vectors added per call.
+    :param ivfdata_path: If given, the inverted lists are stored on disk in this file.
+    """
+    with open(os.path.join(path_vecs, SHARDS_MANIFEST), 'r') as f_obj:
+        manifest = json.load(f_obj)
+    total = sum(shard['count'] for shard in manifest['shards'])
+    if total == 0:
+        raise ValueError(f"There are no vectors in {path_vecs}; an IVF index cannot be trained without them.")
+    nlist = nlist or max(1, min(int(4 * np.sqrt(total)), total // 39 or 1))
+    sample_size = sample_size or nlist * 64
+
+    quantizer = faiss.IndexFlatL2(manifest['dim'])
+    index = faiss.IndexIVFFlat(quantizer, manifest['dim'], nlist)
+    index.train(sample_vectors(path_vecs, sample_size))
+
+    if ivfdata_path is None:
+        offset = 0
+        for batch in iter_vector_batches(path_vecs, batch_size):
+            index.add_with_ids(batch, np.arange(offset, offset + len(batch), dtype='int64'))
+            offset += len(batch)
+        store_embeddings_to_file(index, path_index)
+        return
+
+    trained_path = f'{path_index}.trained'
+    store_embeddings_to_file(index, trained_path)
+    block_paths, offset = [], 0
+    for i, (vectors, _) in enumerate(iter_vector_shards(path_vecs)):
+        block = faiss.read_index(trained_path)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.ascontiguousarray(vectors[start:start + batch_size], dtype='float32')
+            block.add_with_ids(batch, np.arange(offset + start, offset + start + len(batch), dtype='int64'))
+        offset += len(vectors)
+        block_paths.append(f'{path_index}.block_{i:05d}')
+        store_embeddings_to_file(block, block_paths[-1])
+    merge_index_shards(block_paths, path_index, trained_path=trained_path, ivfdata_path=ivfdata_path)
+    for path in block_paths + [trained_path]:
+        os.remove(path)
+
+
+def merge_index_shards(block_paths, path_index, trained_path=None, ivfdata_path=None):
+    """
+    Merges IVF indexes built over separate shards into one index.
+
+    :param block_paths: Paths of IVF indexes sharing the same trained quantizer.
+    :param path_index: Destination of the merged index.
+    :param trained_path: Empty trained index; required for on-disk merging.
+    :param ivfdata_path: If given, the merged inverted lists are written to this file as ``OnDiskInvertedLists``,
+        otherwise the blocks are merged in memory with ``merge_from``.
+    """
+    if ivfdata_path is not None:
+        from faiss.contrib.ondisk import merge_ondisk
+
+        index = faiss.read_index(trained_path)
+        merge_ondisk(index, block_paths, ivfdata_path)
+    else:
+        index = faiss.read_index(block_paths[0])
+        for block_path in block_paths[1:]:
+            index.merge_from(faiss.read_index(block_path), 0)
+    store_embeddings_to_file(index, path_index)
@@ -0,0 +1,316 @@
+"""
+Token and cost accounting of the language model calls, with per-job budgets.
+
+The prompt of every call is counted with tiktoken before it is sent, so a call that would exceed the budget of the
+running job is refused instead of paid for. The completion is counted when it arrives. Totals are kept per operation
+and per prompt template, and ``report`` orders the templates by their spend::
+
+    accountant = TokenAccountant()
+    with accountant.job('docstrings', max_tokens=200000):
+        model(messages, callbacks=[accountant.langchain_callback('docstring_generation', 'docstringPrompt')])
+    print(accountant.format_report())
+"""
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+
+from legacy_code_assistant.utils.common_utils import DEFAULT_ENCODING, count_tokens
+from legacy_code_assistant.utils.instrumentation import instrumentation
+
+# USD per 1000 tokens of the gpt-35-turbo deployments.
+DEFAULT_PROMPT_PRICE = 0.0015
+DEFAULT_COMPLETION_PRICE = 0.002
+
+# Tokens added by the chat format to every message and to the reply, as counted by the OpenAI chat models.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+_PLACEHOLDER = re.compile(r'(?<!{){(\w+)}(?!})')
+
+
+class TokenBudgetExceeded(Exception):
+    """Raised before a model call that would exceed the token or cost budget of a job."""
+
+    def __init__(self, job, used, requested, limit, unit='tokens'):
+        self.job = job
+        self.used = used
+        self.requested = requested
+        self.limit = limit
+        self.unit = unit
+        super().__init__(f"Budget of job '{job}' exceeded: {used:g} {unit} used, {requested:g} requested, "
+                         f"limit {limit:g} {unit}")
+
+
+class TokenBudget:
+    """
+    Tokens and cost spent by one job, e.g. one RAG request or one docstring generation run.
+
+    Attributes
+    ----------
+    name : str
+        name of the job, shown in the TokenBudgetExceeded message
+    max_tokens : int or None
+        maximal number of prompt and completion tokens of the job; None is unlimited
+    max_cost : float or None
+        maximal cost of the job in USD; None is unlimited
+    prompt_tokens : int
+        prompt tokens spent so far
+    completion_tokens : int
+        completion tokens spent so far
+    cost : float
+        cost spent so far in USD
+    """
+
+    def __init__(self, name, max_tokens=None, max_cost=None):
+        self.name = name
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def check(self, prompt_tokens, prompt_cost=0.0):
+        """Raise TokenBudgetExceeded if a prompt of ``prompt_tokens`` does not fit in the rest of the budget."""
+        if self.max_tokens is not None and self.total_tokens + prompt_tokens > self.max_tokens:
+            raise TokenBudgetExceeded(self.name, self.total_tokens, prompt_tokens, self.max_tokens)
+        if self.max_cost is not None and self.cost + prompt_cost > self.max_cost:
+            raise TokenBudgetExceeded(self.name, self.cost, prompt_cost, self.max_cost, unit='USD')
+
+    def add(self, prompt_tokens, completion_tokens, cost):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += cost
+
+
+class TokenAccountant:
+    """
+    Counts the tokens of the language model calls and enforces the budgets of the running jobs.
+
+    Attributes
+    ----------
+    prompt_price : float
+        USD per 1000 prompt tokens
+    completion_price : float
+        USD per 1000 completion tokens
+    encoding_name : str
+        tiktoken encoding of the model
+    calls : collections.deque
+        the last ``max_calls`` calls, as dictionaries with the operation, template, tokens, cost and duration
+    """
+
+    def __init__(self, prompt_price=DEFAULT_PROMPT_PRICE, completion_price=DEFAULT_COMPLETION_PRICE,
+                 encoding_name=DEFAULT_ENCODING, max_calls=1000):
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.encoding_name = encoding_name
+        self.calls = deque(maxlen=max_calls)
+        self._operations = {}
+        self._templates = {}
+        self._template_tokens = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def count_text(self, text):
+        return count_tokens(text, self.encoding_name)
+
+    def count_messages(self, messages):
+        """Count the prompt tokens of chat messages, including the tokens added by the chat format."""
+        return sum(TOKENS_PER_MESSAGE + self.count_text(_message_text(message)) for message in messages) + \
+            TOKENS_PER_REPLY
+
+    def cost(self, prompt_tokens=0, completion_tokens=0):
+        return (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1000
+
+    def register_template(self, name, template=None, static_tokens=None):
+        """
+        Count the static tokens of a prompt template, i.e. the tokens sent with every call whatever its variables.
+
+        :param name: Name of the template in the report.
+        :param template: Template string with ``{variable}`` placeholders.
+        :param static_tokens: Static tokens of the template if already counted, e.g. by the TemplateRegistry.
+        :return: Number of static tokens.
+        """
+        with self._lock:
+            if name in self._template_tokens:
+                return self._template_tokens[name]
+        tokens = static_tokens if static_tokens is not None else self.count_text(_PLACEHOLDER.sub('', template))
+        with self._lock:
+            self._template_tokens[name] = tokens
+        return tokens
+
+    @contextmanager
+    def job(self, name, max_tokens=None, max_cost=None):
+        """
+        Account the calls of a block of code to a job with a budget.
+
+        Jobs can be nested; a call is then checked against the budgets of all enclosing jobs of the thread.
+
+        :return: The TokenBudget of the job.
+        """
+        budget = TokenBudget(name, max_tokens=max_tokens, max_cost=max_cost)
+        stack = self._budgets()
+        stack.append(budget)
+        try:
+            yield budget
+        finally:
+            stack.remove(budget)
+
+    def _budgets(self):
+        if not hasattr(self._local, 'budgets'):
+            self._local.budgets = []
+        return self._local.budgets
+
+    def check(self, prompt_tokens, budgets=None):
+        """Raise TokenBudgetExceeded if a prompt of ``prompt_tokens`` does not fit in a budget of the running jobs."""
+        prompt_cost = self.cost(prompt_tokens)
+        for budget in (self._budgets() if budgets is None else budgets):
+            budget.check(prompt_tokens, prompt_cost)
+
+    def record(self, operation, template, prompt_tokens, completion_tokens, seconds=None, budgets=None):
+        """
+        Record one model call.
+
+        :param operation: Operation that made the call, e.g. ``analyze``.
+        :param template: Name of the prompt template of the call, or None.
+        :param prompt_tokens: Tokens of the prompt.
+        :param completion_tokens: Tokens of the completion.
+        :param seconds: Duration of the call.
+        :param budgets: Budgets charged with the call; by default those of the running jobs of the thread.
+        :return: Cost of the call in USD.
+        """
+        cost = self.cost(prompt_tokens, completion_tokens)
+        for budget in (self._budgets() if budgets is None else budgets):
+            budget.add(prompt_tokens, completion_tokens, cost)
+        with self._lock:
+            for totals, key in ((self._operations, operation), (self._templates, template)):
+                if key is None:
+                    continue
+                total = totals.setdefault(key, [0, 0, 0, 0.0])
+                total[0] += 1
+                total[1] += prompt_tokens
+                total[2] += completion_tokens
+                total[3] += cost
+            self.calls.append({'operation': operation, 'template': template, 'prompt_tokens': prompt_tokens,
+                               'completion_tokens': completion_tokens, 'cost': cost, 'seconds': seconds})
+        labels = {'operation': operation, 'template': template or ''}
+        instrumentation.count('estimated_tokens', prompt_tokens, kind='prompt', **labels)
+        instrumentation.count('estimated_tokens', completion_tokens, kind='completion', **labels)
+        instrumentation.count('estimated_cost_usd', cost, **labels)
+        return cost
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self._operations.clear()
+            self._templates.clear()
+
+    def report(self):
+        """
+        Return the spend in total, per operation and per template.
+
+        The templates are ordered by cost, most expensive first. ``static_share`` is the part of the prompt tokens
+        of a template taken by its static text, i.e. what trimming the template would save.
+        """
+        with self._lock:
+            operations = {operation: _totals(*total) for operation, total in self._operations.items()}
+            templates = []
+            for name, total in self._templates.items():
+                entry = _totals(*total)
+                static_tokens = self._template_tokens.get(name)
+                entry['template'] = name
+                entry['static_tokens'] = static_tokens
+                entry['static_share'] = (static_tokens * total[0] / total[1]
+                                         if static_tokens is not None and total[1] else None)
+                templates.append(entry)
+        total = _totals(sum(entry['calls'] for entry in operations.values()),
+                        sum(entry['prompt_tokens'] for entry in operations.values()),
+                        sum(entry['completion_tokens'] for entry in operations.values()),
+                        sum(entry['cost'] for entry in operations.values()))
+        for entry in templates:
+            entry['cost_share'] = entry['cost'] / total['cost'] if total['cost'] else 0.0
+        templates.sort(key=lambda entry: entry['cost'], reverse=True)
+        return {'total': total, 'operations': operations, 'templates': templates}
+
+    def format_report(self):
+        """Return the report as a table of the templates, most expensive first."""
+        report = self.report()
+        lines = [f"{'template':24s} {'calls':>6s} {'prompt':>9s} {'completion':>10s} {'cost USD':>9s} "
+                 f"{'share':>6s} {'static':>7s}"]
+        for entry in report['templates']:
+            static = f"{entry['static_share']:7.0%}" if entry['static_share'] is not None else f"{'-':>7s}"
+            lines.append(f"{entry['template']:24s} {entry['calls']:6d} {entry['prompt_tokens']:9d} "
+                         f"{entry['completion_tokens']:10d} {entry['cost']:9.4f} {entry['cost_share']:6.0%} {static}")
+        total = report['total']
+        lines.append(f"{'total':24s} {total['calls']:6d} {total['prompt_tokens']:9d} "
+                     f"{total['completion_tokens']:10d} {total['cost']:9.4f}")
+        return '\n'.join(lines)
+
+    def langchain_callback(self, operation, template=None):
+        """
+        Return a LangChain callback handler accounting the model calls of ``operation`` made with ``template``.
+
+        The handler is bound to the jobs running when it is created, so it can be passed to calls made from other
+        threads. A call exceeding a budget is stopped by TokenBudgetExceeded before it is sent.
+        """
+        return _callback_handler_class()(self, operation, template, list(self._budgets()))
+
+
+def _totals(calls, prompt_tokens, completion_tokens, cost):
+    return {'calls': calls, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens, 'cost': cost}
+
+
+def _message_text(message):
+    content = getattr(message, 'content', message)
+    if isinstance(content, list):
+        # Multi-part messages; only the text parts are counted.
+        return ''.join(part if isinstance(part, str) else part.get('text', '') for part in content)
+    return str(content)
+
+
+@lru_cache(maxsize=None)
+def _callback_handler_class():
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class TokenAccountingCallbackHandler(BaseCallbackHandler):
+        # Exceptions of other handlers are only logged by LangChain; a budget has to stop the call.
+        raise_error = True
+
+        def __init__(self, accountant, operation, template, budgets):
+            self.accountant = accountant
+            self.operation = operation
+            self.template = template
+            self.budgets = budgets
+            self._starts = {}
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self._start(run_id, sum(self.accountant.count_messages(prompt) for prompt in messages))
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+            self._start(run_id, sum(self.accountant.count_text(prompt) for prompt in prompts))
+
+        def _start(self, run_id, prompt_tokens):
+            self.accountant.check(prompt_tokens, self.budgets)
+            self._starts[run_id] = (prompt_tokens, time.perf_counter())
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            prompt_tokens, start = self._starts.pop(run_id, (0, None))
+            completion_tokens = sum(self.accountant.count_text(generation.text)
+                                    for generations in response.generations for generation in generations)
+            self.accountant.record(self.operation, self.template, prompt_tokens, completion_tokens,
+                                   seconds=time.perf_counter() - start if start is not None else None,
+                                   budgets=self.budgets)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._starts.pop(run_id, None)
+
+    return TokenAccountingCallbackHandler
@@ -1,9 +1,14 @@
 import os
+import subprocess
 
 import git
+import pytest
 
-from data_extraction.data_extractor import extract_code_files, extract_commit_history, extract_documentation
-from data_extraction.repository_cloner import clone_repository
+from data_extraction.blob_reader import GitBlobReader
+from data_extraction.data_extractor import (commit_history_to_columns, extract_code_and_documentation,
+                                            extract_code_files, extract_commit_history, extract_documentation,
+                                            iter_commit_history, iter_commit_pages, scan_repository)
+from data_extraction.repository_cloner import clone_repository, get_mirror_path
 
 
 def test_clone_repository_success(mocker):
@@ -41,3 +46,160 @@ def test_extract_commit_history_failure(mocker):
     mocker.patch("git.Repo", side_effect=Exception("Error occurred while extracting commit history"))
     commits = extract_commit_history("tests/test_repo")
     assert commits == []
+
+
+def _make_git_repo(path):
+    def run(*args):
+        subprocess.run(['git', *args], cwd=path, check=True, capture_output=True)
+
+    run('init', '-q')
+    run('config', 'user.email', 'author@example.com')
+    run('config', 'user.name', 'Author')
+    (path / 'module.py').write_text('def first():\n    pass\n')
+    run('add', '.')
+    run('commit', '-q', '-m', 'first')
+    (path / 'module.py').write_text('def first():\n    return 1\n')
+    (path / 'README.md').write_text('readme\n')
+    run('add', '.')
+    run('commit', '-q', '-m', 'second')
+
+
+def _blob_sha(repo_path, spec):
+    return subprocess.run(['git', 'rev-parse', spec], cwd=repo_path, capture_output=True, text=True).stdout.strip()
+
+
+def test_blob_reader_reads_many_blobs(tmp_path):
+    _make_git_repo(tmp_path)
+    old_sha, new_sha = _blob_sha(tmp_path, 'HEAD~1:module.py'), _blob_sha(tmp_path, 'HEAD:module.py')
+    with GitBlobReader(str(tmp_path)) as reader:
+        contents = reader.read_many([old_sha, new_sha, 'f' * 40])
+        assert reader.read_text(new_sha) == 'def first():\n    return 1\n'
+    assert contents == {old_sha: b'def first():\n    pass\n', new_sha: b'def first():\n    return 1\n',
+                        'f' * 40: None}
+
+
+def test_blob_reader_commit_range_blobs(tmp_path):
+    _make_git_repo(tmp_path)
+    with GitBlobReader(str(tmp_path)) as reader:
+        blobs = reader.commit_range_blobs('HEAD~1..HEAD', paths=['*.py'])
+        reader.prefetch(blobs)
+        assert set(blobs) == {_blob_sha(tmp_path, 'HEAD~1:module.py'), _blob_sha(tmp_path, 'HEAD:module.py')}
+        assert all(sha in reader._cache for sha in blobs)
+
+
+@pytest.fixture
+def bare_repo(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    _make_git_repo(source)
+    bare = tmp_path / 'bare.git'
+    subprocess.run(['git', 'clone', '-q', '--bare', str(source), str(bare)], check=True)
+    subprocess.run(['git', 'config', 'uploadpack.allowFilter', 'true'], cwd=bare, check=True)
+    return bare.as_uri()
+
+
+def test_clone_repository_shallow(bare_repo, tmp_path):
+    repo = clone_repository(bare_repo, str(tmp_path / 'clone'), depth=1, single_branch=True)
+    assert len(list(repo.iter_commits())) == 1
+
+
+def test_clone_repository_sparse_partial(bare_repo, tmp_path):
+    destination = tmp_path / 'clone'
+    repo = clone_repository(bare_repo, str(destination), partial=True, sparse_paths=['*.py'])
+    assert repo.git.config('remote.origin.partialclonefilter') == 'blob:none'
+    assert (destination / 'module.py').exists()
+    assert not (destination / 'README.md').exists()
+
+
+def test_clone_repository_mirror_cache(bare_repo, tmp_path):
+    cache_dir = tmp_path / 'mirrors'
+    first = clone_repository(bare_repo, str(tmp_path / 'first'), mirror_cache_dir=str(cache_dir))
+    mirror_path = get_mirror_path(bare_repo, str(cache_dir))
+    assert os.path.isdir(mirror_path)
+    assert first.remote().url == bare_repo
+
+    first.git.config('user.email', 'author@example.com')
+    first.git.config('user.name', 'Author')
+    first.git.commit('--allow-empty', '-m', 'third')
+    first.git.push('origin', 'HEAD')
+
+    second = clone_repository(bare_repo, str(tmp_path / 'second'), mirror_cache_dir=str(cache_dir))
+    assert len(list(second.iter_commits())) == 3
+    assert os.listdir(cache_dir) == [os.path.basename(mirror_path)]
+
+
+def _make_tree(root):
+    for relative_path, content in {
+        'pkg/module.py': 'x = 1\n',
+        'pkg/README.md': 'docs\n',
+        'pkg/generated.py': 'y = 2\n',
+        'pkg/keep.log.txt': 'kept\n',
+        'node_modules/lib/index.py': 'z = 3\n',
+        '.venv/lib/site.py': 'w = 4\n',
+        'out/artifact.py': 'v = 5\n',
+        'big.py': '#' * 2048,
+        '.gitignore': 'generated.py\nout/\n*.txt\n!keep.log.txt\n',
+    }.items():
+        path = root / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+
+def test_scan_repository_prunes_and_honours_gitignore(tmp_path):
+    _make_tree(tmp_path)
+    code_files, doc_files = extract_code_and_documentation(str(tmp_path), max_file_size=1024)
+    assert sorted(os.path.relpath(path, tmp_path) for path in code_files) == [os.path.join('pkg', 'module.py')]
+    assert sorted(os.path.relpath(path, tmp_path) for path in doc_files) == [
+        os.path.join('pkg', 'README.md'), os.path.join('pkg', 'keep.log.txt')]
+
+
+def test_scan_repository_uses_git_ls_files(tmp_path):
+    _make_tree(tmp_path)
+    subprocess.run(['git', 'init', '-q'], cwd=tmp_path, check=True)
+    files = dict((os.path.relpath(path, tmp_path), kind)
+                 for kind, path in scan_repository(str(tmp_path), max_file_size=1024))
+    assert files == {os.path.join('pkg', 'module.py'): 'code', os.path.join('pkg', 'README.md'): 'doc',
+                     os.path.join('pkg', 'keep.log.txt'): 'doc'}
+
+
+def test_scan_repository_gitignore_character_classes(tmp_path):
+    for name in ('moda.py', 'modb.py', 'xa.py', 'x!.py', 'xb.py'):
+        (tmp_path / name).write_text('x = 1\n')
+    (tmp_path / '.gitignore').write_text('mod[!a].py\nx[a!].py\n')
+    code_files = [os.path.relpath(path, tmp_path) for kind, path in scan_repository(str(tmp_path)) if kind == 'code']
+    assert sorted(code_files) == ['moda.py', 'xb.py']
+
+
+def test_scan_repository_without_gitignore(tmp_path):
+    _make_tree(tmp_path)
+    code_files = [path for kind, path in scan_repository(str(tmp_path), use_gitignore=False, max_file_size=None)
+                  if kind == 'code']
+    assert sorted(os.path.relpath(path, tmp_path) for path in code_files) == sorted([
+        os.path.join('out', 'artifact.py'), 'big.py', os.path.join('pkg', 'generated.py'),
+        os.path.join('pkg', 'module.py')])
+
+
+def test_iter_commit_history_filters(tmp_path):
+    _make_git_repo(tmp_path)
+    assert [c['message'] for c in iter_commit_history(str(tmp_path))] == ['second', 'first']
+    assert [c['message'] for c in iter_commit_history(str(tmp_path), paths=['README.md'])] == ['second']
+    assert [c['message'] for c in iter_commit_history(str(tmp_path), max_count=1, skip=1)] == ['first']
+
+
+def test_iter_commit_pages_resumes_from_cursor(tmp_path):
+    _make_git_repo(tmp_path)
+    pages = iter_commit_pages(str(tmp_path), page_size=1)
+    first_page, cursor = next(pages)
+    assert [c['message'] for c in first_page] == ['second']
+
+    resumed = list(iter_commit_pages(str(tmp_path), page_size=1, cursor=cursor))
+    assert [[c['message'] for c in page] for page, _ in resumed] == [['first'], []]
+    assert resumed[-1][1] is None
+
+
+def test_commit_history_to_columns(tmp_path):
+    _make_git_repo(tmp_path)
+    columns = commit_history_to_columns(iter_commit_history(str(tmp_path)))
+    assert list(columns['author']) == ['Author', 'Author']
+    assert columns['date'].dtype == 'datetime64[s]'
+    assert list(columns['message']) == ['second', 'first']
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Packages that take seconds to import; the entry points must only load them when a feature needs them.
+HEAVY_PACKAGES = {'langchain', 'langchain_community', 'langchain_core', 'openai', 'faiss', 'torch', 'transformers',
+                  'onnxruntime', 'matplotlib', 'pandas', 'lxml'}
+IMPORT_BUDGET_SECONDS = 0.5
+
+ENTRY_POINTS = [
+    'legacy_code_assistant.knowledge_base.knowledge_graph.code_extractor',
+    'legacy_code_assistant.knowledge_base.knowledge_graph.parse_cache',
+    'legacy_code_assistant.knowledge_base.knowledge_graph.code_graph',
+    'legacy_code_assistant.knowledge_base.knowledge_builder',
+    'legacy_code_assistant.knowledge_base.description_generator',
+    'legacy_code_assistant.rag_integration.external_data_fetcher',
+    'legacy_code_assistant.rag_integration.rag_manager',
+    'legacy_code_assistant.rag_integration.rag_service',
+    'legacy_code_assistant.data_extraction.data_extractor',
+]
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter and return the cumulative ``-X importtime`` seconds per module."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_PATH, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=PROJECT_PATH,
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+@pytest.mark.parametrize('module', ENTRY_POINTS)
+def test_entry_point_imports_lazily(module):
+    times = import_times(module)
+
+    heavy = sorted({name.split('.')[0] for name in times} & HEAVY_PACKAGES)
+    assert not heavy, f'{module} imports {heavy} at module level'
+    assert times[module] < IMPORT_BUDGET_SECONDS
@@ -0,0 +1,519 @@
+import importlib.util
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from build_knowledge_base import IngestionPipeline
+from knowledge_base.embedding_cache import CachedEmbeddings
+from knowledge_base.embedding_server import EmbeddingClient, EmbeddingServer
+from knowledge_base.knowledge_builder import KnowledgeBaseBuilder
+from knowledge_base.knowledge_graph.adjacency_index import AdjacencyIndex
+from knowledge_base.knowledge_graph.code_graph import CodeUsageGraphBuilder
+from knowledge_base.knowledge_graph.parse_cache import ParseCache, git_blob_sha
+from knowledge_base.metadata_table import MetadataTable
+from knowledge_base.retrieval_evaluation import LabelledQuery, build_query_set, evaluate
+
+SAMPLE_CODE = '''
+class Base:
+    pass
+
+
+class Child(Base):
+    def method(self):
+        helper()
+
+
+def helper():
+    return 1
+'''
+
+
+def test_git_blob_sha_matches_git(tmp_path):
+    path = tmp_path / 'sample.py'
+    path.write_bytes(SAMPLE_CODE.encode('utf-8'))
+    expected = subprocess.run(['git', 'hash-object', str(path)], capture_output=True, text=True).stdout.strip()
+    assert git_blob_sha(SAMPLE_CODE) == expected
+
+
+def test_parse_cache_reuses_parsed_content():
+    cache = ParseCache()
+    classes, functions, module = cache.extract_all(SAMPLE_CODE, file_path='a.py')
+    classes_again, _, _ = cache.extract_all(SAMPLE_CODE, file_path='b.py')
+
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert set(classes) == {'Base', 'Child'}
+    assert classes['Child'].bases == ['Base']
+    assert classes['Child'].functions['method'].usage == {'helper': 1}
+    assert functions['helper'].lineno == 11
+    assert classes['Child'].file_path == 'a.py'
+    assert classes_again['Child'].file_path == 'b.py'
+
+
+def test_parse_cache_lru_eviction():
+    cache = ParseCache(max_entries=1)
+    cache.extract_all(SAMPLE_CODE)
+    cache.extract_all('x = 1\n')
+    assert len(cache) == 1
+    assert git_blob_sha(SAMPLE_CODE) not in cache
+
+
+def test_parse_cache_disk_tier(tmp_path):
+    ParseCache(cache_dir=str(tmp_path)).extract_all(SAMPLE_CODE)
+    cache = ParseCache(cache_dir=str(tmp_path))
+    classes, functions, _ = cache.extract_all(SAMPLE_CODE)
+    assert (cache.misses, cache.hits) == (0, 1)
+    assert set(functions) == {'helper'}
+    assert classes['Child'].functions['method'].end_lineno == 8
+
+
+def test_adjacency_index_scores_by_edge_weight_and_distance(tmp_path):
+    graph_builder = CodeUsageGraphBuilder(SAMPLE_CODE)
+    graph_builder.analyze_file()
+    index = AdjacencyIndex.from_graph(graph_builder.graph)
+
+    scores = index.expand({'Child': 1.0})
+    assert scores == pytest.approx({'Base': 0.8, 'Child.method': 0.6, 'helper': 0.3})
+    assert index.expand({'Child': 1.0}, max_depth=1, min_score=0.7) == pytest.approx({'Base': 0.8})
+    # Followed against their direction, edges are damped.
+    assert index.expand({'helper': 1.0}, max_depth=1) == pytest.approx({'Child.method': 0.5})
+
+    index.save(tmp_path / 'graph.json')
+    assert AdjacencyIndex.load(tmp_path / 'graph.json').neighbours == index.neighbours
+
+
+class CountingEmbeddings(Embeddings):
+    """Deterministic embeddings counting the calls made to the model."""
+
+    def __init__(self):
+        self.query_calls = 0
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.query_calls += 1
+        return self._embed(text)
+
+    @staticmethod
+    def _embed(text):
+        return [float(len(text)), float(text.count('def')), float(text.count('return')), 1.0]
+
+
+def test_cached_embeddings_lru():
+    model = CountingEmbeddings()
+    cache = CachedEmbeddings(model, max_entries=2)
+    cache.embed_query('a')
+    cache.embed_query('a')
+    assert model.query_calls == 1 and cache.hits == 1
+
+    cache.embed_query('b')
+    cache.embed_query('c')
+    assert 'a' not in cache and len(cache) == 2
+    cache.embed_query('a')
+    assert model.query_calls == 4
+
+
+def test_find_similar_reuses_stored_vector():
+    model = CountingEmbeddings()
+    kbb = KnowledgeBaseBuilder(model=model, model_name='counting')
+    df = pd.DataFrame({
+        'code': ['def a():\n    return 1', 'def b():\n    return 2', 'class C:\n    pass'],
+        'name': ['a', 'b', 'C'],
+    })
+    kbb.upload_df_to_faiss(df, 'code')
+
+    results = kbb.find_similar('def a():\n    return 1', k=1)
+    assert model.query_calls == 0
+    assert [doc.metadata['name'] for doc, _ in results] == ['b']
+    # The stored vector seeded the query cache.
+    assert kbb.search('def a():\n    return 1', k=1)[0][0].metadata['name'] == 'a'
+    assert model.query_calls == 0
+
+    doc_id = kbb.vectorstore.index_to_docstore_id[2]
+    assert list(kbb.get_vector(doc_id)) == CountingEmbeddings._embed('class C:\n    pass')
+    assert kbb.get_vector('missing') is None
+
+    kbb.search('def unknown(): pass')
+    kbb.search('def unknown(): pass')
+    assert model.query_calls == 1
+
+
+def test_metadata_table_select():
+    table = MetadataTable([
+        {'file': 'app/views.py', 'module': 'views', 'type': 'class'},
+        {'file': 'app/views.py', 'module': 'views', 'type': 'method'},
+        {'file': 'app/models.py', 'module': 'models', 'type': 'class'},
+    ])
+    assert list(table.select({'module': 'views'})) == [0, 1]
+    assert list(table.select({'type': ['class', 'function']})) == [0, 2]
+    assert list(table.select({'file_contains': 'models', 'type': 'class'})) == [2]
+    assert list(table.select({'module': 'missing'})) == []
+
+    table.append([{'module': 'models', 'type': 'method'}])
+    assert list(table.select({'module': 'models'})) == [2, 3]
+    with pytest.raises(ValueError):
+        table.select({'colour': 'red'})
+
+
+def test_filtered_search_only_returns_matching_documents():
+    model = CountingEmbeddings()
+    kbb = KnowledgeBaseBuilder(model=model, model_name='counting')
+    df = pd.DataFrame({
+        'code': ['def a():\n    return 1', 'def b():\n    return 2', 'class C:\n    pass', 'def d(): return 4'],
+        'name': ['a', 'b', 'C', 'd'],
+        'module': ['views', 'views', 'models', 'models'],
+        'type': ['function', 'function', 'class', 'function'],
+    })
+    kbb.upload_df_to_faiss(df, 'code')
+
+    results = kbb.search('def a():\n    return 1', k=3, filters={'module': 'models'})
+    assert sorted(doc.metadata['name'] for doc, _ in results) == ['C', 'd']
+    assert results == sorted(results, key=lambda result: result[1])
+
+    similar = kbb.find_similar('def a():\n    return 1', k=3, filters={'type': 'function'})
+    assert [doc.metadata['name'] for doc, _ in similar][:1] == ['b']
+    assert {doc.metadata['name'] for doc, _ in similar} == {'b', 'd'}
+    assert kbb.search('x', filters={'module': 'missing'}) == []
+    assert [doc.metadata['name'] for doc in kbb.get_retriever(filters={'type': 'class'}).invoke('x')] == ['C']
+
+    kbb.upload_df_to_faiss(df.assign(name=df['name'] + '2', module='forms'), 'code')
+    assert {doc.metadata['name'] for doc, _ in kbb.search('x', k=10, filters={'module': 'forms'})} == {
+        'a2', 'b2', 'C2', 'd2'}
+
+
+def _commit_files(path, files, message, amend=False):
+    """Write ``files`` into the git repository at ``path``, created if needed, and commit them."""
+    def run(*args):
+        subprocess.run(['git', *args], cwd=path, check=True, capture_output=True)
+
+    if not (path / '.git').exists():
+        path.mkdir(exist_ok=True)
+        run('init', '-q')
+        run('config', 'user.email', 'author@example.com')
+        run('config', 'user.name', 'Author')
+    for name, content in files.items():
+        (path / name).write_text(content)
+    run('add', '.')
+    run('commit', '-q', '-m', message, *(['--amend'] if amend else []))
+
+
+def _make_bare_repo(tmp_path, files):
+    source = tmp_path / 'source'
+    _commit_files(source, files, 'first')
+    bare = tmp_path / 'bare.git'
+    subprocess.run(['git', 'clone', '-q', '--bare', str(source), str(bare)], check=True)
+    return bare.as_uri()
+
+
+def test_ingestion_pipeline_indexes_repositories(tmp_path):
+    url = _make_bare_repo(tmp_path, {'module.py': SAMPLE_CODE, 'broken.py': 'def broken(:\n'})
+    manifest = {'workdir': str(tmp_path / 'repos'),
+                'repos': [{'name': 'good', 'url': url},
+                          {'name': 'missing', 'url': (tmp_path / 'missing.git').as_uri()}]}
+    kbb = KnowledgeBaseBuilder(index_name=str(tmp_path / 'index'), model=CountingEmbeddings())
+
+    report = IngestionPipeline(manifest, knowledge_base=kbb, clone_workers=2, parse_workers=2).run()
+
+    assert report['clone']['items'] == 1 and report['clone']['errors'] == 1
+    # The broken file fails alone; the other file of the same parse task is indexed.
+    assert report['parse']['items'] == 2 and report['parse']['errors'] == 1
+    documents = kbb.vectorstore.docstore._dict.values()
+    assert {'Base', 'Child', 'helper'} <= {doc.metadata['name'] for doc in documents}
+    assert {(doc.metadata['repo'], doc.metadata['file']) for doc in documents} == {('good', 'module.py')}
+    assert (tmp_path / 'index' / 'index.faiss').exists()
+
+
+def test_ingestion_pipeline_without_indexed_items(tmp_path, capsys):
+    manifest = {'workdir': str(tmp_path / 'repos'),
+                'repos': [{'name': 'missing', 'url': (tmp_path / 'missing.git').as_uri()}]}
+    kbb = KnowledgeBaseBuilder(index_name=str(tmp_path / 'index'), model=CountingEmbeddings())
+
+    report = IngestionPipeline(manifest, knowledge_base=kbb, parse_workers=1).run()
+    IngestionPipeline({'workdir': str(tmp_path / 'repos'), 'repos': []}, knowledge_base=kbb, parse_workers=1).run()
+
+    assert report['clone']['errors'] == 1 and report['embed']['items'] == 0
+    assert capsys.readouterr().out.count('Nothing indexed') == 2
+    assert not (tmp_path / 'index').exists()
+
+
+@pytest.fixture(scope='module')
+def github_graph_demo():
+    """The DEMO 1 module, loaded from its file since the demo directory is not a package."""
+    pytest.importorskip('streamlit')
+    path = os.path.join(os.path.dirname(__file__), '..', 'demo', 'github_graph_DEMO_1_GIF.py')
+    spec = importlib.util.spec_from_file_location('github_graph_demo', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _head(repo_path):
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_path, capture_output=True, text=True).stdout.strip()
+
+
+def _update_commit_graph(demo, repo_path, state_path):
+    """Update the commit graph saved at ``state_path``, recording the revisions whose commits were read."""
+    analyzer = demo.RepoAnalyzer(str(repo_path))
+    revisions = []
+    get_repo_commits = analyzer.get_repo_commits
+    analyzer.get_repo_commits = lambda rev=None: revisions.append(rev) or get_repo_commits(rev)
+    graph, counts = analyzer.update_commit_dependency_graph(str(state_path), analyzer.get_repo_files_metadata())
+    return graph, counts, revisions
+
+
+def _full_commit_graph(demo, repo_path):
+    analyzer = demo.RepoAnalyzer(str(repo_path))
+    return analyzer.build_commit_dependency_graph(analyzer.get_repo_commits(), analyzer.get_repo_files_metadata())
+
+
+def _graph_snapshot(graph):
+    return dict(graph.nodes(data=True)), sorted(graph.edges(data='type'))
+
+
+def test_commit_graph_state_reused_without_new_commits(github_graph_demo, tmp_path):
+    repo_path, state_path = tmp_path / 'repo', tmp_path / '.cache' / 'commit_graph.pkl'
+    _commit_files(repo_path, {'school.py': SAMPLE_CODE}, 'first')
+
+    graph, counts, revisions = _update_commit_graph(github_graph_demo, repo_path, state_path)
+    assert revisions == [None] and state_path.exists()
+
+    cached_graph, cached_counts, revisions = _update_commit_graph(github_graph_demo, repo_path, state_path)
+    assert revisions == []
+    assert _graph_snapshot(cached_graph) == _graph_snapshot(graph)
+    assert dict(cached_counts) == dict(counts)
+
+
+def test_commit_graph_state_extended_with_appended_commits(github_graph_demo, tmp_path):
+    repo_path, state_path = tmp_path / 'repo', tmp_path / '.cache' / 'commit_graph.pkl'
+    _commit_files(repo_path, {'school.py': SAMPLE_CODE}, 'first')
+    _update_commit_graph(github_graph_demo, repo_path, state_path)
+    saved_head = _head(repo_path)
+    _commit_files(repo_path, {'school.py': SAMPLE_CODE.replace('return 1', 'return 2')}, 'second')
+    _commit_files(repo_path, {'other.py': 'class Other:\n    pass\n'}, 'third')
+
+    graph, counts, revisions = _update_commit_graph(github_graph_demo, repo_path, state_path)
+
+    assert revisions == [f'{saved_head}..{_head(repo_path)}']
+    full_graph, full_counts = _full_commit_graph(github_graph_demo, repo_path)
+    assert _graph_snapshot(graph) == _graph_snapshot(full_graph)
+    assert dict(counts) == dict(full_counts)
+
+
+def test_commit_graph_rebuilt_after_rewritten_history(github_graph_demo, tmp_path):
+    repo_path, state_path = tmp_path / 'repo', tmp_path / '.cache' / 'commit_graph.pkl'
+    _commit_files(repo_path, {'school.py': SAMPLE_CODE}, 'first')
+    _commit_files(repo_path, {'school.py': SAMPLE_CODE.replace('return 1', 'return 2')}, 'second')
+    _update_commit_graph(github_graph_demo, repo_path, state_path)
+    rewritten_head = _head(repo_path)
+    _commit_files(repo_path, {'other.py': 'class Other:\n    pass\n'}, 'second, amended', amend=True)
+
+    graph, counts, revisions = _update_commit_graph(github_graph_demo, repo_path, state_path)
+
+    assert revisions == [None]
+    assert rewritten_head not in graph
+    assert _graph_snapshot(graph) == _graph_snapshot(_full_commit_graph(github_graph_demo, repo_path)[0])
+
+
+def test_commit_graph_rebuilt_after_class_added_to_graphed_file(github_graph_demo, tmp_path):
+    repo_path, state_path = tmp_path / 'repo', tmp_path / '.cache' / 'commit_graph.pkl'
+    _commit_files(repo_path, {'school.py': SAMPLE_CODE}, 'first')
+    _update_commit_graph(github_graph_demo, repo_path, state_path)
+    _commit_files(repo_path, {'school.py': SAMPLE_CODE + '\n\nclass Extra:\n    pass\n'}, 'second')
+
+    graph, counts, revisions = _update_commit_graph(github_graph_demo, repo_path, state_path)
+
+    # The class nodes of the first commit depend on the classes of school.py, so the history is read again.
+    assert revisions == [None]
+    full_graph, full_counts = _full_commit_graph(github_graph_demo, repo_path)
+    assert _graph_snapshot(graph) == _graph_snapshot(full_graph)
+    assert dict(counts) == dict(full_counts)
+    assert counts['class_school.py_Extra'] == 2
+
+
+class SlowEncoder:
+    """Encoder with a fixed cost per forward pass, like a model on CPU."""
+
+    def encode_batch(self, texts):
+        time.sleep(0.05)
+        return [CountingEmbeddings._embed(text) for text in texts]
+
+
+def test_embedding_server_batches_concurrent_requests():
+    texts = [f'def f{i}():\n    return {i}' for i in range(24)]
+    with EmbeddingServer(SlowEncoder(), workers=2, max_batch_size=8, max_wait_ms=20, port=0) as server:
+        client = EmbeddingClient(server.url)
+        with ThreadPoolExecutor(max_workers=len(texts)) as executor:
+            vectors = list(executor.map(client.embed_query, texts))
+        documents = client.embed_documents(texts[:3])
+
+    assert vectors == [CountingEmbeddings._embed(text) for text in texts]
+    assert documents == vectors[:3]
+    assert server.texts == len(texts) + 3
+    assert server.batches < len(texts)
+
+
+class DyingEncoder:
+    """Encoder whose worker process exits while encoding the text ``die``."""
+
+    def encode_batch(self, texts):
+        if 'die' in texts:
+            os._exit(1)
+        return [CountingEmbeddings._embed(text) for text in texts]
+
+
+def test_embedding_server_fails_requests_of_dead_workers():
+    with EmbeddingServer(DyingEncoder(), workers=2, max_wait_ms=1, port=0, timeout=10) as server:
+        with pytest.raises(RuntimeError, match='died'):
+            server.embed(['die'])
+        # The surviving worker keeps serving.
+        assert server.embed(['def f(): pass']) == [CountingEmbeddings._embed('def f(): pass')]
+        with pytest.raises(RuntimeError, match='died'):
+            server.embed(['die'])
+        start = time.monotonic()
+        with pytest.raises(RuntimeError, match='All embedding workers have died'):
+            server.embed(['def f(): pass'])
+        assert time.monotonic() - start < 5
+
+
+def test_embedding_server_skips_workers_that_died_while_idle():
+    with EmbeddingServer(DyingEncoder(), workers=2, max_wait_ms=1, port=0, timeout=10) as server:
+        assert server.embed(['x']) == [CountingEmbeddings._embed('x')]
+        server._processes[0].kill()
+        server._processes[0].join()
+        # Let the reaper mark the worker as dead while its index is still in the idle queue.
+        time.sleep(1)
+        start = time.monotonic()
+        for text in ('a', 'b', 'c'):
+            assert server.embed([text]) == [CountingEmbeddings._embed(text)]
+        assert time.monotonic() - start < 5
+
+
+@pytest.fixture(scope='module')
+def tiny_model_path(tmp_path_factory):
+    """A small random BERT saved locally, so no model has to be downloaded."""
+    transformers = pytest.importorskip('transformers')
+    path = tmp_path_factory.mktemp('tiny-bert')
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', 'def', 'return', 'class', 'self', 'x', '(', ')', ':',
+             '=', '1', '+', 'f', 'g', 'pass', 'import']
+    (path / 'vocab.txt').write_text('\n'.join(vocab))
+    transformers.BertTokenizer(str(path / 'vocab.txt')).save_pretrained(path)
+    config = transformers.BertConfig(vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2,
+                                     num_attention_heads=2, intermediate_size=64)
+    transformers.BertModel(config).save_pretrained(path)
+    return str(path)
+
+
+def _cosine(a, b):
+    return (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def test_onnx_embeddings_match_pytorch(tiny_model_path, tmp_path):
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('torch')
+    from knowledge_base.embedding_processor import EmbeddingProcessor
+    from knowledge_base.onnx_embedding_processor import OnnxEmbeddingProcessor
+
+    texts = ['def f(x): return x + 1', 'class g: pass', 'import x', 'x = 1']
+    expected = EmbeddingProcessor(tiny_model_path).encode_batch(texts)
+
+    onnx_vectors = OnnxEmbeddingProcessor(tiny_model_path, onnx_dir=str(tmp_path), num_threads=1).encode_batch(texts)
+    assert onnx_vectors.shape == expected.shape
+    assert _cosine(onnx_vectors, expected).min() > 0.9999
+
+    int8_processor = OnnxEmbeddingProcessor(tiny_model_path, quantize=True, onnx_dir=str(tmp_path))
+    assert int8_processor.onnx_path.endswith('model.int8.onnx')
+    assert _cosine(int8_processor.encode_batch(texts), expected).min() > 0.95
+
+
+class SimpleDocument:
+    def __init__(self, page_content, metadata=None):
+        self.page_content = page_content
+        self.metadata = metadata or {}
+
+
+@pytest.fixture(scope='module')
+def tiny_cross_encoder_path(tiny_model_path, tmp_path_factory):
+    transformers = pytest.importorskip('transformers')
+    path = tmp_path_factory.mktemp('tiny-cross-encoder')
+    transformers.BertTokenizer.from_pretrained(tiny_model_path).save_pretrained(path)
+    config = transformers.BertConfig.from_pretrained(tiny_model_path, num_labels=1)
+    transformers.BertForSequenceClassification(config).save_pretrained(path)
+    return str(path)
+
+
+def test_cross_encoder_reranker_respects_candidate_cap(tiny_cross_encoder_path):
+    from knowledge_base.reranker import CrossEncoderReranker
+
+    reranker = CrossEncoderReranker(tiny_cross_encoder_path, batch_size=2, max_candidates=3)
+    documents = [SimpleDocument(text) for text in ['def f(x): return x', 'class g: pass', 'import x', 'x = 1']]
+    reranked = reranker.rerank('def f', documents)
+    assert {doc.page_content for doc, _ in reranked} == {doc.page_content for doc in documents[:3]}
+    scores = [score for _, score in reranked]
+    assert scores == sorted(scores, reverse=True)
+    assert scores == pytest.approx(sorted(reranker.score('def f', [doc.page_content for doc in documents[:3]]),
+                                          reverse=True), abs=1e-5)
+
+    reranker.time_budget_ms = 0
+    reranked = reranker.rerank('def f', documents, k=3)
+    assert [score for _, score in reranked][2] == float('-inf')
+    assert reranked[2][0] is documents[2]
+
+
+class ReverseReranker:
+    """Reverses the dense order of the candidates."""
+    max_candidates = 4
+
+    def __init__(self):
+        self.candidates = None
+
+    def rerank(self, query, documents, k=None):
+        self.candidates = list(documents)
+        return [(document, float(i)) for i, document in enumerate(reversed(self.candidates))][:k]
+
+
+def test_search_and_rerank_over_fetches_candidates():
+    kbb = KnowledgeBaseBuilder(model=CountingEmbeddings(), model_name='counting')
+    kbb.upload_df_to_faiss(pd.DataFrame({'code': ['a', 'bb', 'ccc', 'dddd', 'eeeee'], 'name': list('abcde')}), 'code')
+    reranker = ReverseReranker()
+
+    results = kbb.search_and_rerank('a', reranker, k=2)
+    assert [doc.metadata['name'] for doc in reranker.candidates] == ['a', 'b', 'c', 'd']
+    assert [doc.metadata['name'] for doc, _ in results] == ['d', 'c']
+    assert [doc.metadata['name'] for doc in kbb.get_retriever(k=1, reranker=reranker).invoke('a')] == ['d']
+
+
+@pytest.mark.parametrize('index_factory', ['IVF2,Flat', 'HNSW8'])
+def test_reindex_keeps_documents_and_filters(index_factory):
+    kbb = KnowledgeBaseBuilder(model=CountingEmbeddings(), model_name='counting')
+    df = pd.DataFrame({'code': ['a' * (i + 1) + ' def' * (i % 3) for i in range(40)],
+                       'name': [f'f{i}' for i in range(40)],
+                       'type': ['function' if i % 2 else 'class' for i in range(40)]})
+    kbb.upload_df_to_faiss(df, 'code')
+    expected = [doc.metadata['name'] for doc, _ in kbb.search(df['code'][7], k=3)]
+
+    kbb.reindex(index_factory, nprobe=2 if index_factory.startswith('IVF') else None,
+                ef_search=None if index_factory.startswith('IVF') else 32)
+    assert kbb.vectorstore.index.ntotal == 40
+    assert [doc.metadata['name'] for doc, _ in kbb.search(df['code'][7], k=3)] == expected
+    assert all(doc.metadata['type'] == 'class' for doc, _ in kbb.search(df['code'][7], k=3, filters={'type': 'class'}))
+    assert list(kbb.get_vector(kbb.vectorstore.index_to_docstore_id[5])) == CountingEmbeddings._embed(df['code'][5])
+
+
+def test_evaluate_retrieval_metrics():
+    df = pd.DataFrame({'code': ['def a(): pass', 'def b(): pass', None],
+                       'generated_docstring': ['Returns nothing at all.', None, 'Orphan docstring.']})
+    queries = build_query_set(df)
+    assert queries == [LabelledQuery('Returns nothing at all.', 'def a(): pass')]
+
+    queries = [LabelledQuery('q1', 'a'), LabelledQuery('q2', 'b'), LabelledQuery('q3', 'c')]
+    results = {'q1': ['a', 'x'], 'q2': ['x', 'b'], 'q3': ['x', 'y']}
+    report = evaluate(lambda query: [SimpleDocument(text) for text in results[query]], queries, ks=(1, 2))
+    assert report['mrr'] == pytest.approx(0.5)
+    assert report['recall@1'] == pytest.approx(1 / 3) and report['recall@2'] == pytest.approx(2 / 3)
+    assert report['queries'] == 3 and report['latency_p95_ms'] >= report['latency_p50_ms'] >= 0
@@ -0,0 +1,375 @@
+import http.client
+import json
+import socket
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from knowledge_base.knowledge_builder import KnowledgeBaseBuilder
+from knowledge_base.knowledge_graph.adjacency_index import AdjacencyIndex
+from rag_integration import external_data_fetcher
+from rag_integration.external_data_fetcher import ContextFetcher
+from rag_integration.graph_expansion import GraphExpander
+from rag_integration.index_router import IndexRouter, item_key
+from rag_integration.prompt_registry import TemplateRegistry, default_registry
+from rag_integration.rag_prompts import TEMPLATES
+from rag_integration.rag_service import RagClient, RagService
+from utils.prompt_layout import PrefixCacheTracker, static_prefix
+# Imported through the package, so the exceptions are the classes the service catches.
+from legacy_code_assistant.utils.token_accounting import TokenAccountant
+
+
+class FakeRetriever:
+    def __init__(self, contents, delay=0.0):
+        self.contents = contents
+        self.delay = delay
+
+    def invoke(self, query):
+        time.sleep(self.delay)
+        return [SimpleNamespace(page_content=content) for content in self.contents]
+
+
+def test_context_fetcher_merges_code_first():
+    fetcher = ContextFetcher(FakeRetriever(['code a', 'code b']),
+                             [FakeRetriever(['so 1', 'so 2']), FakeRetriever(['docs 1'])], timeout=1.0)
+    assert fetcher.fetch({'question': 'why?'}) == ['code a', 'code b', 'so 1', 'docs 1', 'so 2']
+
+
+def test_context_fetcher_drops_slow_external_source():
+    fetcher = ContextFetcher(FakeRetriever(['code a']), [FakeRetriever(['so 1'], delay=0.5)], timeout=0.05)
+    start = time.monotonic()
+    assert fetcher.fetch('why?') == ['code a']
+    assert time.monotonic() - start < 0.4
+    assert fetcher.timeouts == 1
+
+
+class HangingRetriever:
+    """Retriever whose calls block until ``release`` is set."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def invoke(self, query):
+        self.calls += 1
+        self.release.wait()
+        return [SimpleNamespace(page_content='late')]
+
+
+def test_context_fetcher_skips_source_with_running_call():
+    hanging = HangingRetriever()
+    fetcher = ContextFetcher(FakeRetriever(['code a']), [hanging, FakeRetriever(['so 1'])], timeout=0.05,
+                             max_workers=2)
+    for _ in range(20):
+        assert fetcher.fetch('why?') == ['code a', 'so 1']
+    # The hanging source holds one worker; the other worker keeps serving the fast source.
+    assert hanging.calls == 1
+    assert fetcher.skipped == 19
+    assert fetcher.timeouts == 1
+
+    hanging.release.set()
+    time.sleep(0.1)
+    hanging.release.clear()
+    fetcher.fetch('why?')
+    assert hanging.calls == 2
+    hanging.release.set()
+
+
+def test_context_fetcher_respects_token_budget(monkeypatch):
+    # One token per word, whether tiktoken can load its encoding or not.
+    monkeypatch.setattr(external_data_fetcher, 'count_tokens', lambda text: len(text.split()))
+    code, external = FakeRetriever(['word ' * 50]), [FakeRetriever(['short', 'word ' * 50, 'two words'])]
+
+    assert ContextFetcher(code, external, token_budget=53).fetch('why?') == ['word ' * 50, 'short', 'two words']
+    assert ContextFetcher(code, external, token_budget=52).fetch('why?') == ['word ' * 50, 'short']
+    assert ContextFetcher(code, external, token_budget=50).fetch('why?') == ['word ' * 50]
+
+
+class FakeManager:
+    """Answers like RagManager, taking ``delay`` seconds per model call."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def analyze_code(self, user_input, context=None, filters=None, few_shot=None):
+        time.sleep(self.delay)
+        return f'analysis of {user_input} with {context}'
+
+    def find_similar_code(self, source_code, k=5, filters=None):
+        return [(SimpleNamespace(page_content=source_code * i, metadata={'name': f'f{i}', 'filters': filters}),
+                 float(i))
+                for i in range(1, k + 1)]
+
+
+def test_rag_service_answers_concurrent_requests():
+    with RagService(FakeManager(delay=0.2), port=0) as service:
+        client = RagClient(service.url)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(client.analyze_code, [f'q{i}' for i in range(8)]))
+        elapsed = time.monotonic() - start
+
+        assert results == [f'analysis of q{i} with None' for i in range(8)]
+        assert elapsed < 8 * 0.2
+        assert client.analyze_code('q', context='code') == 'analysis of q with code'
+        assert service.requests == 9
+
+
+def test_rag_service_exposes_metrics():
+    with RagService(FakeManager(), port=0) as service:
+        RagClient(service.url).analyze_code('q')
+        with urllib.request.urlopen(f'{service.url}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert '# TYPE lca_stage_seconds summary' in response.read().decode('utf-8')
+
+
+class OverBudgetManager:
+    def __init__(self):
+        self.token_accountant = TokenAccountant()
+        self.token_accountant.record('analyze', 'analyzePrompt', 100, 10)
+
+    def analyze_code(self, user_input, context=None, filters=None, few_shot=None):
+        with self.token_accountant.job('analyze', max_tokens=4000):
+            self.token_accountant.check(5000)
+
+
+def test_rag_service_rejects_requests_over_budget():
+    with RagService(OverBudgetManager(), port=0) as service:
+        with pytest.raises(RuntimeError, match='429'):
+            RagClient(service.url).analyze_code('q')
+        with urllib.request.urlopen(f'{service.url}/tokens') as response:
+            report = json.loads(response.read())
+        assert report['templates'][0]['template'] == 'analyzePrompt'
+        assert report['total']['prompt_tokens'] == 100
+
+
+def test_rag_service_over_unix_socket(tmp_path):
+    with RagService(FakeManager(), unix_socket=str(tmp_path / 'rag.sock')) as service:
+        client = RagClient(service.url)
+        similar = client.find_similar_code('x', k=2)
+        assert [(doc.page_content, doc.metadata['name'], score) for doc, score in similar] == [
+            ('x', 'f1', 1.0), ('xx', 'f2', 2.0)]
+        with pytest.raises(RuntimeError):
+            client._post('write_tests', {'question': 'q'})
+
+
+def test_rag_client_reconnects_after_a_service_restart(tmp_path):
+    client = RagClient(f"unix://{tmp_path / 'rag.sock'}")
+    for _ in range(2):
+        with RagService(FakeManager(), unix_socket=str(tmp_path / 'rag.sock')) as service:
+            assert client.analyze_code('q') == 'analysis of q with None'
+            assert service.requests == 1
+
+
+def test_rag_client_does_not_repeat_a_sent_request():
+    # A service that reads the request and drops the connection without answering.
+    listener = socket.create_server(('127.0.0.1', 0))
+    received = []
+
+    def serve():
+        connection, _ = listener.accept()
+        with connection:
+            received.append(connection.recv(65536))
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    client = RagClient(f'http://127.0.0.1:{listener.getsockname()[1]}', timeout=5)
+    with pytest.raises((ConnectionError, http.client.HTTPException)):
+        client.analyze_code('q')
+    thread.join()
+
+    assert received[0].startswith(b'POST /analyze_code')
+    # A repeated request would already be waiting in the backlog.
+    listener.settimeout(0.1)
+    with pytest.raises(socket.timeout):
+        listener.accept()
+    listener.close()
+
+
+class KeywordEmbeddings(Embeddings):
+    """Embeds texts by counting a few keywords; counts the query embedding calls."""
+    KEYWORDS = ('student', 'grade', 'teacher', 'attendance')
+
+    def __init__(self):
+        self.query_calls = 0
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.query_calls += 1
+        return self._embed(text)
+
+    def _embed(self, text):
+        return [float(text.lower().count(keyword)) for keyword in self.KEYWORDS] + [1.0]
+
+
+@pytest.fixture
+def router_indexes():
+    items = pd.DataFrame({
+        'name': ['average', 'report', 'Teacher'],
+        'parent': ['grades', 'grades', 'staff'],
+        'file': ['grades.py', 'grades.py', 'staff.py'],
+        'code': ['def average(grades): return sum(grades) / len(grades)',
+                 'def report(student): return average(student.grades)',
+                 'class Teacher: attendance = []'],
+        'docstring': ['Average grade of a student.', 'Report of the student grades.', 'A teacher and attendance.'],
+    })
+    model = KeywordEmbeddings()
+    indexes = {}
+    for name in ('code', 'docstring'):
+        indexes[name] = KnowledgeBaseBuilder(model=model, model_name='keywords')
+        indexes[name].upload_df_to_faiss(items.drop(columns=['docstring' if name == 'code' else 'code']), name)
+    return indexes, model
+
+
+def test_index_router_merges_and_deduplicates(router_indexes):
+    indexes, model = router_indexes
+    router = IndexRouter(indexes, k=3)
+    results = router.search('student grade', operation='analyze')
+
+    keys = [item_key(document) for document, _ in results]
+    assert len(keys) == len(set(keys)) == 3
+    assert keys[0] in ('grades.py::grades.average', 'grades.py::grades.report')
+    assert keys[-1] == 'staff.py::staff.Teacher'
+    assert model.query_calls == 1
+
+
+def test_index_router_operation_weights(router_indexes):
+    indexes, _ = router_indexes
+    router = IndexRouter(indexes, operation_weights={'modify': {'code': 1.0}}, k=3)
+    results = router.search('student', operation='modify')
+    assert all(document.page_content.startswith(('def', 'class')) for document, _ in results)
+    assert router.weights('unknown') == {'code': 1.0, 'docstring': 1.0}
+    assert [doc.page_content for doc in router.as_retriever('modify', k=1).invoke('teacher attendance')] == [
+        'class Teacher: attendance = []']
+
+
+def test_index_router_filters(router_indexes):
+    indexes, _ = router_indexes
+    router = IndexRouter(indexes, k=3)
+    results = router.search('student grade', filters={'file': 'staff.py'})
+    assert [item_key(document) for document, _ in results] == ['staff.py::staff.Teacher']
+    assert router.as_retriever(filters={'parent': 'grades'}, k=5).invoke('teacher') != []
+
+
+class ReverseReranker:
+    """Reranker putting the candidates in the reverse order; records the candidates it was given."""
+    max_candidates = 10
+
+    def __init__(self):
+        self.candidates = None
+
+    def rerank(self, query, documents, k=None):
+        self.candidates = list(documents)
+        return [(document, float(i)) for i, document in enumerate(reversed(self.candidates))][:k]
+
+
+def test_index_router_reranks_merged_candidates(router_indexes):
+    indexes, _ = router_indexes
+    reranker = ReverseReranker()
+    results = IndexRouter(indexes, k=3, reranker=reranker).search('teacher attendance', operation='analyze', k=1)
+    merged = IndexRouter(indexes, k=3).search('teacher attendance', operation='analyze')
+
+    assert [item_key(document) for document in reranker.candidates] == [item_key(document) for document, _ in merged]
+    assert [item_key(document) for document, _ in results] == [item_key(merged[-1][0])]
+
+
+def test_graph_expander_adds_callees_and_base_classes():
+    items = pd.DataFrame({
+        'name': ['Child', 'Base', 'helper', 'unrelated'],
+        'parent': ['school', 'school', 'school', 'other'],
+        'type': ['class', 'class', 'function', 'function'],
+        'file': ['school.py', 'school.py', 'school.py', 'other.py'],
+        'code': ['class Child(Base): ...', 'class Base: pass', 'def helper(): return 1', 'def unrelated(): pass'],
+    })
+    kbb = KnowledgeBaseBuilder(model=KeywordEmbeddings(), model_name='keywords')
+    kbb.upload_df_to_faiss(items, 'code')
+    adjacency = AdjacencyIndex({
+        'Child': [('Base', 'inherit', 0.8), ('Child.method', 'consist', 0.6)],
+        'Child.method': [('helper', 'calls', 1.0), ('Child', 'consist', 0.3)],
+    })
+    expander = GraphExpander(adjacency, kbb, max_expansions=3)
+    child = next(doc for doc, _ in kbb.search('x', k=4) if doc.metadata['name'] == 'Child')
+
+    expanded = expander.expand([child])
+    assert [(doc.metadata['name'], round(score, 2)) for doc, score in expanded] == [('Base', 0.8), ('helper', 0.3)]
+    assert GraphExpander(adjacency, kbb, max_expansions=1).expand([child])[0][0].metadata['name'] == 'Base'
+
+    retriever = expander.as_retriever(SimpleNamespace(invoke=lambda query: [child]))
+    assert [doc.metadata['name'] for doc in retriever.invoke('q')] == ['Child', 'Base', 'helper']
+
+
+def test_graph_expander_respects_filters():
+    items = pd.DataFrame({
+        'name': ['Child', 'Base', 'helper'],
+        'parent': ['school', 'school', 'school'],
+        'type': ['class', 'class', 'function'],
+        'file': ['school.py', 'school.py', 'school.py'],
+        'code': ['class Child(Base): ...', 'class Base: pass', 'def helper(): return 1'],
+    })
+    kbb = KnowledgeBaseBuilder(model=KeywordEmbeddings(), model_name='keywords')
+    kbb.upload_df_to_faiss(items, 'code')
+    adjacency = AdjacencyIndex({'Child': [('Base', 'inherit', 0.8), ('helper', 'calls', 0.6)]})
+    expander = GraphExpander(adjacency, kbb, max_expansions=3)
+    child = next(doc for doc, _ in kbb.search('x', k=3) if doc.metadata['name'] == 'Child')
+
+    assert [doc.metadata['name'] for doc, _ in expander.expand([child])] == ['Base', 'helper']
+    assert [doc.metadata['name'] for doc, _ in expander.expand([child], filters={'type': 'function'})] == ['helper']
+    assert expander.expand([child], filters={'module': 'missing'}) == []
+
+    # As in RagManager: the filtered search is expanded with the neighbours matching the same filters.
+    filters = {'type': 'class'}
+    retriever = expander.as_retriever(SimpleNamespace(invoke=lambda query: [child]), filters=filters)
+    assert [doc.metadata['name'] for doc in retriever.invoke('q')] == ['Child', 'Base']
+
+
+@pytest.mark.parametrize('operation', sorted(TEMPLATES))
+def test_rag_prompts_have_a_static_prefix(operation):
+    template = default_registry().get(operation)
+    instructions, examples = template.instructions, template.examples
+    prompt = template.chat_prompt()
+    first = prompt.format_messages(question='What does f do?', context='def f(): pass')
+    second = prompt.format_messages(question='Test g', context='def g(x):\n    return {x}')
+    assert first[0].content == second[0].content
+    assert 'What does f do?' in first[-1].content and 'Context: def f(): pass' in first[-1].content
+
+    tracker = PrefixCacheTracker()
+    assert not tracker.record(operation, first)
+    assert tracker.record(operation, second)
+    assert tracker.report()[operation]['reuse_rate'] == 0.5
+
+    compact = template.chat_prompt(few_shot=False)
+    compact_messages = compact.format_messages(question='q', context='c')
+    assert compact_messages[0].content == static_prefix(instructions)
+    if examples:
+        assert len(compact_messages[0].content) < len(first[0].content)
+
+
+def test_template_registry_compiles_and_validates_templates():
+    registry = default_registry()
+    assert default_registry() is registry
+    analyze = registry.get('analyze')
+    assert analyze.chat_prompt() is registry.chat_prompt('analyze')
+    assert analyze.variables == ['context', 'question']
+    assert analyze.label(few_shot=False) == f'analyze@v{analyze.version}:compact'
+    assert analyze.prefix_tokens(False) < analyze.prefix_tokens(True)
+    assert registry.by_title('Write Tests').name == 'test'
+    assert {entry['name'] for entry in registry.describe()} == set(TEMPLATES)
+
+    with pytest.raises(ValueError, match='Unknown template'):
+        registry.get('translate')
+    with pytest.raises(ValueError, match='contains the variables'):
+        TemplateRegistry({'broken': {'instructions': 'Answer {question} briefly.'}})
+    with pytest.raises(ValueError, match='no variables'):
+        TemplateRegistry({'broken': {'instructions': 'Answer.', 'variables_template': 'nothing'}})
+    # Braces of code examples are not variables and are sent verbatim.
+    registry = TemplateRegistry({'dicts': {'instructions': 'Return {"a": 1} as in:', 'examples': 'f"{name}"'}})
+    messages = registry.chat_prompt('dicts').format_messages(question='q', context='c')
+    assert messages[0].content == 'Return {"a": 1} as in:\n\nf"{name}"'
@@ -0,0 +1,309 @@
+import io
+import json
+import lzma
+import sys
+from types import SimpleNamespace
+
+import faiss
+import numpy as np
+import pytest
+
+from utils import common_utils
+from utils.instrumentation import Instrumentation
+from utils.stackoverflow_embeddings import (ParamsTuple, VectorShardWriter, build_ivf_index_from_shards,
+                                            create_question_vecs, create_question_vecs_parallel,
+                                            derive_topics_from_vecs, get_vecs_from_file, iter_vector_shards,
+                                            parse_tags, questions_iter, sample_vectors)
+# Imported through the package, like the service and RagManager do, so there is one TokenBudgetExceeded class.
+from legacy_code_assistant.utils.token_accounting import TokenAccountant, TokenBudgetExceeded
+
+POSTS_XML = (
+    b'<?xml version="1.0" encoding="utf-8"?>\n'
+    b'<posts>\n'
+    b'  <row Id="1" PostTypeId="1" CreationDate="2020-01-01T00:00:00" Title="Django ORM join" '
+    b'Tags="&lt;python&gt;&lt;django&gt;" />\n'
+    b'  <row Id="2" PostTypeId="2" CreationDate="2020-01-02T00:00:00" />\n'
+    b'  <row Id="3" PostTypeId="1" CreationDate="2020-01-03T00:00:00" Title="CSS grid" Tags="|css|html|" />\n'
+    b'  <row Id="4" PostTypeId="1" CreationDate="2020-01-04T00:00:00" Title="Pandas merge" '
+    b'Tags="&lt;python&gt;&lt;pandas&gt;" />\n'
+    b'</posts>\n'
+)
+
+
+def fake_embed(texts):
+    return np.array([[len(text), i] for i, text in enumerate(texts)], dtype='float32')
+
+
+def test_parse_tags_formats():
+    assert parse_tags('<python><django>') == ['python', 'django']
+    assert parse_tags('|css|html|') == ['css', 'html']
+    assert parse_tags('') == []
+
+
+def test_questions_iter_filters_by_techs():
+    questions = list(questions_iter(io.BytesIO(POSTS_XML), techs={'python', 'django'}, min_techs_in_question=1))
+    assert [q.id for q in questions] == ['1', '4']
+    questions = list(questions_iter(io.BytesIO(POSTS_XML), techs={'python', 'django'}, min_techs_in_question=2))
+    assert [q.id for q in questions] == ['1']
+
+
+def test_questions_iter_rejects_min_techs_without_techs():
+    with pytest.raises(ValueError, match='requires techs'):
+        next(questions_iter(io.BytesIO(POSTS_XML), min_techs_in_question=2))
+    assert len(list(questions_iter(io.BytesIO(POSTS_XML)))) == 3
+
+
+def test_vector_shard_writer_roundtrip(tmp_path):
+    with VectorShardWriter(str(tmp_path), dim=2, shard_size=3) as writer:
+        writer.append(np.arange(10, dtype='float32').reshape(5, 2), [{'id': i} for i in range(5)])
+    shards = list(iter_vector_shards(str(tmp_path)))
+    assert [len(vectors) for vectors, _ in shards] == [3, 2]
+    np.testing.assert_array_equal(np.concatenate([v for v, _ in shards]), np.arange(10).reshape(5, 2))
+    with open(shards[1][1]) as f:
+        assert f.read().splitlines() == ['{"id": 3}', '{"id": 4}']
+
+
+def test_create_question_vecs_streams_to_shards(tmp_path):
+    posts_path = tmp_path / 'Posts.xml'
+    posts_path.write_bytes(POSTS_XML)
+    params = ParamsTuple(str(posts_path), None, str(tmp_path / 'vecs'), 1, techs=['python'], batch_size=1)
+    create_question_vecs(params, embed_fn=fake_embed)
+    vectors, metadata_path = next(iter_vector_shards(str(tmp_path / 'vecs')))
+    assert vectors.shape == (2, 2)
+    assert vectors[0, 0] == len('Django ORM join')
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_create_question_vecs_without_matching_questions(tmp_path, parallel):
+    posts_path = tmp_path / 'Posts.xml'
+    posts_path.write_bytes(POSTS_XML)
+    params = ParamsTuple(str(posts_path), None, str(tmp_path / 'vecs'), 1, techs=['rust'], batch_size=1)
+
+    if parallel:
+        create_question_vecs_parallel(params, workers=2, embed_factory=fake_embed_factory)
+    else:
+        create_question_vecs(params, embed_fn=fake_embed)
+
+    assert get_vecs_from_file(str(tmp_path / 'vecs')).shape[0] == 0
+    assert list(iter_vector_shards(str(tmp_path / 'vecs'))) == []
+
+
+def fake_embed_factory():
+    return fake_embed
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_create_question_vecs_parallel(tmp_path, compressed):
+    posts_path = tmp_path / ('Posts.xml.xz' if compressed else 'Posts.xml')
+    posts_path.write_bytes(lzma.compress(POSTS_XML) if compressed else POSTS_XML)
+    params = ParamsTuple(str(posts_path), None, str(tmp_path / 'vecs'), 1, techs=['python'], batch_size=1)
+
+    create_question_vecs_parallel(params, workers=2, embed_factory=fake_embed_factory,
+                                  index_path=str(tmp_path / 'questions.index'))
+
+    vectors = get_vecs_from_file(str(tmp_path / 'vecs'))
+    assert sorted(vectors[:, 0]) == sorted([len('Django ORM join'), len('Pandas merge')])
+    assert faiss.read_index(str(tmp_path / 'questions.index')).ntotal == 2
+
+
+def test_create_question_vecs_parallel_pre_split_shards(tmp_path):
+    lines = POSTS_XML.splitlines(keepends=True)
+    shard_paths = []
+    for i, shard_lines in enumerate([lines[:3], lines[3:]]):
+        shard_path = tmp_path / f'Posts_{i}.xml'
+        shard_path.write_bytes(b''.join(shard_lines))
+        shard_paths.append(str(shard_path))
+    params = ParamsTuple(None, None, str(tmp_path / 'vecs'), 1, techs=['python'], batch_size=8)
+
+    create_question_vecs_parallel(params, workers=2, input_shards=shard_paths, embed_factory=fake_embed_factory)
+
+    assert len(get_vecs_from_file(str(tmp_path / 'vecs'))) == 2
+
+
+def failing_embed_factory():
+    raise ValueError('embedding model not available')
+
+
+def test_create_question_vecs_parallel_fails_fast_when_a_worker_dies(tmp_path):
+    posts_path = tmp_path / 'Posts.xml'
+    posts_path.write_bytes(POSTS_XML)
+    params = ParamsTuple(str(posts_path), None, str(tmp_path / 'vecs'), 1, techs=['python'], batch_size=1)
+
+    # One worker with a queue of two tasks: without the failure check the parent would block on the third put.
+    with pytest.raises(RuntimeError, match='worker'):
+        create_question_vecs_parallel(params, workers=1, embed_factory=failing_embed_factory)
+
+
+def _write_random_shards(directory, n=600, dim=8, shard_size=250):
+    vectors = np.random.default_rng(0).random((n, dim), dtype='float32')
+    with VectorShardWriter(directory, dim=dim, shard_size=shard_size) as writer:
+        writer.append(vectors, [{}] * n)
+    return vectors
+
+
+@pytest.mark.parametrize('on_disk', [False, True])
+def test_build_ivf_index_from_shards(tmp_path, on_disk):
+    vectors = _write_random_shards(str(tmp_path / 'vecs'))
+    index_path = str(tmp_path / 'index.faiss')
+    build_ivf_index_from_shards(str(tmp_path / 'vecs'), index_path, nlist=4, batch_size=100,
+                                ivfdata_path=str(tmp_path / 'index.ivfdata') if on_disk else None)
+
+    index = faiss.read_index(index_path)
+    index.nprobe = 4
+    assert index.ntotal == len(vectors)
+    _, ids = index.search(vectors[[0, 300, 599]], 1)
+    assert ids[:, 0].tolist() == [0, 300, 599]
+
+
+def test_derive_topics_from_vecs_streams_batches(tmp_path):
+    vectors = _write_random_shards(str(tmp_path / 'vecs'))
+    derive_topics_from_vecs(str(tmp_path / 'vecs'), str(tmp_path / 'flat.faiss'), batch_size=128)
+    assert faiss.read_index(str(tmp_path / 'flat.faiss')).ntotal == len(vectors)
+
+
+def test_derive_topics_from_vecs_without_vectors(tmp_path):
+    VectorShardWriter(str(tmp_path / 'vecs'), dim=8).close()
+    with pytest.raises(ValueError, match='no vectors'):
+        derive_topics_from_vecs(str(tmp_path / 'vecs'), str(tmp_path / 'flat.faiss'))
+
+    derive_topics_from_vecs(str(tmp_path / 'vecs'), str(tmp_path / 'flat.faiss'), dimensions=8)
+    index = faiss.read_index(str(tmp_path / 'flat.faiss'))
+    assert (index.ntotal, index.d) == (0, 8)
+
+
+def test_build_ivf_index_from_shards_without_vectors(tmp_path):
+    VectorShardWriter(str(tmp_path / 'vecs'), dim=8).close()
+    with pytest.raises(ValueError, match='no vectors'):
+        build_ivf_index_from_shards(str(tmp_path / 'vecs'), str(tmp_path / 'index.faiss'))
+    with pytest.raises(ValueError, match='no vectors'):
+        sample_vectors(str(tmp_path / 'vecs'), 10)
+
+
+def test_instrumentation_timings_counters_and_exports(tmp_path):
+    metrics = Instrumentation()
+    for _ in range(3):
+        with metrics.timed('embed_documents'):
+            pass
+    metrics.count('query_cache', result='hit')
+    metrics.count('query_cache', 2, result='hit')
+    metrics.record_tokens('llm', prompt_tokens=120, completion_tokens=30)
+
+    data = metrics.to_dict()
+    assert data['timings']['embed_documents']['count'] == 3
+    assert {(counter['name'], tuple(sorted(counter['labels'].items())), counter['value'])
+            for counter in data['counters']} == {
+        ('query_cache', (('result', 'hit'),), 3),
+        ('llm_tokens', (('kind', 'prompt'), ('stage', 'llm')), 120),
+        ('llm_tokens', (('kind', 'completion'), ('stage', 'llm')), 30)}
+
+    text = metrics.to_prometheus()
+    assert 'lca_stage_seconds_count{stage="embed_documents"} 3' in text
+    assert 'lca_query_cache_total{result="hit"} 3' in text
+    assert '# TYPE lca_llm_tokens_total counter' in text
+
+    metrics.to_json(tmp_path / 'metrics.json')
+    assert json.loads((tmp_path / 'metrics.json').read_text())['timings']['embed_documents']['count'] == 3
+
+
+def test_instrumentation_profiles_outermost_stage(tmp_path):
+    metrics = Instrumentation(profile_dir=str(tmp_path))
+    with metrics.timed('rag.analyze'):
+        with metrics.timed('retrieval'):
+            sum(range(1000))
+    metrics.enable_profiling(str(tmp_path), stages=['retrieval'])
+    with metrics.timed('retrieval'):
+        pass
+    assert sorted(path.name.split('-')[0] for path in tmp_path.glob('*.prof')) == ['rag.analyze', 'retrieval']
+
+
+class FakeSpan:
+    def __init__(self, spans, name):
+        self.spans, self.name = spans, name
+
+    def __enter__(self):
+        self.spans.append(self.name)
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_instrumentation_opentelemetry_spans_and_langchain_callback():
+    spans = []
+    metrics = Instrumentation()
+    metrics.enable_opentelemetry(SimpleNamespace(start_as_current_span=lambda name, attributes: FakeSpan(spans, name)))
+    with metrics.timed('retrieval', operation='analyze'):
+        pass
+    assert spans == ['retrieval']
+
+    handler = metrics.langchain_callback('llm')
+    assert metrics.langchain_callback('llm') is handler
+    handler.on_chat_model_start({}, [], run_id='run')
+    handler.on_llm_end(SimpleNamespace(llm_output={'token_usage': {'prompt_tokens': 10, 'completion_tokens': 5}}),
+                       run_id='run')
+    data = metrics.to_dict()
+    assert data['timings']['llm']['count'] == 1
+    assert sum(counter['value'] for counter in data['counters'] if counter['name'] == 'llm_tokens') == 15
+
+
+def test_token_accountant_reports_template_spend():
+    accountant = TokenAccountant(prompt_price=1.0, completion_price=2.0)
+    assert accountant.register_template('analyzePrompt', 'Analyze the code. {question} {context}') == \
+        accountant.count_text('Analyze the code.  ')
+    accountant.record('analyze', 'analyzePrompt', 1000, 100)
+    accountant.record('analyze', 'analyzePrompt', 1000, 100)
+    accountant.record('test', 'testPrompt', 3000, 500)
+
+    report = accountant.report()
+    assert report['total'] == {'calls': 3, 'prompt_tokens': 5000, 'completion_tokens': 700, 'total_tokens': 5700,
+                               'cost': pytest.approx(6.4)}
+    assert report['operations']['analyze']['cost'] == pytest.approx(2.4)
+    assert [entry['template'] for entry in report['templates']] == ['testPrompt', 'analyzePrompt']
+    assert report['templates'][0]['cost_share'] == pytest.approx(4.0 / 6.4)
+    assert report['templates'][1]['static_share'] == pytest.approx(
+        accountant.count_text('Analyze the code.  ') * 2 / 2000)
+    assert 'testPrompt' in accountant.format_report().splitlines()[1]
+
+
+def test_token_accountant_enforces_job_budget():
+    from langchain.chat_models.fake import FakeListChatModel
+    from langchain.schema import HumanMessage
+
+    accountant = TokenAccountant()
+    model = FakeListChatModel(responses=['a docstring'] * 3)
+    messages = [HumanMessage(content='Describe the function. ' * 20)]
+    prompt_tokens = accountant.count_messages(messages)
+    completion_tokens = accountant.count_text('a docstring')
+
+    with accountant.job('docstrings', max_tokens=2 * prompt_tokens + completion_tokens - 1) as budget:
+        callbacks = [accountant.langchain_callback('docstring_generation', 'docstringPrompt')]
+        model(messages, callbacks=callbacks)
+        with pytest.raises(TokenBudgetExceeded):
+            model(messages, callbacks=callbacks)
+    assert (budget.prompt_tokens, budget.completion_tokens) == (prompt_tokens, completion_tokens)
+    assert [call['template'] for call in accountant.calls] == ['docstringPrompt']
+
+    # Outside of a job the calls are only accounted.
+    model(messages, callbacks=[accountant.langchain_callback('docstring_generation', 'docstringPrompt')])
+    assert accountant.report()['total']['calls'] == 2
+
+
+def test_get_encoding_retries_after_a_failure(monkeypatch):
+    attempts = []
+
+    def get_encoding(name):
+        attempts.append(name)
+        if len(attempts) == 1:
+            raise OSError('offline')
+        return SimpleNamespace(encode=lambda text, disallowed_special=(): text.split())
+
+    monkeypatch.setitem(sys.modules, 'tiktoken', SimpleNamespace(get_encoding=get_encoding))
+    monkeypatch.setattr(common_utils, '_encodings', {})
+    monkeypatch.setattr(common_utils, '_failed_encodings', {})
+
+    assert common_utils.count_tokens('one two three four five') == 6
+    assert common_utils.count_tokens('one two three four five') == 6
+    assert len(attempts) == 1
+    monkeypatch.setattr(common_utils, 'ENCODING_RETRY_SECONDS', 0)
+    assert common_utils.count_tokens('one two three four five') == 5
+    assert common_utils.count_tokens('one two') == 2
+    assert len(attempts) == 2